@@ -1,31 +1,183 @@
 """ Flask Feedback app """
 
-from flask import Flask, jsonify, request, redirect, render_template, redirect, flash, session
+import hashlib
+import itertools
+import math
+import os
+import zlib
+
+
+from flask import Flask, jsonify, request, redirect, render_template, redirect, flash, session, Markup
+from flask import Blueprint, abort, current_app, g, make_response, Response, stream_with_context
 # from flask_debugtoolbar import DebugToolbarExtension
 from models import db, connect_db, User, USER_FIELDS, db_add_user, db_delete_user
 from models import db, connect_db, Feedback, db_add_feedback, db_update_feedback, db_delete_feedback
-from config import APP_KEY
+from models import db_add_feedback_batch, db_delete_feedback_batch
+from models import db_check_availability, db_record_login
+from models import db_get_feedback_page, db_get_user_profile, db_search_feedback, get_owned_feedback
+from models import iter_user_feedback, db_get_archived_feedback_page
+from hashing import password_hasher, HashingBusyError
+from render_cache import render_cache
+from identity import user_cache
+from routing import reading_replica, replica_router
+from sharding import ShardMovingError, shard_router
+from assets import assets
+from jobs import job_queue
+from slow_query import slow_query_log
+from metrics import metrics
+from throttle import login_throttle
+from settings import load_config, engine_options
 from forms import LoginForm, RegistrationForm, FeedbackForm
+from commands import register_commands
+
+bp = Blueprint("feedback_app", __name__)
+
+
+def create_app(config=None):
+    """ Build the Flask Feedback app. Settings come from settings.DEFAULTS, then environment
+        variables, then config (a dict) when given.
+
+        `flask run` finds this factory on its own. Set FLASK_FEEDBACK_APP=1 to also build a
+        module level app at import time for WSGI servers that expect app:app.
+    """
+
+    app = Flask(__name__)
+
+    app.config.update(load_config())
+    if config:
+        app.config.update(config)
+
+    if not app.config.get("SECRET_KEY"):
+        from config import APP_KEY
+        app.config["SECRET_KEY"] = APP_KEY
+
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options(app.config))
+
+    # # debugtoolbar
+    # debug = DebugToolbarExtension(app)
+    # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+
+    connect_db(app)
+    # first of the before_request hooks that may query, so their statements and time are counted
+    metrics.init_app(app)
+    password_hasher.init_app(app)
+    render_cache.init_app(app)
+    user_cache.init_app(app, db_get_user_profile)
+    slow_query_log.init_app(app)
+    login_throttle.init_app(app)
+    assets.init_app(app)
+    job_queue.init_app(app)
+    register_commands(app)
+
+    with app.app_context():
+        for engine in [db.get_engine()] + replica_router.replica_engines(db) + shard_router.shard_engines(db):
+            slow_query_log.instrument(engine)
+            if app.config["METRICS_ENABLED"]:
+                metrics.instrument(engine)
+
+    app.register_blueprint(bp)
+
+    return app
+
+
+def get_per_page():
+    """ Page size for feedback listings: ?per_page= when given, limited to FEEDBACK_MAX_PAGE_SIZE,
+        otherwise FEEDBACK_PAGE_SIZE.
+    """
+
+    per_page = request.args.get("per_page", current_app.config["FEEDBACK_PAGE_SIZE"], type=int)
+
+    return max(1, min(per_page, current_app.config["FEEDBACK_MAX_PAGE_SIZE"]))
+
+
+STREAM_MARKER = "<!-- feedback stream -->"
+
+
+def chunked(fragments, chunk_bytes):
+    """ Join the text fragments into utf8 chunks of at least chunk_bytes (the last may be shorter) """
+
+    buffer = []
+    size = 0
+
+    for fragment in fragments:
+        data = fragment.encode("utf8")
+        buffer.append(data)
+        size += len(data)
+
+        if (size >= chunk_bytes):
+            yield b"".join(buffer)
+            (buffer, size) = ([], 0)
+
+    if buffer:
+        yield b"".join(buffer)
 
-app = Flask(__name__)
 
-# Flask and SQL Alchemy Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql:///flask_feedback_db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
+def gzipped(chunks, level=6):
+    """ gzip the chunks on the fly. Each chunk is sync flushed so the browser can render it
+        before the rest arrives.
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+def stream_user_page(username, full_name, form, total):
+    """ The profile page as a streamed response holding every piece of the user's feedback.
+
+        view_user.html is rendered first, with a marker where the feedback list goes, so the
+        flashes and the CSRF token are taken from the session before the response starts. The
+        part before the marker is sent at once. The feedback list is then rendered from a
+        server side cursor as it is read, so memory stays bounded whatever the feedback count.
+    """
+
+    config = current_app.config
+
+    page = render_template("view_user.html", full_name=full_name, form=form, form_user=username,
+                           feedback_html=Markup(STREAM_MARKER))
+    (head, tail) = page.split(STREAM_MARKER, 1)
+
+    def body():
+        yield head.encode("utf8")
+
+        rows = iter(iter_user_feedback(username, batch_size=config["PROFILE_STREAM_BATCH_SIZE"]))
+        first = next(rows, None)
+
+        context = {"form_user": username, "total": total, "per_page": None,
+                   "feedback": itertools.chain([first], rows) if first is not None else [],
+                   "next_cursor": None, "prev_cursor": None}
+        current_app.update_template_context(context)
+
+        template = current_app.jinja_env.get_template("_feedback_list.html")
+        yield from chunked(template.generate(context), config["PROFILE_STREAM_CHUNK_BYTES"])
+
+        yield tail.encode("utf8")
 
-app.config['SECRET_KEY'] = APP_KEY
+    chunks = body()
+    response = Response(mimetype="text/html")
 
-# # debugtoolbar
-# debug = DebugToolbarExtension(app)
-# app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    if (config["PROFILE_STREAM_GZIP"]):
+        response.vary.add("Accept-Encoding")
+        if ("gzip" in request.accept_encodings):
+            chunks = gzipped(chunks)
+            response.headers["Content-Encoding"] = "gzip"
 
-connect_db(app)
+    # the request context (and the database session) stays up until the last chunk is sent
+    response.response = stream_with_context(chunks)
+    # let proxies pass the chunks through as they come
+    response.headers["X-Accel-Buffering"] = "no"
+
+    return response
 
 
 # Form Routes
 
-@app.route("/")
+@bp.route("/")
 def home_page():
     """ Home page for the Flask Feedback application.
         Redirects to /register
@@ -34,7 +186,7 @@ def home_page():
     return redirect("/register")
 
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
 def create_user_page():
     """ route: /register  Present visitor with a form that lets them create a new user
         by username, password, email, first_name, and last_name, all of which are required.
@@ -73,7 +225,24 @@ def create_user_page():
         return render_template("registration.html", form=form)
 
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/register/check", methods=["GET"])
+def check_registration_availability():
+    """ route: /register/check?username=<username>&email=<email>  Live registration form feedback.
+
+        Returns {"username": true|false, "email": true|false} with a key for each value given, true
+        when it is free. The answer is advice; registering can still find the name taken.
+    """
+
+    values = {field: request.args.get(field, "").strip() for field in ("username", "email")}
+    values = {field: value for (field, value) in values.items() if value}
+
+    if not values:
+        return api_error("Send a username and / or an email to check.", 400)
+
+    return jsonify(db_check_availability(**values))
+
+
+@bp.route("/login", methods=["GET", "POST"])
 def login_user_page():
     """ route: /login  Present visitor with a form that lets them login by providing their
         username and password, email, first_name, and last_name, all of which are required.
@@ -89,23 +258,38 @@ def login_user_page():
         username = form.username.data
         password = form.password.data
 
+        # throttled attempts are refused before any database lookup or password hashing
+        retry_after = login_throttle.check(username, request.remote_addr)
+        if (retry_after is not None):
+            flash(f"Too many login attempts. Please try again in {math.ceil(retry_after)} seconds.",
+                  "flash-error")
+            return (render_template("login.html", form=form), 429)
+
         # authenticate returns either a user object or False
-        auth_user = User.authenticate(username, password)
+        try:
+            auth_user = User.authenticate(username, password)
+
+        except HashingBusyError:
+            flash("Login is busy right now. Please try again in a moment.", "flash-error")
+            return render_template("login.html", form=form)
 
         if (auth_user):
 
+            login_throttle.record_success(username)
+            db_record_login(auth_user.username)
             session["username"] = auth_user.username
 
             return redirect(f"/user/{username}")
 
         else:
+            login_throttle.record_failure(username)
             # handle the error messaging better
             flash("username and / or password are incorrect.", "flash-error")
 
     return render_template("login.html", form=form)
 
 
-@app.route("/secret", methods=["GET"])
+@bp.route("/secret", methods=["GET"])
 def secret_page():
     """ route: /secret  Restricted page viewable only by authenticated users.
     """
@@ -116,7 +300,7 @@ def secret_page():
     return redirect("/login")
 
 
-@app.route("/user")
+@bp.route("/user")
 def user_limbo():
     """ route: //user  User may be lost. Redirect them to user/<username> when logged in, otherwise 
         redirect them to the login page.
@@ -129,7 +313,7 @@ def user_limbo():
         return redirect("/login")
 
 
-@app.route("/user/<username>", methods=["GET"])
+@bp.route("/user/<username>", methods=["GET"])
 def view_user_page(username):
     """ route: //user/<username>  Restricted page viewable only by authenticated user.
 
@@ -141,19 +325,49 @@ def view_user_page(username):
         Have a link that sends you to a form to add more feedback and a button to delete the user. Make sure 
         that only the user who is logged in can successfully view this page.
 
+        Feedback is paged by id. ?after=<id> and ?before=<id> move to the next and previous pages and
+        ?per_page=<n> overrides the configured page size.
+
+        With PROFILE_STREAMING_ENABLED the page lists all of the feedback and is streamed instead
+        (stream_user_page).
+
     """
 
     if ("username" in session):
         if (session["username"] == username):
-            auth_user = User.query.get_or_404(username)
+            # loaded once per request (identity.py), usually without touching the users table
+            auth_user = g.user
+            if auth_user is None:
+                abort(404)
             full_name = auth_user.get_full_name()
 
             form = RegistrationForm(obj=auth_user)
 
-            user_feedback = Feedback.query.filter_by(username=username).all()
+            if (current_app.config["PROFILE_STREAMING_ENABLED"]):
+                return stream_user_page(username, full_name, form, auth_user.feedback_count)
+
+            after = request.args.get("after", type=int)
+            before = request.args.get("before", type=int)
+            per_page = get_per_page()
+
+            # the feedback section is cached per user and page until the user's feedback changes
+            cache_key = render_cache.key(username, f"{after}:{before}:{per_page}", auth_user.pages_version)
+            feedback_html = render_cache.get(cache_key)
+
+            if (feedback_html is None):
+                page = db_get_feedback_page(username, after=after, before=before, per_page=per_page)
+
+                feedback_html = render_template("_feedback_list.html", form_user=username,
+                                                feedback=page["feedback"], per_page=per_page,
+                                                total=auth_user.feedback_count,
+                                                next_cursor=page["next"], prev_cursor=page["prev"])
+                # a lagging replica's page would stay cached under the current version until the
+                #  next write; only pages read from the primary are cached
+                if not reading_replica():
+                    render_cache.set(cache_key, feedback_html)
 
             return render_template("view_user.html", full_name=full_name,
-                                   form=form, form_user=username, feedback=user_feedback)
+                                   form=form, form_user=username, feedback_html=Markup(feedback_html))
         else:
             # view of another's profile is not allowed.
             flash("You may only view your profile!", "flash-error")
@@ -165,11 +379,65 @@ def view_user_page(username):
     return redirect("/login")
 
 
+@bp.route("/user/<username>/feedback/archived", methods=["GET"])
+def view_archived_feedback_page(username):
+    """ route: /user/<username>/feedback/archived  The logged in user's archived (old, read only)
+        feedback, paged like the profile page. Only loaded when asked for, so the profile page
+        itself only reads the live feedback table.
+    """
+
+    if ("username" in session):
+        if (session["username"] == username):
+            after = request.args.get("after", type=int)
+            before = request.args.get("before", type=int)
+            per_page = get_per_page()
+
+            page = db_get_archived_feedback_page(username, after=after, before=before, per_page=per_page)
+
+            return render_template("archived_feedback.html", form_user=username, feedback=page["feedback"],
+                                   per_page=per_page, next_cursor=page["next"], prev_cursor=page["prev"])
+        else:
+            flash("You may only view your own feedback!", "flash-error")
+            return redirect(f"/user/{session['username']}")
+
+    else:
+        flash("You must login to view your feedback.", "flash-error")
+
+    return redirect("/login")
+
+
+@bp.route("/user/<username>/feedback/search", methods=["GET"])
+def search_user_feedback_page(username):
+    """ route: /user/<username>/feedback/search?q=<words>  Only the logged in user can search their
+        feedback. Lists the feedback whose title or content contains all of the words, best match
+        first, ?page=<n> at a time.
+    """
+
+    if ("username" in session):
+        if (session["username"] == username):
+            terms = request.args.get("q", "")
+            per_page = get_per_page()
+
+            results = db_search_feedback(username, terms, page=max(1, request.args.get("page", 1, type=int)),
+                                         per_page=per_page)
+
+            return render_template("search_feedback.html", form_user=username, terms=terms,
+                                   per_page=per_page, **results)
+        else:
+            flash("You may only search your own feedback!", "flash-error")
+            return redirect(f"/user/{session['username']}")
+
+    else:
+        flash("You must login to search your feedback.", "flash-error")
+
+    return redirect("/login")
+
+
 # POST /users/<username>/delete
 # Remove the user from the database and make sure to also delete all of their feedback. Clear any user
 # information in the session and redirect to /. Make sure that only the user who is logged in can
 # successfully delete their account
-@app.route("/user/<username>/delete", methods=["POST"])
+@bp.route("/user/<username>/delete", methods=["POST"])
 def delete_user(username):
     """ route: /user/<username>/delete  Delete the user and all their feedback from the database. 
         User information in the session is cleared (user logged out) and redirected to /. 
@@ -212,7 +480,7 @@ def delete_user(username):
     return redirect("/login")
 
 
-@app.route("/user/<username>/feedback/add", methods=["GET", "POST"])
+@bp.route("/user/<username>/feedback/add", methods=["GET", "POST"])
 def add_user_feedback_page(username):
     """ route: /user/<username>/feedback/add:   Only the logged in user can see their page. 
         Displays a form for the user to add feedback. When feedback is successfully added, the user is
@@ -257,7 +525,7 @@ def add_user_feedback_page(username):
     return redirect("/login")
 
 
-@app.route("/logout", methods=["POST"])
+@bp.route("/logout", methods=["POST"])
 def logout_user():
     """ route: /logout  logs user out by removing credentials from session.
         Redirect to login page.
@@ -276,7 +544,7 @@ def logout_user():
 # POST /feedback/<feedback-id>/update
 #     Update a specific piece of feedback and redirect to /users/<username> — Make sure that only the user who has written
 # that feedback can update it
-@app.route("/feedback/<feedback_id>/update", methods=["GET", "POST"])
+@bp.route("/feedback/<int:feedback_id>/update", methods=["GET", "POST"])
 def update_feedback_page(feedback_id):
     """ route: /feedback/<feedback-id>/update:  Only the user who authored the feedback identified by
         feedback-id can see the update page. 
@@ -285,45 +553,68 @@ def update_feedback_page(feedback_id):
         Only logged in users can perform an update to feedback.
         Form redirects to /users/<username> after the update.
         Form redirects to /login when the a user is not logged in.
+
+        A valid POST is one conditional UPDATE (db_update_feedback) that also refuses to save over a
+        newer version than the one the form was loaded with.
     """
 
     if ("username" in session):
 
-        # user is logged in, but did they write the feedback?
-
-        db_feedback = Feedback.query.get_or_404(feedback_id)
         session_username = session["username"]
+        form = FeedbackForm()
 
-        if (db_feedback.username == session_username):
+        if form.validate_on_submit():
+            feedback_info = {
+                "title": form.title.data,
+                "content": form.content.data
+            }
+            expected_version = int(form.version.data) if form.version.data.isdigit() else None
 
-            form = FeedbackForm(obj=db_feedback)
+            results = db_update_feedback(feedback_id, session_username, feedback_info,
+                                         expected_version=expected_version)
 
-            if form.validate_on_submit():
-                feedback_info = {
-                    "title": form.title.data,
-                    "content": form.content.data
-                }
+            if (results["success"]):
 
-                results = db_update_feedback(db_feedback, feedback_info)
+                flash(results['messages'][0][1],
+                      f"flash-{results['messages'][0][0]}")
 
-                if (results["success"]):
+                return redirect(f"/user/{ session_username }")
 
-                    flash(results['messages'][0][1],
-                          f"flash-{results['messages'][0][0]}")
+            if (results["error"] == "not_found"):
+                abort(404)
 
-                    return redirect(f"/user/{ session_username }")
-                else:
+            if (results["error"] == "not_owner"):
+                # feedback_id does not belong to this user.
+                flash(results['messages'][0][1], "flash-error")
 
-                    # FUTURE: handle the error messaging better by addinbg the messages to the fields error,
-                    # for now, flash them
-                    for (field, msg) in results["messages"]:
-                        flash(msg, "flash-error")
+                return redirect(f"/user/{ session_username }")
 
-                    return render_template("add_or_update_feedback.html", mode="Update", form=form, username=session_username)
+            if (results["error"] == "conflict"):
+                # changed since the form was loaded; reload it with the current text
+                flash(results['messages'][0][1], "flash-error")
 
-            else:
-                # return render_template("add_or_update_feedback.html", mode="Update", form=form)
-                return render_template("add_or_update_feedback.html", mode="Update", form=form, username=session_username)
+                return redirect(f"/feedback/{ feedback_id }/update")
+
+            # FUTURE: handle the error messaging better by addinbg the messages to the fields error,
+            # for now, flash them
+            for (field, msg) in results["messages"]:
+                flash(msg, "flash-error")
+
+            return render_template("add_or_update_feedback.html", mode="Update", form=form, username=session_username)
+
+        # user is logged in, but did they write the feedback?
+
+        (db_feedback, error) = get_owned_feedback(feedback_id, session_username)
+
+        if (error == "not_found"):
+            abort(404)
+
+        if (error is None):
+
+            if (request.method == "GET"):
+                form = FeedbackForm(obj=db_feedback)
+
+            return render_template("add_or_update_feedback.html", mode="Update", form=form, username=session_username)
 
         else:
             # feedback_id does not belong to this user.
@@ -337,37 +628,57 @@ def update_feedback_page(feedback_id):
     return redirect("/login")
 
 
-@app.route("/feedback/<feedback_id>/delete", methods=["GET", "POST"])
+@bp.route("/feedback/<int:feedback_id>/delete", methods=["GET", "POST"])
 def delete_user_feedback(feedback_id):
     """ route: /feedback/<feedback_id>/delete:  Delete feedback associated with feedback_id. Only a logged in user 
         can delete their own feedback. A user cannot delete another user's feedback.
 
+        One conditional DELETE (db_delete_feedback) checks ownership and deletes.
+
         redirected to /users/<username>
     """
 
     if ("username" in session):
         session_username = session["username"]
 
-        # user is logged in, but did they write the feedback?
+        results = db_delete_feedback(feedback_id, session_username)
 
-        db_feedback = Feedback.query.get(feedback_id)
+        flash(results['message'][1], f"flash-{results['message'][0]}")
 
-        if (db_feedback):
+        return redirect(f"/user/{ session_username }")
 
-            if (db_feedback.username == session_username):
+    else:
+        flash("You must login to delete your feedback.", "flash-error")
 
-                results = db_delete_feedback(db_feedback)
+    return redirect("/login")
 
-                flash(results['message'][1], f"flash-{results['message'][0]}")
 
-            else:
-                # feedback_id does not belong to this user.
-                flash("You cannot delete another users feedback.", "flash-error")
+@bp.route("/user/<username>/feedback/delete", methods=["POST"])
+def delete_user_feedback_batch(username):
+    """ route: /user/<username>/feedback/delete:  Delete the feedback checked on the profile page
+        (form field feedback_id, repeated) in one transaction. Only the logged in user can delete
+        their own feedback.
+
+        redirected to /users/<username>
+    """
+
+    if ("username" in session):
+        session_username = session["username"]
+
+        feedback_ids = request.form.getlist("feedback_id", type=int)
+
+        if not feedback_ids:
+            flash("No feedback was selected.", "flash-error")
+
+        elif (len(feedback_ids) > current_app.config["FEEDBACK_MAX_BATCH_SIZE"]):
+            flash(f"At most {current_app.config['FEEDBACK_MAX_BATCH_SIZE']} pieces of feedback can be deleted at once.",
+                  "flash-error")
 
         else:
-            # feedback_id does not exist.
-            flash(
-                "The requested feedback was not found and was NOT deleted.", "flash-error")
+            results = db_delete_feedback_batch(session_username, feedback_ids)
+
+            for item in results["items"]:
+                flash(item["message"][1], f"flash-{item['message'][0]}")
 
         return redirect(f"/user/{ session_username }")
 
@@ -375,3 +686,283 @@ def delete_user_feedback(feedback_id):
         flash("You must login to delete your feedback.", "flash-error")
 
     return redirect("/login")
+
+
+# JSON API Routes
+#  Same rules as the form routes: a logged in user can only see and change their own feedback.
+#  Responses carry an ETag built from the feedback row versions. GETs honor If-None-Match with a
+#  304 and updates / deletes honor If-Match with a 412.
+
+def api_error(message, status):
+    """ JSON error response """
+
+    return (jsonify(error=message), status)
+
+
+@bp.app_errorhandler(ShardMovingError)
+def user_being_moved(err):
+    """ Writes of a user that is being moved to another shard (sharding.py) are refused for a
+        few seconds. The API answers 503 with a Retry-After, the pages flash and go back.
+    """
+
+    db.session.rollback()
+    message = "Your account is being moved. Please try again in a moment."
+
+    if request.path.startswith("/api/"):
+        (response, status) = api_error(message, 503)
+        return (response, status, {"Retry-After": str(current_app.config["SHARD_DIRECTORY_TTL"])})
+
+    flash(message, "flash-error")
+    return redirect(request.referrer or "/")
+
+
+def feedback_etag(feedback_list):
+    """ ETag for one or more feedback rows, derived from their ids and row versions. """
+
+    versions = ",".join(f"{comment.id}.{comment.version}" for comment in feedback_list)
+
+    return hashlib.sha1(versions.encode("utf8")).hexdigest()
+
+
+def api_owned_feedback(feedback_id):
+    """ Return (db_feedback, None) for the logged in user's feedback_id, otherwise
+        (None, error response).
+    """
+
+    if ("username" not in session):
+        return (None, api_error("You must login to access feedback.", 401))
+
+    (db_feedback, error) = get_owned_feedback(feedback_id, session["username"])
+
+    if (error == "not_found"):
+        return (None, api_error("The requested feedback was not found.", 404))
+
+    if (error == "not_owner"):
+        return (None, api_error("You cannot access another users feedback.", 403))
+
+    if (request.if_match and not request.if_match.contains(feedback_etag([db_feedback]))):
+        return (None, api_error("The feedback was changed by another request.", 412))
+
+    return (db_feedback, None)
+
+
+def api_write_error(error, messages):
+    """ Error response for a failed db_update_feedback / db_delete_feedback """
+
+    if (error == "invalid"):
+        return (jsonify(errors=[msg for (field, msg) in messages]), 400)
+
+    statuses = {"not_found": 404, "not_owner": 403, "conflict": 412}
+
+    return api_error(messages[0][1], statuses.get(error, 500))
+
+
+def api_feedback_response(db_feedback, status=200):
+    """ JSON response for one piece of feedback with its ETag """
+
+    response = make_response(jsonify(feedback=db_feedback.serialize()), status)
+    response.set_etag(feedback_etag([db_feedback]))
+
+    return response.make_conditional(request)
+
+
+@bp.route("/api/feedback", methods=["GET"])
+def api_list_feedback():
+    """ route: GET /api/feedback  The logged in user's feedback, paged the same way as the profile page
+        (?after=, ?before=, ?per_page=).
+
+        Returns {"feedback": [...], "next": id or null, "prev": id or null}
+    """
+
+    if ("username" not in session):
+        return api_error("You must login to access feedback.", 401)
+
+    page = db_get_feedback_page(session["username"],
+                                after=request.args.get("after", type=int),
+                                before=request.args.get("before", type=int),
+                                per_page=get_per_page())
+
+    response = jsonify(feedback=[comment.serialize() for comment in page["feedback"]],
+                       next=page["next"], prev=page["prev"])
+    response.set_etag(feedback_etag(page["feedback"]))
+
+    return response.make_conditional(request)
+
+
+@bp.route("/api/feedback/search", methods=["GET"])
+def api_search_feedback():
+    """ route: GET /api/feedback/search?q=<words>  The logged in user's feedback matching all of the
+        words, best match first. Paged with ?page= and ?per_page=.
+
+        Returns {"feedback": [...], "page": n, "next": page or null, "prev": page or null}
+    """
+
+    if ("username" not in session):
+        return api_error("You must login to access feedback.", 401)
+
+    results = db_search_feedback(session["username"], request.args.get("q", ""),
+                                 page=max(1, request.args.get("page", 1, type=int)),
+                                 per_page=get_per_page())
+
+    return jsonify(feedback=[comment.serialize() for comment in results["feedback"]],
+                   page=results["page"], next=results["next"], prev=results["prev"])
+
+
+@bp.route("/api/feedback", methods=["POST"])
+def api_add_feedback():
+    """ route: POST /api/feedback  Create feedback from JSON {"title": ..., "content": ...} for the
+        logged in user. Returns 201 and the new feedback.
+    """
+
+    if ("username" not in session):
+        return api_error("You must login to provide feedback.", 401)
+
+    data = request.get_json(silent=True) or {}
+
+    results = db_add_feedback({
+        "title": str(data.get("title") or ""),
+        "content": str(data.get("content") or ""),
+        "username": session["username"]
+    })
+
+    if (results["success"]):
+        return api_feedback_response(results["feedback"], 201)
+
+    return (jsonify(errors=[msg for (field, msg) in results["messages"]]), 400)
+
+
+def api_batch_list(key):
+    """ Return (list, None) for the request's JSON list under key, otherwise (None, error response). """
+
+    items = (request.get_json(silent=True) or {}).get(key)
+
+    if not (isinstance(items, list) and items):
+        return (None, api_error(f"Send a non empty list in '{key}'.", 400))
+
+    if (len(items) > current_app.config["FEEDBACK_MAX_BATCH_SIZE"]):
+        return (None, api_error(f"At most {current_app.config['FEEDBACK_MAX_BATCH_SIZE']} items per batch.", 413))
+
+    return (items, None)
+
+
+@bp.route("/api/feedback/batch", methods=["POST"])
+def api_add_feedback_batch():
+    """ route: POST /api/feedback/batch  Create feedback from JSON {"feedback": [{"title": ..., "content": ...}, ...]}
+        for the logged in user in one transaction.
+
+        Returns {"created": n, "failed": n, "results": [...]} with one result per item, in order:
+        {"status": 201, "feedback": {...}} or {"status": 400, "errors": [...]}.
+    """
+
+    if ("username" not in session):
+        return api_error("You must login to provide feedback.", 401)
+
+    (feedback_list, error_response) = api_batch_list("feedback")
+    if error_response:
+        return error_response
+
+    results = db_add_feedback_batch(session["username"], [
+        {"title": str(item.get("title") or ""), "content": str(item.get("content") or "")}
+        if isinstance(item, dict) else {} for item in feedback_list])
+
+    if not results["success"]:
+        return api_error(results["items"][0]["messages"][0][1], 500)
+
+    return jsonify(created=results["created"], failed=results["failed"], results=[
+        {"status": 201, "feedback": item["feedback"].serialize()} if item["success"] else
+        {"status": 400, "errors": [msg for (severity, msg) in item["messages"]]}
+        for item in results["items"]])
+
+
+@bp.route("/api/feedback/batch/delete", methods=["POST"])
+def api_delete_feedback_batch():
+    """ route: POST /api/feedback/batch/delete  Delete the logged in user's feedback listed in
+        JSON {"ids": [...]} in one transaction.
+
+        Returns {"deleted": n, "failed": n, "results": [{"id": id, "status": 200 | 403 | 404, ...}, ...]}
+    """
+
+    if ("username" not in session):
+        return api_error("You must login to access feedback.", 401)
+
+    (feedback_ids, error_response) = api_batch_list("ids")
+    if error_response:
+        return error_response
+
+    if not all(isinstance(feedback_id, int) and not isinstance(feedback_id, bool) for feedback_id in feedback_ids):
+        return api_error("ids must be a list of feedback ids.", 400)
+
+    results = db_delete_feedback_batch(session["username"], feedback_ids)
+
+    if not results["success"]:
+        return api_error("An error occurred. No feedback was deleted.", 500)
+
+    statuses = {None: 200, "not_found": 404, "not_owner": 403}
+
+    return jsonify(deleted=results["deleted"], failed=results["failed"], results=[
+        {"id": item["id"], "status": statuses[item["error"]], "message": item["message"][1]}
+        for item in results["items"]])
+
+
+@bp.route("/api/feedback/<int:feedback_id>", methods=["GET"])
+def api_get_feedback(feedback_id):
+    """ route: GET /api/feedback/<feedback_id>  One piece of the logged in user's feedback. """
+
+    (db_feedback, error_response) = api_owned_feedback(feedback_id)
+    if error_response:
+        return error_response
+
+    return api_feedback_response(db_feedback)
+
+
+@bp.route("/api/feedback/<int:feedback_id>", methods=["PATCH", "PUT"])
+def api_update_feedback(feedback_id):
+    """ route: PATCH /api/feedback/<feedback_id>  Update the title and / or content of the logged in
+        user's feedback from JSON. Fields that are not sent keep their value. The update only applies
+        to the version that was read (and matched If-Match); a concurrent change gets a 412.
+    """
+
+    (db_feedback, error_response) = api_owned_feedback(feedback_id)
+    if error_response:
+        return error_response
+
+    data = request.get_json(silent=True) or {}
+
+    results = db_update_feedback(feedback_id, session["username"], {
+        "title": str(data.get("title", db_feedback.title) or ""),
+        "content": str(data.get("content", db_feedback.content) or "")
+    }, expected_version=db_feedback.version)
+
+    if (results["success"]):
+        return api_feedback_response(results["feedback"])
+
+    return api_write_error(results["error"], results["messages"])
+
+
+@bp.route("/api/feedback/<int:feedback_id>", methods=["DELETE"])
+def api_delete_feedback(feedback_id):
+    """ route: DELETE /api/feedback/<feedback_id>  Delete the logged in user's feedback. Without
+        If-Match this is a single conditional DELETE; with it the version that matched is the only
+        one deleted.
+    """
+
+    if ("username" not in session):
+        return api_error("You must login to access feedback.", 401)
+
+    expected_version = None
+    if request.if_match:
+        (db_feedback, error_response) = api_owned_feedback(feedback_id)
+        if error_response:
+            return error_response
+        expected_version = db_feedback.version
+
+    results = db_delete_feedback(feedback_id, session["username"], expected_version=expected_version)
+
+    if (results["successful"]):
+        return jsonify(message=results["message"][1])
+
+    return api_write_error(results["error"], [results["message"]])
+
+
+if os.environ.get("FLASK_FEEDBACK_APP"):
+    app = create_app()
@@ -0,0 +1,386 @@
+""" Async serving mode for the Flask Feedback app.
+
+    An ASGI application in front of the Flask app. The read heavy routes - the profile page,
+    GET /api/feedback, GET /api/feedback/<id> and GET /api/feedback/search - are served by
+    coroutines that query through SQLAlchemy's AsyncSession (asyncpg on PostgreSQL, aiosqlite
+    on SQLite) with the same models.py definitions and statements. While one of them waits on
+    the database the event loop serves other requests, so one process holds many slow clients
+    without a thread each.
+
+    Everything else - form posts, JSON writes, redirects, error pages - is handed to the
+    unchanged Flask app on a pool of ASYNC_BRIDGE_THREADS threads. The async views hand a
+    request over too whenever it is not the plain success case (not logged in, someone else's
+    profile, ...), so the flashes and redirects stay exactly those of app.py.
+
+        uvicorn --factory asgi:create_asgi_app
+
+    Routing, the session cookie and the templates all come from the Flask app. Templates are
+    rendered on a bridge thread, in a Flask request context that is pushed only after the last
+    await and runs the app's before_request / after_request hooks (metrics, replica pinning,
+    g.user), so the async routes are timed and behave like the Flask ones.
+
+    An in memory SQLite database (sqlite://) is not shared between the two engines; use a file.
+    With sharding (DB_SHARD_URIS, sharding.py) every route goes through the Flask app.
+"""
+
+import asyncio
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from flask import g, jsonify, render_template, Markup
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_cookie
+from werkzeug.routing import RequestRedirect
+
+from app import create_app, api_error, feedback_etag
+from forms import RegistrationForm
+from identity import UserProfile, user_cache
+from models import Feedback, user_profile_statement, feedback_page_statement, feedback_page
+from models import feedback_search_statement, feedback_search_page
+from render_cache import render_cache
+from sharding import shard_router
+from settings import async_database_uri, async_engine_options
+
+
+def wsgi_environ(scope, body):
+    """ WSGI environ for an ASGI http scope """
+
+    (server_name, server_port) = scope.get("server") or ("localhost", 80)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    for (name, value) in scope["headers"]:
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+
+        if (name == "CONTENT_TYPE"):
+            environ[name] = value
+            continue
+
+        if (name == "CONTENT_LENGTH"):
+            continue
+
+        # repeated headers are joined as a list, except cookies (HTTP/2 sends one header per cookie)
+        key = f"HTTP_{name}"
+        separator = "; " if (key == "HTTP_COOKIE") else ", "
+        environ[key] = f"{environ[key]}{separator}{value}" if key in environ else value
+
+    # the body has been read in full, chunked or not
+    environ["CONTENT_LENGTH"] = str(len(body))
+
+    return environ
+
+
+class FeedbackASGI:
+    """ ASGI app serving the read routes asynchronously and the rest through the Flask app. """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        config = flask_app.config
+
+        self.engine = create_async_engine(
+            config["ASYNC_DATABASE_URI"] or async_database_uri(config["SQLALCHEMY_DATABASE_URI"]),
+            **async_engine_options(config))
+        self.async_session = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+
+        self.bridge = ThreadPoolExecutor(max_workers=config["ASYNC_BRIDGE_THREADS"],
+                                         thread_name_prefix="wsgi-bridge")
+
+        # Flask endpoint -> coroutine. Anything not listed goes to the Flask app.
+        self.views = {
+            "feedback_app.view_user_page": self.view_user_page,
+            "feedback_app.api_list_feedback": self.api_list_feedback,
+            "feedback_app.api_get_feedback": self.api_get_feedback,
+            "feedback_app.api_search_feedback": self.api_search_feedback,
+        }
+
+        # the async engine only reaches the primary, not the shards
+        if shard_router.enabled:
+            self.views = {}
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] == "lifespan"):
+            return await self.lifespan(receive, send)
+
+        if (scope["type"] != "http"):
+            raise NotImplementedError(f"unsupported ASGI scope type {scope['type']}")
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        environ = wsgi_environ(scope, body)
+        # request metrics cover the async queries too
+        environ["feedback.started"] = time.perf_counter()
+
+        try:
+            (endpoint, view_args) = self.flask_app.url_map.bind_to_environ(environ).match()
+        except (HTTPException, RequestRedirect):
+            (endpoint, view_args) = (None, {})
+
+        response = None
+        view = self.views.get(endpoint)
+        if view is not None:
+            response = await view(environ, **view_args)
+
+        if response is None:
+            response = await asyncio.get_running_loop().run_in_executor(self.bridge, self.run_wsgi, environ)
+
+        await self.send_response(send, *response)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if (message["type"] == "lifespan.startup"):
+                await send({"type": "lifespan.startup.complete"})
+
+            elif (message["type"] == "lifespan.shutdown"):
+                await self.engine.dispose()
+                self.bridge.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def send_response(self, send, status, headers, body):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(name.encode("latin1"), value.encode("latin1")) for (name, value) in headers]})
+        await send({"type": "http.response.body", "body": body})
+
+    # the Flask side
+
+    def run_wsgi(self, environ):
+        """ Run the Flask app for environ on a bridge thread. Returns (status, headers, body). """
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = headers
+
+        result = self.flask_app(environ, start_response)
+        try:
+            body = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+        return (started["status"], started["headers"], body)
+
+    async def finish(self, environ, make_response):
+        """ Run respond() on a bridge thread, so rendering templates never blocks the event loop. """
+
+        return await asyncio.get_running_loop().run_in_executor(self.bridge, self.respond, environ, make_response)
+
+    def respond(self, environ, make_response):
+        """ Build a response with make_response() inside a Flask request context, after the app's
+            before_request hooks, let Flask run the after_request hooks and save the session
+            (flashes read by the templates, CSRF token) and return (status, headers, body).
+        """
+
+        with self.flask_app.request_context(environ):
+            response = self.flask_app.preprocess_request()
+
+            if response is None:
+                if ("metrics_start" in g):
+                    g.metrics_start = environ["feedback.started"]
+                response = make_response()
+
+            response = self.flask_app.process_response(self.flask_app.make_response(response))
+            response = response.make_conditional(environ)
+
+            return (response.status_code, list(response.headers.items()), response.get_data())
+
+    def session_username(self, environ):
+        """ username in the signed Flask session cookie, or None """
+
+        cookie = parse_cookie(environ).get(self.flask_app.session_cookie_name)
+        if not cookie:
+            return None
+
+        serializer = self.flask_app.session_interface.get_signing_serializer(self.flask_app)
+        try:
+            data = serializer.loads(cookie, max_age=int(self.flask_app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            return None
+
+        return data.get("username")
+
+    def arguments(self, environ):
+        """ The query string as a dict (last value wins) """
+
+        return dict(parse_qsl(environ["QUERY_STRING"], keep_blank_values=True))
+
+    def int_argument(self, arguments, name, default=None):
+        try:
+            return int(arguments[name])
+        except (KeyError, ValueError):
+            return default
+
+    def per_page(self, arguments):
+        """ Same rules as app.get_per_page """
+
+        config = self.flask_app.config
+        per_page = self.int_argument(arguments, "per_page", config["FEEDBACK_PAGE_SIZE"])
+
+        return max(1, min(per_page, config["FEEDBACK_MAX_PAGE_SIZE"]))
+
+    # async views. Each returns (status, headers, body), or None to hand the request to Flask.
+
+    async def load_profile(self, session, username):
+        profile = user_cache.cached(username)
+
+        if profile is None:
+            row = (await session.execute(user_profile_statement(username))).first()
+            profile = UserProfile(*row) if row else None
+            user_cache.put(username, profile)
+
+        return profile
+
+    async def view_user_page(self, environ, username):
+        """ async app.view_user_page """
+
+        if (self.session_username(environ) != username):
+            return None
+
+        arguments = self.arguments(environ)
+        after = self.int_argument(arguments, "after")
+        before = self.int_argument(arguments, "before")
+        per_page = self.per_page(arguments)
+
+        async with self.async_session() as session:
+            profile = await self.load_profile(session, username)
+            if profile is None:
+                return None
+
+            cache_key = render_cache.key(username, f"{after}:{before}:{per_page}", profile.pages_version)
+            feedback_html = render_cache.get(cache_key)
+
+            page = None
+            if (feedback_html is None):
+                rows = (await session.execute(feedback_page_statement(username, after, before, per_page))).scalars().all()
+                page = feedback_page(rows, after, before, per_page)
+
+        def make_response():
+            nonlocal feedback_html
+
+            g.user = profile
+
+            if (feedback_html is None):
+                feedback_html = render_template("_feedback_list.html", form_user=username,
+                                                feedback=page["feedback"], per_page=per_page,
+                                                total=profile.feedback_count,
+                                                next_cursor=page["next"], prev_cursor=page["prev"])
+                render_cache.set(cache_key, feedback_html)
+
+            return render_template("view_user.html", full_name=profile.get_full_name(),
+                                   form=RegistrationForm(obj=profile), form_user=username,
+                                   feedback_html=Markup(feedback_html))
+
+        return await self.finish(environ, make_response)
+
+    async def api_list_feedback(self, environ):
+        """ async app.api_list_feedback """
+
+        username = self.session_username(environ)
+        if username is None:
+            return None
+
+        arguments = self.arguments(environ)
+        after = self.int_argument(arguments, "after")
+        before = self.int_argument(arguments, "before")
+        per_page = self.per_page(arguments)
+
+        async with self.async_session() as session:
+            rows = (await session.execute(feedback_page_statement(username, after, before, per_page))).scalars().all()
+
+        page = feedback_page(rows, after, before, per_page)
+
+        def make_response():
+            response = jsonify(feedback=[comment.serialize() for comment in page["feedback"]],
+                               next=page["next"], prev=page["prev"])
+            response.set_etag(feedback_etag(page["feedback"]))
+            return response
+
+        return await self.finish(environ, make_response)
+
+    async def api_get_feedback(self, environ, feedback_id):
+        """ async app.api_get_feedback """
+
+        username = self.session_username(environ)
+        if username is None:
+            return None
+
+        async with self.async_session() as session:
+            db_feedback = (await session.execute(
+                select(Feedback).where(Feedback.id == feedback_id))).scalars().first()
+
+        def make_response():
+            if (db_feedback is None):
+                return api_error("The requested feedback was not found.", 404)
+
+            if (db_feedback.username != username):
+                return api_error("You cannot access another users feedback.", 403)
+
+            response = jsonify(feedback=db_feedback.serialize())
+            response.set_etag(feedback_etag([db_feedback]))
+            return response
+
+        return await self.finish(environ, make_response)
+
+    async def api_search_feedback(self, environ):
+        """ async app.api_search_feedback """
+
+        username = self.session_username(environ)
+        if username is None:
+            return None
+
+        arguments = self.arguments(environ)
+        terms = arguments.get("q", "")
+        page = max(1, self.int_argument(arguments, "page", 1))
+        per_page = self.per_page(arguments)
+
+        rows = []
+        if terms.split():
+            async with self.async_session() as session:
+                rows = (await session.execute(feedback_search_statement(
+                    username, terms, page, per_page, self.engine.dialect.name))).scalars().all()
+
+        results = feedback_search_page(rows, page, per_page)
+
+        def make_response():
+            return jsonify(feedback=[comment.serialize() for comment in results["feedback"]],
+                           page=results["page"], next=results["next"], prev=results["prev"])
+
+        return await self.finish(environ, make_response)
+
+
+def create_asgi_app(config=None):
+    """ ASGI app around create_app(config) """
+
+    return FeedbackASGI(create_app(config))
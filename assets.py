@@ -0,0 +1,215 @@
+""" Fingerprinted, precompressed static assets and the Jinja bytecode cache.
+
+    `flask build-assets` copies every file under static/ to static/dist/ with a content hash
+    in its name (base.css -> base.3f2a9c1b0d4e.css), writes .gz and, when the brotli package
+    is installed, .br variants of the text files next to it and records the names in
+    static/dist/manifest.json.
+
+    Templates link assets with asset_url("base.css"). With a manifest it returns the hashed
+    URL under ASSETS_URL_PREFIX, which is served with a far future immutable Cache-Control and
+    the best precompressed variant the client accepts. A changed file gets a new name, so it
+    never needs revalidating. Without a manifest (no build yet) it falls back to /static/.
+
+        ASSETS_URL_PREFIX               /assets by default.
+        ASSETS_MAX_AGE                  Cache-Control max-age of hashed assets, one year.
+        JINJA_BYTECODE_CACHE_ENABLED    compiled templates are kept in JINJA_BYTECODE_CACHE_DIR
+        JINJA_BYTECODE_CACHE_DIR        (default: Jinja's per user directory in the system temp
+                                        dir) so new workers skip compiling them. The directory
+                                        must belong to the app's user and not be writable by
+                                        anyone else, since Jinja runs the bytecode it finds there.
+
+    The manifest is read at startup; restart the workers after a build.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import stat
+
+from flask import request, send_from_directory, abort
+from jinja2 import FileSystemBytecodeCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIRECTORY = "dist"
+MANIFEST_NAME = "manifest.json"
+
+# only these are worth compressing; images and fonts are already compressed
+COMPRESSIBLE = (".css", ".js", ".svg", ".html", ".json", ".txt", ".map")
+
+
+def fingerprint(path):
+    """ First 12 hex digits of the sha256 of the file at path """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for chunk in iter(lambda: source.read(65536), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()[:12]
+
+
+def write_compressed(path):
+    """ Write path.gz and, with brotli installed, path.br when they are smaller than path.
+        Returns the encodings written.
+    """
+
+    with open(path, "rb") as source:
+        data = source.read()
+
+    variants = [("gzip", ".gz", lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(("br", ".br", lambda raw: brotli.compress(raw, quality=11)))
+
+    written = []
+    for (encoding, suffix, compress) in variants:
+        compressed = compress(data)
+        if (len(compressed) < len(data)):
+            with open(path + suffix, "wb") as output:
+                output.write(compressed)
+            written.append(encoding)
+
+    return written
+
+
+def private_directory(path):
+    """ Create path (mode 0700) if needed and check that only the current user can write to it.
+        Raises RuntimeError otherwise.
+    """
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    status = os.lstat(path)
+    if (not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or
+            status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+        raise RuntimeError(f"{path} must be a directory owned by this user and not writable by others")
+
+    return path
+
+
+def build_assets(static_folder):
+    """ Fingerprint and precompress every file under static_folder into static_folder/dist and
+        write the manifest. Returns the manifest {"files": {name: hashed name}, "encodings": {...}}.
+    """
+
+    dist_folder = os.path.join(static_folder, DIST_DIRECTORY)
+    if os.path.isdir(dist_folder):
+        shutil.rmtree(dist_folder)
+    os.makedirs(dist_folder)
+
+    manifest = {"files": {}, "encodings": {}}
+
+    for (directory, subdirectories, filenames) in os.walk(static_folder):
+        if (os.path.abspath(directory) == os.path.abspath(static_folder)):
+            subdirectories[:] = [name for name in subdirectories if name != DIST_DIRECTORY]
+
+        for filename in sorted(filenames):
+            source = os.path.join(directory, filename)
+            name = os.path.relpath(source, static_folder).replace(os.sep, "/")
+
+            (stem, extension) = os.path.splitext(name)
+            hashed_name = f"{stem}.{fingerprint(source)}{extension}"
+
+            target = os.path.join(dist_folder, hashed_name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+
+            manifest["files"][name] = hashed_name
+            if (extension.lower() in COMPRESSIBLE):
+                manifest["encodings"][hashed_name] = write_compressed(target)
+
+    with open(os.path.join(dist_folder, MANIFEST_NAME), "w") as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class Assets:
+    """ asset_url template helper, the hashed asset route and the Jinja bytecode cache. """
+
+    def __init__(self, app=None):
+        self.files = {}
+        self.encodings = {}
+        self.url_prefix = "/assets"
+        self.max_age = 31536000
+        self.dist_folder = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("ASSETS_URL_PREFIX", "/assets")
+        app.config.setdefault("ASSETS_MAX_AGE", 31536000)
+        app.config.setdefault("JINJA_BYTECODE_CACHE_ENABLED", True)
+        app.config.setdefault("JINJA_BYTECODE_CACHE_DIR", "")
+
+        self.url_prefix = app.config["ASSETS_URL_PREFIX"]
+        self.max_age = app.config["ASSETS_MAX_AGE"]
+        self.dist_folder = os.path.join(app.static_folder, DIST_DIRECTORY)
+        self.load_manifest()
+
+        app.add_template_global(self.asset_url, "asset_url")
+        app.add_url_rule(f"{self.url_prefix}/<path:filename>", "assets", self.send_asset)
+
+        if app.config["JINJA_BYTECODE_CACHE_ENABLED"]:
+            if app.config["JINJA_BYTECODE_CACHE_DIR"]:
+                app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+                    private_directory(app.config["JINJA_BYTECODE_CACHE_DIR"]))
+            else:
+                # Jinja creates and checks a 0700 directory of this user's in the temp dir
+                app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.dist_folder, MANIFEST_NAME)) as source:
+                manifest = json.load(source)
+        except (OSError, ValueError):
+            manifest = {}
+
+        self.files = manifest.get("files", {})
+        self.encodings = manifest.get("encodings", {})
+
+    def asset_url(self, name):
+        """ template helper: URL of the static file name, fingerprinted when built """
+
+        if (name in self.files):
+            return f"{self.url_prefix}/{self.files[name]}"
+
+        return f"/static/{name}"
+
+    def send_asset(self, filename):
+        """ route: ASSETS_URL_PREFIX/<filename>  a fingerprinted asset, precompressed when the
+            client accepts it, cacheable forever.
+        """
+
+        if (filename not in self.encodings and filename not in self.files.values()):
+            abort(404)
+
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        encodings = self.encodings.get(filename, [])
+
+        for (encoding, suffix) in (("br", ".br"), ("gzip", ".gz")):
+            if (encoding in encodings and encoding in request.accept_encodings):
+                response = send_from_directory(self.dist_folder, filename + suffix, mimetype=mimetype,
+                                               cache_timeout=self.max_age)
+                response.headers["Content-Encoding"] = encoding
+                break
+        else:
+            response = send_from_directory(self.dist_folder, filename, mimetype=mimetype,
+                                           cache_timeout=self.max_age)
+
+        if encodings:
+            response.vary.add("Accept-Encoding")
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+
+        return response
+
+
+assets = Assets()
@@ -0,0 +1,352 @@
+""" Load and latency benchmark for the Flask Feedback app.
+
+    Seeds a database with users and feedback, then runs concurrent clients through the app with
+    a weighted mix of register, login, profile view, add / update / delete feedback and delete
+    user requests. Requests go through Flask's test client, so no server or network is needed.
+
+    Prints (or writes with --output) a JSON report with throughput and p50 / p95 / p99 latency per
+    route. Keys are sorted so two reports diff cleanly; --compare old.json new.json prints the
+    change in p50 / p95 / throughput per route.
+
+        python benchmark.py --users 200 --feedback-per-user 50 --clients 8 --requests 250
+        python benchmark.py --database postgresql:///flask_feedback_bench --output after.json
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import func, inspect, text
+
+from app import create_app
+from models import db, Feedback
+import bulk
+
+DEFAULT_MIX = "register=5,login=15,view=45,add=15,update=10,delete=8,delete_user=2"
+PASSWORD = "benchmark-password"
+
+
+def parse_mix(mix):
+    """ "view=50,login=20" -> [("view", 50), ("login", 20)] """
+
+    weights = []
+    for part in mix.split(","):
+        (name, weight) = part.split("=")
+        if (name.strip() not in OPERATIONS):
+            raise SystemExit(f"unknown operation '{name}'. Choose from {', '.join(OPERATIONS)}")
+        weights.append((name.strip(), float(weight)))
+    return weights
+
+
+def percentile(sorted_values, pct):
+    """ Nearest rank percentile of an already sorted list. """
+
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# seeding
+
+def seed(app, nbr_users, feedback_per_user, reset=False):
+    """ Create nbr_users users (user0 ...) with feedback_per_user pieces of feedback each.
+        Returns {username: [feedback ids]}.
+
+        Seeding drops every table first, so a database that already has tables is refused unless
+        reset is set.
+    """
+
+    def quiet(row_number, message):
+        pass
+
+    users = ({"username": f"user{i}", "password": PASSWORD, "email": f"user{i}@bench.test",
+              "first_name": "Bench", "last_name": f"User{i}"} for i in range(nbr_users))
+    feedback = ({"title": f"title {i}", "content": f"benchmark feedback {i} " * 8,
+                 "username": f"user{i % nbr_users}"} for i in range(nbr_users * feedback_per_user))
+
+    with app.app_context():
+        tables = inspect(db.engine).get_table_names()
+        if (tables and not reset):
+            raise SystemExit(f"{db.engine.url!r} already has tables ({', '.join(sorted(tables)[:5])} ...). "
+                             "The benchmark drops them all; pass --reset if that is what you want.")
+
+        db.drop_all()
+        db.create_all()
+
+        if (db.engine.dialect.name == "sqlite"):
+            db.session.execute(text("PRAGMA journal_mode=WAL"))
+
+        bulk.import_users(((n, row, None) for (n, row) in enumerate(users, 1)), quiet)
+        bulk.import_feedback(((n, row, None) for (n, row) in enumerate(feedback, 1)), quiet)
+
+        owned = {f"user{i}": [] for i in range(nbr_users)}
+        for (feedback_id, username) in db.session.query(Feedback.id, Feedback.username):
+            owned[username].append(feedback_id)
+
+    return owned
+
+
+# client operations. Each returns the response; the client decides what counts as an error.
+
+class Client:
+    """ One simulated user session driving the app through a test client. """
+
+    def __init__(self, app, client_id, owned, rng):
+        self.app = app
+        self.client_id = client_id
+        self.owned = owned
+        self.rng = rng
+        self.http = app.test_client()
+        self.registered = 0
+
+        # clients take seeded users in turn so they only share accounts when there are more
+        #  clients than users
+        usernames = sorted(owned, key=lambda username: int(username[4:]))
+        self.username = usernames[client_id % len(usernames)]
+        self.feedback_ids = owned.get(self.username, [])
+        self.added = False
+        self.login()
+
+    def login(self):
+        return self.http.post("/login", data={"username": self.username, "password": PASSWORD})
+
+    def register(self):
+        self.registered += 1
+        username = f"c{self.client_id}n{self.registered}"
+        response = self.http.post("/register", data={
+            "username": username, "password": PASSWORD, "email": f"{username}@bench.test",
+            "first_name": "New", "last_name": "User"})
+        self.username = username
+        self.feedback_ids = []
+        return response
+
+    def view(self):
+        return self.http.get(f"/user/{self.username}")
+
+    def add(self):
+        response = self.http.post(f"/user/{self.username}/feedback/add", data={
+            "title": "benchmark title", "content": "benchmark content " * 8})
+        self.added = response.status_code < 400
+        return response
+
+    def record_added(self):
+        """ The add page redirects without the new id, so read it back (outside the timed request)
+            for later updates and deletes to use.
+        """
+
+        if not self.added:
+            return
+        self.added = False
+
+        with self.app.app_context():
+            feedback_id = db.session.query(func.max(Feedback.id)).filter_by(username=self.username).scalar()
+            db.session.remove()
+
+        if (feedback_id is not None and feedback_id not in self.feedback_ids):
+            self.feedback_ids.append(feedback_id)
+
+    def update(self):
+        if not self.feedback_ids:
+            return self.add()
+        feedback_id = self.rng.choice(self.feedback_ids)
+        return self.http.post(f"/feedback/{feedback_id}/update", data={
+            "title": "updated title", "content": "updated content " * 8})
+
+    def delete(self):
+        if not self.feedback_ids:
+            return self.add()
+        feedback_id = self.feedback_ids.pop(self.rng.randrange(len(self.feedback_ids)))
+        return self.http.post(f"/feedback/{feedback_id}/delete")
+
+    def delete_user(self):
+        response = self.http.post(f"/user/{self.username}/delete")
+        # carry on as a brand new user
+        self.register()
+        return response
+
+
+OPERATIONS = {
+    "register": Client.register,
+    "login": Client.login,
+    "view": Client.view,
+    "add": Client.add,
+    "update": Client.update,
+    "delete": Client.delete,
+    "delete_user": Client.delete_user,
+}
+
+
+def run_client(app, client_id, owned, mix, nbr_requests, seed_value, results, start_barrier):
+    """ Run one client and store its ({name: [seconds]}, {name: errors}) in results[client_id] """
+
+    samples = {name: [] for name in OPERATIONS}
+    errors = {name: 0 for name in OPERATIONS}
+    results[client_id] = (samples, errors)
+
+    rng = random.Random(seed_value * 1000 + client_id)
+    client = Client(app, client_id, owned, rng)
+    names = [name for (name, weight) in mix]
+    weights = [weight for (name, weight) in mix]
+
+    start_barrier.wait()
+
+    for _ in range(nbr_requests):
+        name = rng.choices(names, weights)[0]
+
+        start = time.perf_counter()
+        response = OPERATIONS[name](client)
+        elapsed = time.perf_counter() - start
+
+        samples[name].append(elapsed)
+        if (response.status_code >= 400):
+            errors[name] += 1
+
+        client.record_added()
+
+
+def run(args):
+    database = args.database or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+
+    config = {
+        "SQLALCHEMY_DATABASE_URI": database,
+        "WTF_CSRF_ENABLED": False,
+        "BCRYPT_LOG_ROUNDS": args.rounds,
+        "SECRET_KEY": "benchmark",
+        # every client shares 127.0.0.1, which the per IP login bucket would soon refuse
+        "LOGIN_THROTTLE_ENABLED": args.throttle,
+    }
+    if database.startswith("sqlite"):
+        # concurrent writers wait for the lock instead of failing
+        config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"timeout": 30}}
+
+    app = create_app(config)
+
+    mix = parse_mix(args.mix)
+    owned = seed(app, args.users, args.feedback_per_user, reset=args.reset)
+
+    results = [None] * args.clients
+    start_barrier = threading.Barrier(args.clients + 1)
+
+    threads = [threading.Thread(target=run_client,
+                                args=(app, client_id, owned, mix, args.requests, args.seed,
+                                      results, start_barrier))
+               for client_id in range(args.clients)]
+    for thread in threads:
+        thread.start()
+
+    start_barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - start
+
+    # each client kept its own counters; merge them now that every thread is done
+    samples = {name: [] for name in OPERATIONS}
+    errors = {name: 0 for name in OPERATIONS}
+    for (client_samples, client_errors) in results:
+        for name in OPERATIONS:
+            samples[name].extend(client_samples[name])
+            errors[name] += client_errors[name]
+
+    routes = {}
+    for (name, durations) in samples.items():
+        if not durations:
+            continue
+        durations.sort()
+        routes[name] = {
+            "count": len(durations),
+            "errors": errors[name],
+            "throughput": round(len(durations) / wall_seconds, 2),
+            "mean_ms": round(sum(durations) / len(durations) * 1000, 3),
+            "p50_ms": round(percentile(durations, 50) * 1000, 3),
+            "p95_ms": round(percentile(durations, 95) * 1000, 3),
+            "p99_ms": round(percentile(durations, 99) * 1000, 3),
+        }
+
+    total = sum(route["count"] for route in routes.values())
+
+    return {
+        "revision": git_revision(),
+        "config": {
+            "database": database.split(":")[0],
+            "users": args.users,
+            "feedback_per_user": args.feedback_per_user,
+            "clients": args.clients,
+            "requests_per_client": args.requests,
+            "mix": args.mix,
+            "rounds": args.rounds,
+            "seed": args.seed,
+            "throttle": args.throttle,
+        },
+        "total": {
+            "requests": total,
+            "seconds": round(wall_seconds, 3),
+            "throughput": round(total / wall_seconds, 2),
+        },
+        "routes": routes,
+    }
+
+
+def compare(old_path, new_path):
+    """ Print p50 / p95 / throughput changes per route between two reports. """
+
+    with open(old_path) as old_file, open(new_path) as new_file:
+        (old, new) = (json.load(old_file), json.load(new_file))
+
+    print(f"{'route':<12} {'p50 ms':>20} {'p95 ms':>20} {'req/s':>20}")
+    for name in sorted(set(old["routes"]) | set(new["routes"])):
+        (before, after) = (old["routes"].get(name), new["routes"].get(name))
+        if not (before and after):
+            print(f"{name:<12} only in {'new' if after else 'old'} report")
+            continue
+        cells = [f"{before[key]:.2f} -> {after[key]:.2f}" for key in ("p50_ms", "p95_ms", "throughput")]
+        print(f"{name:<12} {cells[0]:>20} {cells[1]:>20} {cells[2]:>20}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flask Feedback load and latency benchmark")
+    parser.add_argument("--database", help="database URI. Default: a new SQLite file in a temp directory")
+    parser.add_argument("--reset", action="store_true",
+                        help="allow seeding to drop the tables of a --database that already has some")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--feedback-per-user", type=int, default=20)
+    parser.add_argument("--clients", type=int, default=4, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="requests per client")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights. Default: {DEFAULT_MIX}")
+    parser.add_argument("--rounds", type=int, default=4, help="bcrypt cost for the run")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--throttle", action="store_true", help="leave login throttling on")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two reports and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = json.dumps(run(args), indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
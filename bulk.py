@@ -0,0 +1,359 @@
+""" Bulk import and export of users and feedback for the flask CLI.
+
+    Files are CSV (header row) or JSONL (one object per line). Imports work in batches: each
+    batch is validated, checked for username / email conflicts with one query per column,
+    has its passwords hashed across a process pool and is written in one transaction with
+    PostgreSQL COPY when available (executemany otherwise). Problems are reported per row and
+    never stop the run.
+
+    Exports stream rows with a server side cursor so memory use does not depend on table size.
+    With sharding (sharding.py) they read one shard after the other; imports need an unsharded
+    database.
+"""
+
+import csv
+import io
+import json
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from hashing import hash_passwords, get_rounds
+from models import db, User, Feedback, clean_feedback_fields, count_feedback, feedback_changed
+from models import index_unindexed_feedback
+from sharding import shard_router
+
+USER_IMPORT_COLUMNS = ["username", "password", "email", "first_name", "last_name"]
+USER_EXPORT_COLUMNS = ["username", "password_hash", "email", "first_name", "last_name"]
+FEEDBACK_COLUMNS = ["id", "title", "content", "username"]
+
+# (min, max) lengths, the same limits RegistrationForm applies.
+USER_FIELD_LENGTHS = {
+    "username": (4, 20),
+    "email": (1, 50),
+    "first_name": (1, 30),
+    "last_name": (1, 30)
+}
+PASSWORD_MIN_LENGTH = 6
+
+
+def detect_format(stream, fmt=None):
+    """ fmt when given, otherwise jsonl for .jsonl / .ndjson files and csv for everything else
+        (including stdin / stdout).
+    """
+
+    if fmt:
+        return fmt
+
+    path = getattr(stream, "name", "")
+    return "jsonl" if str(path).endswith((".jsonl", ".ndjson")) else "csv"
+
+
+def read_rows(stream, fmt):
+    """ Yield (row_number, row, error) for each record in stream. row is a dict, or None when
+        the record could not be parsed or is not an object and error says why.
+    """
+
+    if (fmt == "csv"):
+        for (row_number, row) in enumerate(csv.DictReader(stream), start=1):
+            yield (row_number, row, None)
+        return
+
+    for (row_number, line) in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as err:
+            yield (row_number, None, f"invalid JSON: {err}")
+            continue
+
+        if isinstance(row, dict):
+            yield (row_number, row, None)
+        else:
+            yield (row_number, None, "not a JSON object")
+
+
+def batched(iterable, size):
+    """ Yield lists of up to size items from iterable. """
+
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if (len(batch) >= size):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def clean_user_row(row):
+    """ Return (user_data, error). user_data has stripped values, a lowercase email and either
+        a plain "password" to hash or an existing bcrypt "password_hash".
+    """
+
+    # JSONL values can be numbers, lists, ...
+    for field in list(USER_FIELD_LENGTHS) + ["password", "password_hash"]:
+        if not isinstance(row.get(field) or "", str):
+            return (None, f"{field} must be a string")
+
+    user_data = {}
+    for (field, (min_len, max_len)) in USER_FIELD_LENGTHS.items():
+        value = (row.get(field) or "").strip()
+        if not (min_len <= len(value) <= max_len):
+            return (None, f"{field} must be {min_len} to {max_len} characters in length")
+        user_data[field] = value
+
+    user_data["email"] = user_data["email"].lower()
+
+    password_hash = (row.get("password_hash") or "").strip()
+    password = row.get("password") or ""
+
+    if password_hash:
+        if get_rounds(password_hash) is None:
+            return (None, "password_hash is not a bcrypt hash")
+        user_data["password_hash"] = password_hash
+
+    elif (len(password) >= PASSWORD_MIN_LENGTH):
+        user_data["password"] = password
+
+    else:
+        return (None, f"password must be at least {PASSWORD_MIN_LENGTH} characters in length")
+
+    return (user_data, None)
+
+
+def insert_rows(table, columns, records):
+    """ Insert records (dicts keyed by columns) into table inside the current transaction.
+        PostgreSQL gets a single COPY, other databases an executemany INSERT.
+    """
+
+    connection = db.session.connection()
+
+    if (connection.dialect.name == "postgresql"):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for record in records:
+            writer.writerow([record[column] for column in columns])
+        buffer.seek(0)
+
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+        cursor.close()
+
+    else:
+        connection.execute(table.insert(), [{column: record[column] for column in columns}
+                                            for record in records])
+
+
+def insert_batch(table, columns, records, report):
+    """ Insert a batch in one statement. When a row conflicts (a concurrent signup between the
+        conflict check and the insert) fall back to row by row inserts inside savepoints so
+        only the conflicting rows are rejected through report(row_number, message). Returns the
+        records that were inserted.
+    """
+
+    if not records:
+        return []
+
+    # COPY runs on the raw DBAPI cursor, so its conflicts are the driver's IntegrityError
+    integrity_errors = (IntegrityError, db.session.connection().dialect.dbapi.IntegrityError)
+
+    try:
+        with db.session.begin_nested():
+            insert_rows(table, columns, records)
+        return records
+
+    except integrity_errors:
+        inserted = []
+        for record in records:
+            try:
+                with db.session.begin_nested():
+                    insert_rows(table, columns, [record])
+                inserted.append(record)
+            except integrity_errors:
+                report(record["_row"], "conflicts with an existing username or email")
+        return inserted
+
+
+def import_users(rows, report, batch_size=500, workers=None):
+    """ Create users from rows (see read_rows). report(row_number, message) is called for every
+        rejected row. Returns {"created": n, "failed": n}.
+    """
+
+    rounds = current_app.config["BCRYPT_LOG_ROUNDS"]
+    columns = USER_IMPORT_COLUMNS
+    seen_usernames = set()
+    seen_emails = set()
+    summary = {"created": 0, "failed": 0}
+
+    def reject(row_number, message):
+        summary["failed"] += 1
+        report(row_number, message)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for batch in batched(rows, batch_size):
+
+            candidates = []
+            for (row_number, row, error) in batch:
+                if row is not None:
+                    (user_data, error) = clean_user_row(row)
+
+                if error:
+                    reject(row_number, error)
+                elif (user_data["username"] in seen_usernames):
+                    reject(row_number, f"username '{user_data['username']}' appears earlier in the file")
+                elif (user_data["email"] in seen_emails):
+                    reject(row_number, f"email '{user_data['email']}' appears earlier in the file")
+                else:
+                    seen_usernames.add(user_data["username"])
+                    seen_emails.add(user_data["email"])
+                    user_data["_row"] = row_number
+                    candidates.append(user_data)
+
+            if not candidates:
+                continue
+
+            # one existence query per unique column for the whole batch
+            taken_usernames = {username for (username,) in db.session.query(User.username).filter(
+                User.username.in_([c["username"] for c in candidates]))}
+            taken_emails = {email for (email,) in db.session.query(User.email).filter(
+                User.email.in_([c["email"] for c in candidates]))}
+
+            records = []
+            for candidate in candidates:
+                if (candidate["username"] in taken_usernames):
+                    reject(candidate["_row"], f"username '{candidate['username']}' already exists")
+                elif (candidate["email"] in taken_emails):
+                    reject(candidate["_row"], f"email '{candidate['email']}' already exists")
+                else:
+                    records.append(candidate)
+
+            to_hash = [record for record in records if "password_hash" not in record]
+            hashes = hash_passwords([record["password"] for record in to_hash], rounds, executor)
+            for (record, hashed) in zip(to_hash, hashes):
+                record["password_hash"] = hashed
+            for record in records:
+                record["password"] = record["password_hash"]
+
+            inserted = insert_batch(User.__table__, columns, records, reject)
+            db.session.commit()
+
+            summary["created"] += len(inserted)
+
+    return summary
+
+
+def import_feedback(rows, report, batch_size=1000):
+    """ Create feedback from rows with title, content and username. Rows for unknown users or
+        with blank title / content are rejected through report(row_number, message).
+        Returns {"created": n, "failed": n}.
+    """
+
+    columns = ["title", "content", "username"]
+    summary = {"created": 0, "failed": 0}
+
+    def reject(row_number, message):
+        summary["failed"] += 1
+        report(row_number, message)
+
+    for batch in batched(rows, batch_size):
+
+        candidates = []
+        for (row_number, row, error) in batch:
+            if row is not None:
+                (feedback_data, errors) = clean_feedback_fields(
+                    {column: row.get(column) for column in columns})
+                error = "; ".join(msg for (field, msg) in errors)
+
+            if error:
+                reject(row_number, error)
+            else:
+                feedback_data["_row"] = row_number
+                candidates.append(feedback_data)
+
+        if not candidates:
+            continue
+
+        known_users = {username for (username,) in db.session.query(User.username).filter(
+            User.username.in_({c["username"] for c in candidates}))}
+
+        records = []
+        for candidate in candidates:
+            if (candidate["username"] in known_users):
+                records.append(candidate)
+            else:
+                reject(candidate["_row"], f"username '{candidate['username']}' does not exist")
+
+        inserted = insert_batch(Feedback.__table__, columns, records, reject)
+        # COPY cannot compute the search vectors, so fill them in before the batch commits
+        index_unindexed_feedback({record["username"] for record in inserted})
+        for (username, nbr_inserted) in Counter(record["username"] for record in inserted).items():
+            count_feedback(username, nbr_inserted)
+        db.session.commit()
+
+        for username in {record["username"] for record in inserted}:
+            feedback_changed(username)
+
+        summary["created"] += len(inserted)
+
+    return summary
+
+
+def write_rows(stream, fmt, columns, rows):
+    """ Write rows (tuples in columns order) to stream as CSV or JSONL. Returns the row count. """
+
+    count = 0
+
+    if (fmt == "csv"):
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+
+    else:
+        for row in rows:
+            stream.write(json.dumps(dict(zip(columns, row))) + "\n")
+            count += 1
+
+    return count
+
+
+def each_shard_rows(query):
+    """ The rows of query on every shard, one shard after the other """
+
+    for shard in shard_router.each_shard():
+        yield from query
+
+
+def export_users(stream, fmt, batch_size=1000):
+    """ Stream every user to stream. Passwords are exported as their bcrypt hash so the file can
+        be imported elsewhere without resetting passwords.
+    """
+
+    query = db.session.query(User.username, User.password, User.email, User.first_name,
+                             User.last_name).order_by(User.username)
+    query = query.execution_options(stream_results=True).yield_per(batch_size)
+
+    return write_rows(stream, fmt, USER_EXPORT_COLUMNS, each_shard_rows(query))
+
+
+def export_feedback(stream, fmt, username=None, batch_size=1000):
+    """ Stream feedback, optionally for one username, to stream. """
+
+    query = db.session.query(Feedback.id, Feedback.title, Feedback.content, Feedback.username)
+    if username:
+        query = query.filter(Feedback.username == username)
+
+    query = query.order_by(Feedback.id).execution_options(stream_results=True).yield_per(batch_size)
+
+    if username:
+        shard_router.use_shard(username)
+        return write_rows(stream, fmt, FEEDBACK_COLUMNS, query)
+
+    return write_rows(stream, fmt, FEEDBACK_COLUMNS, each_shard_rows(query))
@@ -0,0 +1,171 @@
+""" Change feed of feedback mutations for the flask CLI.
+
+    The feedback helpers in models.py append a FeedbackEvent to the feedback_events outbox in
+    the same transaction as every create, update and delete (user deletion included), so the
+    outbox holds exactly the committed changes, in id order. Bulk imports do not emit events;
+    seed a consumer with `flask export-feedback` instead.
+
+    Each named consumer has a cursor in feedback_event_cursors. consume() reads the events past
+    the cursor in batches, writes them as JSONL and, once the batch is flushed, moves the
+    cursor - that is the acknowledgement. A crash between the write and the cursor update
+    replays the batch, so delivery is at least once and consumers dedupe on the event id.
+    Events every consumer has acknowledged are pruned.
+
+    Ids are handed out before commit, so on a database with concurrent writers a slow
+    transaction can commit an id below one that is already visible. Events are therefore read
+    in the order they became visible:
+
+      - PostgreSQL: every event records its transaction (txid). Only events of transactions
+        older than every transaction still running (txid_snapshot_xmin) are read, ordered by
+        (txid, id), and the cursor holds both. Nothing can commit behind it.
+      - SQLite: one writer at a time, so ids commit in order and the cursor is the id.
+      - other databases: events younger than FEEDBACK_EVENTS_SETTLE_SECONDS are left for the next
+        batch. That is a hard bound on the length of a write transaction; enforce it on the
+        database (statement / transaction timeouts) or late commits are skipped.
+
+    Pruning only removes events that every consumer acknowledged and that are older than
+    FEEDBACK_EVENTS_RETENTION_HOURS, so a consumer registered after a prune still finds the
+    recent history; seed it with `flask export-feedback` for anything older.
+
+    With sharding (sharding.py) every shard has its own outbox and event ids, so a consumer
+    has a cursor per shard, events carry their "shard" and ordering holds within a shard.
+"""
+
+import json
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func, tuple_
+
+from models import db, FeedbackEvent, FeedbackEventCursor
+from sharding import shard_router
+
+
+def visibility_order():
+    """ How events become visible on the current shard's database: "txid", "id" or "settle" """
+
+    dialect_name = db.session.get_bind(mapper=FeedbackEvent.__mapper__).dialect.name
+
+    return {"postgresql": "txid", "sqlite": "id"}.get(dialect_name, "settle")
+
+
+def get_cursor(consumer, shard=0):
+    """ (last txid, last event id) consumer acknowledged on shard, (0, 0) for a new consumer. """
+
+    cursor = FeedbackEventCursor.query.get((consumer, shard))
+
+    return (cursor.last_txid, cursor.last_event_id) if cursor else (0, 0)
+
+
+def event_position(feedback_event):
+    """ Cursor position just past feedback_event """
+
+    return (feedback_event.txid or 0, feedback_event.id)
+
+
+def read_events(position, limit):
+    """ Up to limit events past position (see get_cursor) whose transaction can no longer be
+        overtaken by another commit, in visibility order.
+    """
+
+    order = visibility_order()
+    (last_txid, last_event_id) = position
+
+    if (order == "txid"):
+        # every transaction below xmin has finished, so no event can still appear below it
+        return FeedbackEvent.query.filter(
+            FeedbackEvent.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()),
+            tuple_(FeedbackEvent.txid, FeedbackEvent.id) > tuple_(last_txid, last_event_id)).order_by(
+            FeedbackEvent.txid, FeedbackEvent.id).limit(limit).all()
+
+    query = FeedbackEvent.query.filter(FeedbackEvent.id > last_event_id)
+
+    if (order == "settle"):
+        settled = datetime.utcnow() - timedelta(seconds=current_app.config["FEEDBACK_EVENTS_SETTLE_SECONDS"])
+        query = query.filter(FeedbackEvent.created_at <= settled)
+
+    return query.order_by(FeedbackEvent.id).limit(limit).all()
+
+
+def acknowledge(consumer, position, shard=0):
+    """ Move consumer's cursor on shard to position. """
+
+    (last_txid, last_event_id) = position
+
+    cursor = FeedbackEventCursor.query.get((consumer, shard))
+    if cursor is None:
+        db.session.add(FeedbackEventCursor(consumer=consumer, shard=shard, last_txid=last_txid,
+                                           last_event_id=last_event_id))
+    else:
+        cursor.last_txid = last_txid
+        cursor.last_event_id = last_event_id
+
+    db.session.commit()
+
+
+def prune(shard=0):
+    """ Delete the events on shard that every consumer has acknowledged and that are older than
+        FEEDBACK_EVENTS_RETENTION_HOURS. Returns the number deleted.
+    """
+
+    low_water = FeedbackEventCursor.query.filter(FeedbackEventCursor.shard == shard).order_by(
+        FeedbackEventCursor.last_txid, FeedbackEventCursor.last_event_id).first()
+    if low_water is None:
+        return 0
+
+    if (visibility_order() == "txid"):
+        acknowledged = (tuple_(FeedbackEvent.txid, FeedbackEvent.id) <=
+                        tuple_(low_water.last_txid, low_water.last_event_id))
+    else:
+        acknowledged = FeedbackEvent.id <= low_water.last_event_id
+
+    retained = datetime.utcnow() - timedelta(hours=current_app.config["FEEDBACK_EVENTS_RETENTION_HOURS"])
+
+    nbr_deleted = FeedbackEvent.query.filter(acknowledged, FeedbackEvent.created_at < retained).delete(
+        synchronize_session=False)
+    db.session.commit()
+
+    return nbr_deleted
+
+
+def consume(consumer, stream, batch_size=500, prune_acknowledged=True):
+    """ Write consumer's unread events to stream as JSONL, batch_size per read, until caught up.
+        Returns {"events": n, "batches": n, "pruned": n, "cursor": last event id}; with sharding
+        "cursor" lists the last event id of every shard.
+    """
+
+    summary = {"events": 0, "batches": 0, "pruned": 0, "cursor": []}
+
+    for shard in shard_router.each_shard():
+        position = get_cursor(consumer, shard)
+
+        while True:
+            events = read_events(position, batch_size)
+            if not events:
+                break
+
+            for feedback_event in events:
+                record = feedback_event.serialize()
+                if shard_router.enabled:
+                    record["shard"] = shard
+                stream.write(json.dumps(record, sort_keys=True) + "\n")
+            stream.flush()
+
+            position = event_position(events[-1])
+            acknowledge(consumer, position, shard)
+
+            summary["events"] += len(events)
+            summary["batches"] += 1
+
+            # the events were only read; keep the identity map from growing across batches
+            db.session.expunge_all()
+
+        if prune_acknowledged:
+            summary["pruned"] += prune(shard)
+
+        summary["cursor"].append(position[1])
+
+    if not shard_router.enabled:
+        summary["cursor"] = summary["cursor"][0]
+
+    return summary
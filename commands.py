@@ -0,0 +1,327 @@
+""" flask CLI commands for the Flask Feedback app. """
+
+import json
+import time
+
+import click
+
+from assets import build_assets
+from hashing import calibrate_rounds
+from jobs import job_queue
+from models import db, User, enqueue_job, archive_feedback, purge_user, reconcile_feedback_counts
+from models import create_shard_tables, init_feedback_id_block, move_users, rebalance_shards, rebuild_user_directory
+from routing import replica_router
+from sharding import shard_router
+import bulk
+import changefeed
+
+
+def register_commands(app):
+    """ Attach the Flask Feedback CLI commands to app. """
+
+    @app.cli.command("calibrate-bcrypt")
+    @click.option("--target-ms", default=None, type=float,
+                  help="Target median hash time in milliseconds. Defaults to BCRYPT_TARGET_MS.")
+    @click.option("--samples", default=5, help="Hashes timed per cost.")
+    def calibrate_bcrypt(target_ms, samples):
+        """ Measure bcrypt on this machine and suggest BCRYPT_LOG_ROUNDS. """
+
+        if (target_ms is None):
+            target_ms = app.config["BCRYPT_TARGET_MS"]
+
+        results = calibrate_rounds(target_ms, samples)
+
+        click.echo(json.dumps(results, indent=2))
+        click.echo(f"BCRYPT_LOG_ROUNDS = {results['rounds']}")
+
+    def echo_rejected(row_number, message):
+        click.echo(f"row {row_number}: {message}", err=True)
+
+    def refuse_sharded_import():
+        if shard_router.enabled:
+            raise click.ClickException(
+                "Imports need an unsharded database. Import first, then shard it with init-shards and rebalance-shards.")
+
+    @app.cli.command("import-users")
+    @click.argument("source", type=click.File("r"))
+    @click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None,
+                  help="File format. Defaults to the file extension.")
+    @click.option("--batch-size", default=500, help="Rows per transaction.")
+    @click.option("--workers", default=None, type=int, help="Hashing processes. Defaults to the cpu count.")
+    def import_users(source, fmt, batch_size, workers):
+        """ Create users from a CSV / JSONL file with username, password (or password_hash),
+            email, first_name and last_name. Rejected rows are listed on stderr.
+        """
+
+        refuse_sharded_import()
+        fmt = bulk.detect_format(source, fmt)
+        summary = bulk.import_users(bulk.read_rows(source, fmt), echo_rejected,
+                                    batch_size=batch_size, workers=workers)
+
+        click.echo(f"{summary['created']} users created, {summary['failed']} rows rejected.")
+
+    @app.cli.command("import-feedback")
+    @click.argument("source", type=click.File("r"))
+    @click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None,
+                  help="File format. Defaults to the file extension.")
+    @click.option("--batch-size", default=1000, help="Rows per transaction.")
+    def import_feedback(source, fmt, batch_size):
+        """ Create feedback from a CSV / JSONL file with title, content and username. """
+
+        refuse_sharded_import()
+        fmt = bulk.detect_format(source, fmt)
+        summary = bulk.import_feedback(bulk.read_rows(source, fmt), echo_rejected,
+                                       batch_size=batch_size)
+
+        click.echo(f"{summary['created']} feedback created, {summary['failed']} rows rejected.")
+
+    @app.cli.command("export-users")
+    @click.argument("destination", type=click.File("w"))
+    @click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None,
+                  help="File format. Defaults to the file extension.")
+    @click.option("--batch-size", default=1000, help="Rows fetched per round trip.")
+    def export_users(destination, fmt, batch_size):
+        """ Write every user, with the password hash, to a CSV / JSONL file ('-' for stdout). """
+
+        count = bulk.export_users(destination, bulk.detect_format(destination, fmt), batch_size)
+
+        click.echo(f"{count} users exported.", err=True)
+
+    @app.cli.command("export-feedback")
+    @click.argument("destination", type=click.File("w"))
+    @click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None,
+                  help="File format. Defaults to the file extension.")
+    @click.option("--username", default=None, help="Only export this user's feedback.")
+    @click.option("--batch-size", default=1000, help="Rows fetched per round trip.")
+    def export_feedback(destination, fmt, username, batch_size):
+        """ Write feedback to a CSV / JSONL file ('-' for stdout). """
+
+        count = bulk.export_feedback(destination, bulk.detect_format(destination, fmt),
+                                     username=username, batch_size=batch_size)
+
+        click.echo(f"{count} feedback exported.", err=True)
+
+    @app.cli.command("purge-disabled-users")
+    def purge_disabled_users():
+        """ Finish deleting users that were disabled for a background purge, for example after
+            the worker that was purging them restarted. Prints progress per chunk.
+        """
+
+        usernames = []
+        for shard in shard_router.each_shard():
+            usernames.extend(user.username for user in User.query.filter_by(disabled=True))
+
+        for username in usernames:
+            status = purge_user(app, username,
+                                progress=lambda s: click.echo(
+                                    f"{s['username']}: chunk {s['chunks']}, {s['deleted']} deleted"))
+            click.echo(f"{username}: {status['state']}, {status['deleted']} feedback deleted.")
+
+        click.echo(f"{len(usernames)} disabled users processed.")
+
+    @app.cli.command("purge-status")
+    def purge_status():
+        """ List the users waiting to be purged with the feedback they have left. Purges commit
+            per chunk, so this follows a purge running in any process.
+        """
+
+        disabled = []
+        for shard in shard_router.each_shard():
+            disabled.extend(db.session.query(User.username, User.feedback_count).filter_by(disabled=True))
+
+        for (username, feedback_count) in sorted(disabled):
+            click.echo(f"{username}: {feedback_count} feedback left")
+
+        click.echo(f"{len(disabled)} users waiting to be purged.")
+
+    @app.cli.command("reconcile-feedback-counts")
+    @click.option("--batch-size", default=1000, help="Users recounted per transaction.")
+    def reconcile_counts(batch_size):
+        """ Recount every user's feedback and repair feedback_count values that drifted. """
+
+        def echo_fixed(username, stored, actual):
+            click.echo(f"{username}: feedback_count {stored} -> {actual}")
+
+        fixed = reconcile_feedback_counts(batch_size=batch_size, report=echo_fixed)
+
+        click.echo(f"{fixed} feedback counts repaired.")
+
+    @app.cli.command("archive-feedback")
+    @click.option("--older-than-days", default=None, type=int,
+                  help="Archive feedback created more than this many days ago. Default: FEEDBACK_ARCHIVE_AFTER_DAYS.")
+    @click.option("--batch-size", default=None, type=int,
+                  help="Rows moved per transaction. Default: FEEDBACK_ARCHIVE_BATCH_SIZE.")
+    def archive_old_feedback(older_than_days, batch_size):
+        """ Move old feedback from the feedback table to feedback_archive in batches. Safe to run
+            from cron; an interrupted run just leaves the rest for the next one.
+        """
+
+        if older_than_days is None:
+            older_than_days = app.config["FEEDBACK_ARCHIVE_AFTER_DAYS"]
+
+        moved = archive_feedback(older_than_days, batch_size=batch_size or app.config["FEEDBACK_ARCHIVE_BATCH_SIZE"],
+                                 report=lambda moved: click.echo(f"{moved} moved", err=True))
+
+        click.echo(f"{moved} pieces of feedback older than {older_than_days} days archived.")
+
+    @app.cli.command("consume-feedback-events")
+    @click.argument("consumer")
+    @click.option("--output", type=click.File("a"), default="-",
+                  help="JSONL file the events are appended to. Default: stdout.")
+    @click.option("--batch-size", default=500, help="Events read and acknowledged at a time.")
+    @click.option("--follow", is_flag=True, help="Keep polling for new events.")
+    @click.option("--interval", default=2.0, help="Seconds between polls with --follow.")
+    @click.option("--prune/--no-prune", default=True, help="Delete events every consumer has acknowledged.")
+    def consume_feedback_events(consumer, output, batch_size, follow, interval, prune):
+        """ Stream the feedback change events CONSUMER has not acknowledged yet as JSONL, from
+            where it left off.
+        """
+
+        while True:
+            summary = changefeed.consume(consumer, output, batch_size=batch_size, prune_acknowledged=prune)
+
+            if (summary["events"] or not follow):
+                click.echo(f"{consumer}: {summary['events']} events in {summary['batches']} batches, "
+                           f"cursor at {summary['cursor']}, {summary['pruned']} pruned.", err=True)
+
+            if not follow:
+                return
+
+            time.sleep(interval)
+
+    @app.cli.command("build-assets")
+    def build_static_assets():
+        """ Copy static/ to static/dist/ under content hashed names, precompress the text files
+            and write the manifest asset_url() reads. Restart the app afterwards.
+        """
+
+        manifest = build_assets(app.static_folder)
+
+        for (name, hashed_name) in sorted(manifest["files"].items()):
+            encodings = ", ".join(manifest["encodings"].get(hashed_name, [])) or "-"
+            click.echo(f"{name} -> {hashed_name} ({encodings})")
+
+        click.echo(f"{len(manifest['files'])} assets built.")
+
+    @app.cli.command("copy-to-replicas")
+    def copy_to_replicas():
+        """ Overwrite each SQLite replica in DB_REPLICA_URIS with a copy of the SQLite primary, to
+            try read / write splitting locally. Real replicas are kept up to date by the database.
+        """
+
+        engines = replica_router.replica_engines(db)
+        if not engines:
+            raise click.ClickException("DB_REPLICA_URIS is not set.")
+
+        if any(engine.dialect.name != "sqlite" for engine in [db.engine] + engines):
+            raise click.ClickException("copy-to-replicas only copies SQLite databases; use the database's replication.")
+
+        source = db.engine.raw_connection()
+        try:
+            for engine in engines:
+                target = engine.raw_connection()
+                try:
+                    source.connection.backup(target.connection)
+                finally:
+                    target.close()
+
+                click.echo(f"{db.engine.url.database} -> {engine.url.database}")
+        finally:
+            source.close()
+
+    @app.cli.command("init-shards")
+    def init_shards():
+        """ Create the sharded tables on every shard in DB_SHARD_URIS, record their users in the
+            user directory and start the feedback id allocator. Safe to run again after adding
+            shards.
+        """
+
+        if not shard_router.enabled:
+            raise click.ClickException("DB_SHARD_URIS is not set.")
+
+        db.create_all()
+        create_shard_tables()
+        added = rebuild_user_directory()
+        next_id = init_feedback_id_block()
+
+        click.echo(f"{shard_router.nbr_shards} shards ready, {added} users added to the directory, "
+                   f"next feedback id {next_id}.")
+
+    def echo_moved(username, source, target):
+        click.echo(f"{username}: shard {source} -> {target}")
+
+    @app.cli.command("move-user")
+    @click.argument("username")
+    @click.argument("shard", type=int)
+    def move_user(username, shard):
+        """ Move USERNAME and their feedback to shard SHARD (an index into DB_SHARD_URIS) while the
+            app keeps running. Their writes are refused for the length of the copy.
+        """
+
+        if not (0 <= shard < shard_router.nbr_shards):
+            raise click.ClickException(f"SHARD must be between 0 and {shard_router.nbr_shards - 1}.")
+
+        moved = move_users([(username, shard)], report=echo_moved)
+
+        click.echo(f"{moved} users moved.")
+
+    @app.cli.command("rebalance-shards")
+    @click.option("--batch-size", default=100, help="Users moved together.")
+    def rebalance(batch_size):
+        """ Move every user that is not on the shard its username hashes to, after shards were
+            added to DB_SHARD_URIS.
+        """
+
+        if not shard_router.enabled:
+            raise click.ClickException("DB_SHARD_URIS is not set.")
+
+        moved = rebalance_shards(batch_size=batch_size, report=echo_moved)
+
+        click.echo(f"{moved} users moved.")
+
+    @app.cli.command("run-jobs")
+    @click.option("--threads", default=None, type=int,
+                  help="Jobs run at the same time. Default: JOB_WORKER_THREADS.")
+    @click.option("--once", is_flag=True, help="Stop when no job is due instead of polling.")
+    def run_jobs(threads, once):
+        """ Work through the jobs table (jobs.py) until interrupted. Start as many of these
+            processes as needed; they share the queue.
+        """
+
+        def echo_job(job_id, name, succeeded):
+            click.echo(f"job {job_id} ({name}): {'done' if succeeded else 'failed'}", err=True)
+
+        job_queue.run_workers(app, threads or app.config["JOB_WORKER_THREADS"], once=once, report=echo_job)
+
+    @app.cli.command("enqueue-job")
+    @click.argument("name", type=click.Choice(sorted(job_queue.handlers)))
+    @click.option("--payload", default="{}", help="JSON object of handler arguments.")
+    @click.option("--delay", default=0, help="Seconds before the job may run.")
+    def enqueue(name, payload, delay):
+        """ Queue a NAME job for the `flask run-jobs` workers. """
+
+        try:
+            payload = json.loads(payload)
+        except ValueError as err:
+            raise click.ClickException(f"--payload is not valid JSON: {err}")
+
+        job = enqueue_job(name, payload, delay=delay)
+        db.session.commit()
+
+        click.echo(f"job {job.id} ({name}) queued.")
+
+    @app.cli.command("job-status")
+    @click.argument("job_id", type=int, required=False)
+    def job_status(job_id):
+        """ Show job JOB_ID, or the number of jobs per name and state. """
+
+        if (job_id is not None):
+            status = job_queue.status(job_id)
+            if status is None:
+                raise click.ClickException(f"There is no job {job_id}.")
+
+            click.echo(json.dumps(status, indent=2))
+            return
+
+        for ((name, state), count) in sorted(job_queue.counts().items()):
+            click.echo(f"{name:30} {state:8} {count}")
@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, TextAreaField
+from wtforms import StringField, PasswordField, TextAreaField, HiddenField
 from wtforms.validators import InputRequired, Email, Length, Regexp
 
 
@@ -38,3 +38,5 @@ class FeedbackForm(FlaskForm):
 
     title = StringField("Title", validators=[InputRequired()])
     content = TextAreaField("Feedback", validators=[InputRequired()])
+    # version the update form was loaded with; a save over a newer version is refused
+    version = HiddenField()
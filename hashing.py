@@ -0,0 +1,287 @@
+""" Password hashing service for the Flask Feedback app.
+
+    bcrypt is deliberately slow, so hashing and verifying passwords inline in a request
+    handler holds a worker for tens of milliseconds of CPU. PasswordHasher runs the bcrypt
+    calls in a bounded process pool instead:
+
+        HASHING_POOL_SIZE   number of worker processes. 0 runs bcrypt inline (tests, dev).
+        HASHING_MAX_QUEUE   number of calls allowed to wait for a free worker. Calls beyond
+                            pool size + queue depth are refused with HashingBusyError.
+        HASHING_TIMEOUT     seconds a caller waits for a result before HashingBusyError.
+        BCRYPT_LOG_ROUNDS   bcrypt cost (work factor) for new hashes.
+
+    calibrate_rounds() measures hash time on this machine and picks the cost that fits
+    BCRYPT_TARGET_MS. Set BCRYPT_CALIBRATE_ON_STARTUP to run it when the app starts, or run
+    `flask calibrate-bcrypt` and copy the result into BCRYPT_LOG_ROUNDS.
+"""
+
+import asyncio
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt as _bcrypt
+
+
+class HashingBusyError(Exception):
+    """ Raised when the hashing pool is saturated or a hash did not finish in time. """
+
+
+# worker functions - module level so the process pool can pickle them.
+
+def _hash_password(pwd, rounds):
+    """ bcrypt hash pwd with rounds and return the hash as a utf8 string """
+
+    return _bcrypt.hashpw(pwd.encode("utf8"), _bcrypt.gensalt(rounds)).decode("utf8")
+
+
+def _check_password(hashed, pwd):
+    """ Return True when pwd matches the bcrypt hash hashed """
+
+    try:
+        return _bcrypt.checkpw(pwd.encode("utf8"), hashed.encode("utf8"))
+    except ValueError:
+        # malformed hash in the database
+        return False
+
+
+def get_rounds(hashed):
+    """ Return the cost of a bcrypt hash ($2b$12$... -> 12), or None when hashed is not a
+        bcrypt hash.
+    """
+
+    parts = hashed.split("$")
+    if (len(parts) < 4):
+        return None
+
+    try:
+        return int(parts[2])
+    except ValueError:
+        return None
+
+
+def calibrate_rounds(target_ms=80, samples=5, min_rounds=4, max_rounds=16):
+    """ Measure bcrypt on this machine and return the highest cost whose median hash time
+        is at or under target_ms (min_rounds when even that is too slow).
+
+        Returns {"rounds": n, "timings": {rounds: median_ms, ...}}
+    """
+
+    timings = {}
+    chosen = min_rounds
+
+    for rounds in range(min_rounds, max_rounds + 1):
+        durations = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            _hash_password("calibration-password", rounds)
+            durations.append((time.perf_counter() - start) * 1000)
+
+        median_ms = statistics.median(durations)
+        timings[rounds] = round(median_ms, 2)
+
+        if (median_ms > target_ms):
+            break
+
+        chosen = rounds
+
+    return {"rounds": chosen, "timings": timings}
+
+
+def hash_passwords(passwords, rounds, executor=None, chunksize=8):
+    """ Hash a list of passwords, spread over executor's processes when one is given. Meant
+        for bulk jobs such as imports, not for request handlers - it bypasses the queue limit.
+    """
+
+    if executor is None:
+        return [_hash_password(pwd, rounds) for pwd in passwords]
+
+    return list(executor.map(_hash_password, passwords, [rounds] * len(passwords),
+                             chunksize=chunksize))
+
+
+class PasswordHasher:
+    """ Bounded process pool for bcrypt with a sync and an async API. """
+
+    def __init__(self, app=None):
+        self.pool_size = 0
+        self.max_queue = 0
+        self.timeout = None
+        self.rounds = 12
+
+        # observer(operation, seconds) callables told how long each call took, queueing included
+        self.observers = []
+
+        self._executor = None
+        self._slots = None
+        self._dummy_hash = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Read the hashing configuration from app.config. The pool is started lazily on
+            first use so it is created after any pre-fork done by the WSGI server.
+        """
+
+        app.config.setdefault("HASHING_POOL_SIZE", min(4, os.cpu_count() or 1))
+        app.config.setdefault("HASHING_MAX_QUEUE", 32)
+        app.config.setdefault("HASHING_TIMEOUT", 5.0)
+        app.config.setdefault("BCRYPT_LOG_ROUNDS", 12)
+        app.config.setdefault("BCRYPT_TARGET_MS", 80)
+        app.config.setdefault("BCRYPT_CALIBRATE_ON_STARTUP", False)
+
+        if (app.config["BCRYPT_CALIBRATE_ON_STARTUP"]):
+            calibration = calibrate_rounds(app.config["BCRYPT_TARGET_MS"])
+            app.config["BCRYPT_LOG_ROUNDS"] = calibration["rounds"]
+            app.logger.info(f"bcrypt calibrated to {calibration['rounds']} rounds: {calibration['timings']}")
+
+        self.shutdown()
+
+        self.pool_size = int(app.config["HASHING_POOL_SIZE"])
+        self.max_queue = int(app.config["HASHING_MAX_QUEUE"])
+        self.timeout = app.config["HASHING_TIMEOUT"]
+        self.rounds = int(app.config["BCRYPT_LOG_ROUNDS"])
+
+        self._slots = threading.BoundedSemaphore(self.pool_size + self.max_queue) \
+            if self.pool_size > 0 else None
+        self._dummy_hash = None
+
+    def shutdown(self):
+        """ Stop the worker processes. They are restarted on the next call. """
+
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    # pool plumbing
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.pool_size)
+            return self._executor
+
+    def _submit(self, fn, *args):
+        """ Submit fn to the pool when a slot is free, otherwise raise HashingBusyError.
+            The slot is released when the work finishes, not when the caller gives up, so
+            abandoned calls still count against the queue depth.
+        """
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusyError("password hashing queue is full")
+
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self.shutdown()
+            raise HashingBusyError("password hashing pool is unavailable")
+
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def _observe(self, operation, start):
+        elapsed = time.perf_counter() - start
+        for observer in self.observers:
+            observer(operation, elapsed)
+
+    def _run(self, operation, fn, *args):
+        start = time.perf_counter()
+        try:
+            return self._run_pool(fn, *args)
+        finally:
+            self._observe(operation, start)
+
+    async def _run_async(self, operation, fn, *args):
+        start = time.perf_counter()
+        try:
+            return await self._run_pool_async(fn, *args)
+        finally:
+            self._observe(operation, start)
+
+    def _run_pool(self, fn, *args):
+        if self.pool_size <= 0:
+            return fn(*args)
+
+        future = self._submit(fn, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise HashingBusyError("password hashing timed out")
+        except BrokenProcessPool:
+            self.shutdown()
+            raise HashingBusyError("password hashing pool is unavailable")
+
+    async def _run_pool_async(self, fn, *args):
+        loop = asyncio.get_running_loop()
+
+        if self.pool_size <= 0:
+            return await loop.run_in_executor(None, fn, *args)
+
+        future = self._submit(fn, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise HashingBusyError("password hashing timed out")
+        except BrokenProcessPool:
+            self.shutdown()
+            raise HashingBusyError("password hashing pool is unavailable")
+
+    def _get_dummy_hash(self):
+        """ Hash used to verify against when the username does not exist. Same cost as a
+            real hash so a miss takes as long as a hit.
+        """
+
+        if self._dummy_hash is None:
+            self._dummy_hash = _hash_password(os.urandom(16).hex(), self.rounds)
+        return self._dummy_hash
+
+    def needs_rehash(self, hashed):
+        """ True when hashed was made with a different cost than the configured one. """
+
+        return get_rounds(hashed) != self.rounds
+
+    # sync API
+
+    def hash_password(self, pwd):
+        """ Return the bcrypt hash of pwd as a utf8 string. """
+
+        return self._run("hash", _hash_password, pwd, self.rounds)
+
+    def check_password(self, hashed, pwd):
+        """ Return True when pwd matches hashed. """
+
+        return self._run("check", _check_password, hashed, pwd)
+
+    def dummy_verify(self, pwd):
+        """ Burn the cost of a verify for an unknown user. Always returns False. """
+
+        self._run("dummy_check", _check_password, self._get_dummy_hash(), pwd)
+        return False
+
+    # async API
+
+    async def hash_password_async(self, pwd):
+        """ Awaitable hash_password. """
+
+        return await self._run_async("hash", _hash_password, pwd, self.rounds)
+
+    async def check_password_async(self, hashed, pwd):
+        """ Awaitable check_password. """
+
+        return await self._run_async("check", _check_password, hashed, pwd)
+
+    async def dummy_verify_async(self, pwd):
+        """ Awaitable dummy_verify. """
+
+        await self._run_async("dummy_check", _check_password, self._get_dummy_hash(), pwd)
+        return False
+
+
+password_hasher = PasswordHasher()
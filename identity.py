@@ -0,0 +1,112 @@
+""" Current user loading.
+
+    Once per request, before the view runs, the logged in user's profile is put on g.user
+    (None when nobody is logged in or the user no longer exists). Profiles come from a
+    bounded per-worker LRU cache with a time to live so repeated page views skip the users
+    table:
+
+        USER_CACHE_ENABLED       False loads the profile from the database on every request.
+        USER_CACHE_TTL           seconds a cached profile is trusted.
+        USER_CACHE_MAX_ENTRIES   profiles kept per worker.
+
+    db_delete_user (and any profile update) calls user_cache.invalidate. Other workers keep
+    their copy until it expires, so USER_CACHE_TTL bounds how stale a profile can be.
+"""
+
+import time
+
+from flask import g, session
+
+from store import MemoryStore
+
+
+class UserProfile:
+    """ Read only snapshot of a user row. The password hash is deliberately left out. """
+
+    __slots__ = ("username", "email", "first_name", "last_name", "feedback_count", "pages_version")
+
+    def __init__(self, username, email, first_name, last_name, feedback_count=0, pages_version=0):
+        self.username = username
+        self.email = email
+        self.first_name = first_name
+        self.last_name = last_name
+        self.feedback_count = feedback_count
+        self.pages_version = pages_version
+
+    def __repr__(self):
+        return f"<UserProfile username:{self.username}, first_name:{self.first_name}, last_name:{self.last_name}, email:{self.email} >"
+
+    def get_full_name(self):
+        """ Return the user full name """
+
+        return f"{self.first_name} {self.last_name}"
+
+
+class UserCache:
+    """ TTL'd LRU cache of UserProfiles plus the per request current user loader. """
+
+    def __init__(self, app=None, loader=None):
+        self.enabled = False
+        self.ttl = 60
+        self.loader = None
+        self.store = MemoryStore()
+
+        if app is not None:
+            self.init_app(app, loader)
+
+    def init_app(self, app, loader):
+        """ loader(username) returns a UserProfile or None and is called on cache misses. """
+
+        app.config.setdefault("USER_CACHE_ENABLED", True)
+        app.config.setdefault("USER_CACHE_TTL", 60)
+        app.config.setdefault("USER_CACHE_MAX_ENTRIES", 10000)
+
+        self.enabled = app.config["USER_CACHE_ENABLED"]
+        self.ttl = app.config["USER_CACHE_TTL"]
+        self.loader = loader
+        self.store = MemoryStore(max_entries=app.config["USER_CACHE_MAX_ENTRIES"])
+
+        app.before_request(self.load_current_user)
+
+    def cached(self, username):
+        """ username's UserProfile when the cache holds a fresh copy, otherwise None. """
+
+        if not self.enabled:
+            return None
+
+        cached = self.store.get(username)
+        if cached is not None:
+            (expires, profile) = cached
+            if (time.monotonic() < expires):
+                return profile
+            self.store.delete(username)
+
+        return None
+
+    def put(self, username, profile):
+        """ Cache profile for username. Missing users (None) are not cached. """
+
+        if (self.enabled and profile is not None):
+            self.store.set(username, (time.monotonic() + self.ttl, profile))
+
+    def get(self, username):
+        """ username's UserProfile, from the cache when fresh. """
+
+        profile = self.cached(username)
+
+        if profile is None:
+            profile = self.loader(username)
+            self.put(username, profile)
+
+        return profile
+
+    def invalidate(self, username):
+        self.store.delete(username)
+
+    def load_current_user(self):
+        """ before_request: put the logged in user's profile on g.user """
+
+        g.user = self.get(session["username"]) if "username" in session else None
+
+
+user_cache = UserCache()
@@ -0,0 +1,280 @@
+""" Background jobs kept in the jobs table, run by `flask run-jobs` workers.
+
+    Request handlers queue work with models.enqueue_job(name, payload) in their own transaction
+    and return; no broker is needed. A worker claims the oldest due job with a conditional
+    UPDATE (FOR UPDATE SKIP LOCKED as well on PostgreSQL), so any number of worker threads and
+    processes can share the table. A claimed job is hidden from the other workers for
+    JOB_VISIBILITY_TIMEOUT seconds; a handler that runs longer calls heartbeat() to keep it.
+    If the worker dies the job is claimed again once the timeout has passed.
+
+    A handler that raises is retried after JOB_RETRY_BACKOFF * 2 ** (attempts - 1) seconds, at
+    most JOB_RETRY_BACKOFF_MAX, until the job's max_attempts (JOB_MAX_ATTEMPTS) are used up and
+    it is marked failed. Delivery is at least once, so handlers must be safe to run again.
+
+        JOBS_ENABLED              db_delete_user queues purges here instead of running them
+                                  on a thread of the web process.
+        JOB_WORKER_THREADS        jobs run at the same time by one `flask run-jobs`.
+        JOB_POLL_INTERVAL         seconds an idle worker thread waits before looking again.
+        JOB_RETENTION_DAYS        done jobs older than this are deleted by the workers.
+
+    Handlers are registered with @job_queue.register(name) and called as
+    handler(app, payload, heartbeat) on a worker thread, inside the worker's app context.
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_
+
+from models import db, Job, archive_feedback, purge_user, reconcile_feedback_counts
+
+
+class JobQueue:
+    """ Job handler registry and the worker loop over the jobs table. """
+
+    def __init__(self, app=None):
+        self.handlers = {}
+        self.visibility_timeout = 300
+        self.backoff = 10
+        self.backoff_max = 3600
+        self.poll_interval = 1.0
+        self.retention_days = 7
+        self.pruned_at = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("JOBS_ENABLED", False)
+        app.config.setdefault("JOB_WORKER_THREADS", 4)
+        app.config.setdefault("JOB_POLL_INTERVAL", 1.0)
+        app.config.setdefault("JOB_VISIBILITY_TIMEOUT", 300)
+        app.config.setdefault("JOB_MAX_ATTEMPTS", 5)
+        app.config.setdefault("JOB_RETRY_BACKOFF", 10)
+        app.config.setdefault("JOB_RETRY_BACKOFF_MAX", 3600)
+        app.config.setdefault("JOB_RETENTION_DAYS", 7)
+
+        self.visibility_timeout = app.config["JOB_VISIBILITY_TIMEOUT"]
+        self.backoff = app.config["JOB_RETRY_BACKOFF"]
+        self.backoff_max = app.config["JOB_RETRY_BACKOFF_MAX"]
+        self.poll_interval = app.config["JOB_POLL_INTERVAL"]
+        self.retention_days = app.config["JOB_RETENTION_DAYS"]
+
+    def register(self, name):
+        """ Decorator registering handler(app, payload, heartbeat) for jobs called name """
+
+        def decorator(handler):
+            self.handlers[name] = handler
+            return handler
+
+        return decorator
+
+    # claiming and finishing. Every UPDATE names the worker holding the job, so a worker whose
+    #  job timed out and was claimed by another cannot finish it.
+
+    def claim(self, worker_id):
+        """ Claim the oldest due job for worker_id and commit. Returns the Job, or None. """
+
+        now = datetime.utcnow()
+
+        # jobs whose worker vanished on their last attempt
+        Job.query.filter(Job.state == "running", Job.locked_until < now, Job.attempts >= Job.max_attempts).update(
+            {"state": "failed", "finished_at": now, "last_error": "visibility timeout expired"},
+            synchronize_session=False)
+        db.session.commit()
+
+        due = or_(and_(Job.state == "queued", Job.run_at <= now),
+                  and_(Job.state == "running", Job.locked_until < now))
+
+        candidates = [job_id for (job_id,) in db.session.query(Job.id).filter(due).order_by(
+            Job.run_at, Job.id).limit(5).with_for_update(skip_locked=True)]
+
+        for job_id in candidates:
+            # another worker may have taken it since the SELECT (SQLite has no row locks)
+            claimed = Job.query.filter(Job.id == job_id, due).update(
+                {"state": "running", "attempts": Job.attempts + 1, "locked_by": worker_id,
+                 "locked_until": now + timedelta(seconds=self.visibility_timeout)},
+                synchronize_session=False)
+            if claimed:
+                db.session.commit()
+                return Job.query.get(job_id)
+
+        db.session.rollback()
+        return None
+
+    def heartbeat(self, job_id, worker_id):
+        """ Extend worker_id's hold on job job_id by JOB_VISIBILITY_TIMEOUT. Uses a connection of
+            its own, so it can be called from inside a handler's transaction.
+        """
+
+        with db.engine.begin() as connection:
+            connection.execute(Job.__table__.update().where(
+                Job.id == job_id, Job.locked_by == worker_id, Job.state == "running").values(
+                locked_until=datetime.utcnow() + timedelta(seconds=self.visibility_timeout)))
+
+    def complete(self, job_id, worker_id):
+        Job.query.filter_by(id=job_id, locked_by=worker_id, state="running").update(
+            {"state": "done", "finished_at": datetime.utcnow(), "locked_until": None},
+            synchronize_session=False)
+        db.session.commit()
+
+    def fail(self, job_id, worker_id, attempts, max_attempts, error):
+        """ Queue the job again after its backoff, or mark it failed after its last attempt """
+
+        now = datetime.utcnow()
+
+        if (attempts < max_attempts):
+            delay = min(self.backoff * 2 ** (attempts - 1), self.backoff_max)
+            values = {"state": "queued", "run_at": now + timedelta(seconds=delay)}
+        else:
+            values = {"state": "failed", "finished_at": now}
+
+        values.update({"locked_until": None, "last_error": f"{type(error).__name__}: {error}"})
+
+        Job.query.filter_by(id=job_id, locked_by=worker_id, state="running").update(
+            values, synchronize_session=False)
+        db.session.commit()
+
+    def prune(self):
+        """ Delete the done jobs older than JOB_RETENTION_DAYS. Returns the number deleted. """
+
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+
+        nbr_deleted = Job.query.filter(Job.state == "done", Job.finished_at < cutoff).delete(
+            synchronize_session=False)
+        db.session.commit()
+
+        return nbr_deleted
+
+    # running
+
+    def run(self, app, job, worker_id):
+        """ Run a claimed job and record the outcome. Returns True when it succeeded. """
+
+        (job_id, name, attempts, max_attempts) = (job.id, job.name, job.attempts, job.max_attempts)
+        payload = json.loads(job.payload)
+
+        try:
+            handler = self.handlers.get(name)
+            if handler is None:
+                raise LookupError(f"no handler for job '{name}'")
+
+            handler(app, payload, lambda: self.heartbeat(job_id, worker_id))
+
+        except Exception as err:
+            db.session.rollback()
+            app.logger.exception(f"job {job_id} ({name}) failed, attempt {attempts} of {max_attempts}")
+            self.fail(job_id, worker_id, attempts, max_attempts, err)
+            return False
+
+        self.complete(job_id, worker_id)
+        return True
+
+    def work(self, app, worker_id, stop, once=False, report=None):
+        """ Worker thread: claim and run jobs until stop is set (or, with once, until there is
+            nothing due). report(job_id, name, succeeded) is called after each job.
+        """
+
+        with app.app_context():
+            while not stop.is_set():
+                try:
+                    job = self.claim(worker_id)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception(f"{worker_id} could not claim a job")
+                    job = None
+
+                if job is None:
+                    db.session.remove()
+                    if once:
+                        return
+                    self.prune_now_and_then()
+                    stop.wait(self.poll_interval)
+                    continue
+
+                (job_id, name) = (job.id, job.name)
+                succeeded = self.run(app, job, worker_id)
+                db.session.remove()
+
+                if report:
+                    report(job_id, name, succeeded)
+
+    def prune_now_and_then(self):
+        """ Prune done jobs at most once an hour per process """
+
+        if (time.monotonic() - self.pruned_at > 3600):
+            self.pruned_at = time.monotonic()
+            self.prune()
+
+    def run_workers(self, app, threads, once=False, report=None):
+        """ Run threads worker threads until interrupted (or, with once, until the queue has
+            nothing due). More processes can run their own `flask run-jobs` against the same table.
+        """
+
+        stop = threading.Event()
+        prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="job-worker") as executor:
+            futures = [executor.submit(self.work, app, f"{prefix}:{i}", stop, once, report)
+                       for i in range(threads)]
+            try:
+                for future in futures:
+                    future.result()
+            except KeyboardInterrupt:
+                # the jobs in progress finish; nothing new is claimed
+                stop.set()
+
+    # status
+
+    def status(self, job_id):
+        """ Job job_id as a dictionary, or None """
+
+        job = Job.query.get(job_id)
+
+        return job.serialize() if job else None
+
+    def counts(self):
+        """ {(name, state): number of jobs} """
+
+        return {(name, state): count for (name, state, count) in db.session.query(
+            Job.name, Job.state, func.count(Job.id)).group_by(Job.name, Job.state)}
+
+
+job_queue = JobQueue()
+
+
+# Handlers
+
+@job_queue.register("purge_user")
+def purge_user_job(app, payload, heartbeat):
+    """ payload: {"username"}. Deletes a disabled user's feedback in chunks, then the user. """
+
+    status = purge_user(app, payload["username"], progress=lambda status: heartbeat())
+
+    if (status["state"] == "failed"):
+        # purge_user logged the cause; the next attempt carries on from the rows that are left
+        raise RuntimeError(f"purge of {payload['username']} failed after {status['deleted']} rows")
+
+
+@job_queue.register("archive_feedback")
+def archive_feedback_job(app, payload, heartbeat):
+    """ payload: {"older_than_days", "batch_size"}, both optional. See models.archive_feedback. """
+
+    with app.app_context():
+        archive_feedback(payload.get("older_than_days", app.config["FEEDBACK_ARCHIVE_AFTER_DAYS"]),
+                         batch_size=payload.get("batch_size", app.config["FEEDBACK_ARCHIVE_BATCH_SIZE"]),
+                         report=lambda moved: heartbeat())
+
+
+@job_queue.register("reconcile_feedback_counts")
+def reconcile_feedback_counts_job(app, payload, heartbeat):
+    """ payload: {"batch_size"}, optional. See models.reconcile_feedback_counts. """
+
+    # no heartbeat: reports come mid transaction, where a second SQLite writer would wait
+    with app.app_context():
+        reconcile_feedback_counts(batch_size=payload.get("batch_size", 1000))
@@ -0,0 +1,263 @@
+""" In-process metrics served in Prometheus text format.
+
+    Recorded per worker process:
+        feedback_request_seconds              request latency by endpoint, method and status
+        feedback_request_sql_statements       SQL statements per request by endpoint
+        feedback_request_sql_seconds          time in SQL per request by endpoint
+        feedback_password_hash_seconds        time in the password hashing service by operation
+                                              (includes waiting for a pool worker)
+        feedback_template_render_seconds      template render time by template
+        feedback_db_pool_checkout_seconds     time waiting for a pooled database connection
+        feedback_render_cache_*               profile render cache hits, misses and size
+        feedback_login_throttled_total        logins refused by the throttle by reason
+
+        METRICS_ENABLED     False turns the instrumentation and the endpoint off.
+        METRICS_PATH        where the metrics are served, /metrics by default.
+
+    Recording is a lock, a bisect and two additions per observation so it can stay on in
+    production. Template timing uses Flask's signals, which need the blinker package.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+from hashing import password_hasher
+from render_cache import render_cache
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def format_labels(labelnames, values, extra=""):
+    pairs = [f'{name}="{value}"' for (name, value) in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """ Prometheus style histogram with labels. """
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+
+        # labels -> [bucket counts..., sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            if (index < len(self.buckets)):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            series_items = [(labels, list(series)) for (labels, series) in self._series.items()]
+
+        for (labels, series) in sorted(series_items):
+            cumulative = 0
+            for (bound, count) in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {series[-1]}")
+
+        return lines
+
+
+class Counter:
+    """ Prometheus style counter with labels. """
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for (labels, value) in values:
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+
+        return lines
+
+
+class Metrics:
+    """ Collects the app's metrics and serves them at METRICS_PATH. """
+
+    def __init__(self, app=None):
+        self.request_seconds = Histogram(
+            "feedback_request_seconds", "Request latency.", ("endpoint", "method", "status"))
+        self.request_sql_statements = Histogram(
+            "feedback_request_sql_statements", "SQL statements per request.", ("endpoint",), COUNT_BUCKETS)
+        self.request_sql_seconds = Histogram(
+            "feedback_request_sql_seconds", "Time spent in SQL per request.", ("endpoint",))
+        self.password_hash_seconds = Histogram(
+            "feedback_password_hash_seconds", "Time in the password hashing service.", ("operation",))
+        self.template_render_seconds = Histogram(
+            "feedback_template_render_seconds", "Template render time.", ("template",))
+        self.pool_checkout_seconds = Histogram(
+            "feedback_db_pool_checkout_seconds", "Time waiting for a pooled database connection.")
+        self.login_throttled = Counter(
+            "feedback_login_throttled_total", "Login attempts refused by the throttle.", ("reason",))
+
+        self.collectors = [self.request_seconds, self.request_sql_statements, self.request_sql_seconds,
+                           self.password_hash_seconds, self.template_render_seconds,
+                           self.pool_checkout_seconds, self.login_throttled]
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("METRICS_ENABLED", True)
+        app.config.setdefault("METRICS_PATH", "/metrics")
+
+        if not app.config["METRICS_ENABLED"]:
+            return
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+        before_render_template.connect(self.before_render_template, app)
+        template_rendered.connect(self.template_rendered, app)
+
+        if (self.observe_hashing not in password_hasher.observers):
+            password_hasher.observers.append(self.observe_hashing)
+
+        app.add_url_rule(app.config["METRICS_PATH"], "metrics", self.metrics_view)
+
+    # request timing
+
+    def before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_sql_count = 0
+        g.metrics_sql_seconds = 0.0
+
+    def after_request(self, response):
+        start = g.get("metrics_start")
+        if start is None:
+            return response
+
+        endpoint = request.endpoint or "unmatched"
+
+        self.request_seconds.observe(time.perf_counter() - start, endpoint, request.method,
+                                     str(response.status_code))
+        self.request_sql_statements.observe(g.metrics_sql_count, endpoint)
+        self.request_sql_seconds.observe(g.metrics_sql_seconds, endpoint)
+
+        return response
+
+    # SQL and pool timing
+
+    def instrument(self, engine):
+        """ Attach the SQL counters and the pool checkout timer to engine. """
+
+        if event.contains(engine, "before_cursor_execute", self.before_cursor_execute):
+            return
+
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+        event.listen(engine, "engine_disposed", self.instrument_pool)
+
+        self.instrument_pool(engine)
+
+    def instrument_pool(self, engine):
+        """ Time Pool.connect, which is where a request waits for a free connection. The pool is
+            replaced when the engine is disposed, so this runs again on engine_disposed.
+        """
+
+        pool = engine.pool
+        if getattr(pool, "feedback_metrics_timed", False):
+            return
+
+        connect = pool.connect
+        observe = self.pool_checkout_seconds.observe
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                observe(time.perf_counter() - start)
+
+        pool.connect = timed_connect
+        pool.feedback_metrics_timed = True
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["metrics_start"].pop()
+
+        if has_request_context() and "metrics_sql_count" in g:
+            g.metrics_sql_count += 1
+            g.metrics_sql_seconds += elapsed
+
+    # hashing and templates
+
+    def observe_hashing(self, operation, seconds):
+        self.password_hash_seconds.observe(seconds, operation)
+
+    def before_render_template(self, sender, template, context, **extra):
+        if has_request_context():
+            g.setdefault("metrics_render_start", []).append(time.perf_counter())
+
+    def template_rendered(self, sender, template, context, **extra):
+        if has_request_context() and g.get("metrics_render_start"):
+            self.template_render_seconds.observe(
+                time.perf_counter() - g.metrics_render_start.pop(), template.name or "string")
+
+    # exposition
+
+    def render(self):
+        """ All metrics in Prometheus text format. """
+
+        lines = []
+        for collector in self.collectors:
+            lines.extend(collector.render())
+
+        cache_stats = render_cache.stats()
+        for (key, kind) in (("hits", "counter"), ("misses", "counter"), ("entries", "gauge"), ("bytes", "gauge")):
+            if (key in cache_stats):
+                name = f"feedback_render_cache_{key}"
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {cache_stats[key]}")
+
+        return "\n".join(lines) + "\n"
+
+    def metrics_view(self):
+        """ route: METRICS_PATH  metrics in Prometheus text format """
+
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+
+metrics = Metrics()
@@ -1,12 +1,25 @@
 """Models for Flask Feedback app."""
 
-from flask_sqlalchemy import SQLAlchemy
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app, g
+from sqlalchemy import DDL, FetchedValue, column, delete, event, exists, func, insert, literal, select, table, text, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import IntegrityError
-from flask_bcrypt import Bcrypt
+from hashing import password_hasher, HashingBusyError
+from render_cache import render_cache
+from identity import UserProfile, user_cache
+from routing import RoutingSQLAlchemy, on_primary, replica_router
+from sharding import SHARDED_TABLES, ShardingError, ShardMovingError, shard_router
 
-db = SQLAlchemy()
-
-bcrypt = Bcrypt()
+# sessions send the reads of GET requests to a replica when DB_REPLICA_URIS is set (routing.py)
+db = RoutingSQLAlchemy()
 
 USER_FIELDS = {
     "username": "",
@@ -16,15 +29,43 @@ USER_FIELDS = {
     "last_name": ""
 }
 
+# passwords hashed with an outdated bcrypt cost are rehashed off the login path.
+rehash_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rehash")
+rehash_pending = set()
+rehash_lock = threading.Lock()
+
+# deletes of very large accounts are finished off the request path, one at a time.
+purge_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="purge")
+
+# text search configuration for the PostgreSQL tsvector column
+SEARCH_CONFIG = "english"
+
+# with sharding, feedback ids are handed out from blocks reserved in id_blocks on the primary,
+#  one block per primary database URL: {url: {"next", "end"}}
+feedback_id_blocks = {}
+feedback_id_lock = threading.Lock()
+
 
 def connect_db(app):
     """ Associate the flask application app with SQL Alchemy and
         initialize SQL Alchemy
     """
     db.app = app
+    shard_router.init_app(app, lookup_user_shard)
+    replica_router.init_app(app)
     db.init_app(app)
 
 
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """ SQLite ignores foreign keys (and so ON DELETE CASCADE) unless asked per connection. """
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 # MODELS
 class User(db.Model):
     """ User model for a users table in the flask_feedback database. """
@@ -47,6 +88,34 @@ class User(db.Model):
     last_name = db.Column(db.String(30),
                           nullable=False)
 
+    # set while a large account is being purged in the background. Disabled users cannot login.
+    disabled = db.Column(db.Boolean,
+                         nullable=False,
+                         default=False,
+                         server_default=db.false())
+
+    # kept in step with the feedback table by the helpers below, in the same transaction as the
+    #  feedback change. `flask reconcile-feedback-counts` repairs any drift.
+    feedback_count = db.Column(db.Integer,
+                               nullable=False,
+                               default=0,
+                               server_default="0")
+
+    last_feedback_at = db.Column(db.DateTime,
+                                 nullable=True)
+
+    # bumped with every change to the user's feedback pages, in the same transaction. It is part
+    #  of the render cache key (through the cached UserProfile), so changes made by other
+    #  processes - the CLI, job workers, other web workers - reach the cached pages within
+    #  USER_CACHE_TTL.
+    pages_version = db.Column(db.Integer,
+                              nullable=False,
+                              default=0,
+                              server_default="0")
+
+    last_login_at = db.Column(db.DateTime,
+                              nullable=True)
+
     def __repr__(self):
         """Show user information """
 
@@ -61,9 +130,8 @@ class User(db.Model):
     def register(cls, username, pwd):
         """ Register user w/hashed password and return user object. """
 
-        hashed = bcrypt.generate_password_hash(pwd)
-        # turn bytestring into normal (unicode utf8) string
-        hashed_utf8 = hashed.decode("utf8")
+        # hashed in the password hashing pool, returned as a normal (unicode utf8) string
+        hashed_utf8 = password_hasher.hash_password(pwd)
 
         # return instance of user w/username and hashed pwd
         return cls(username=username, password=hashed_utf8)
@@ -73,15 +141,25 @@ class User(db.Model):
         """ Validate that user exists & password is correct.
 
             Return user object when valid; otherwise return False.
+
+            HashingBusyError is raised when the password hashing pool is saturated.
         """
 
-        u = User.query.filter_by(username=username).first()
+        shard_router.use_shard(username)
+        u = User.query.filter_by(username=username, disabled=False).first()
 
-        if u and bcrypt.check_password_hash(u.password, pwd):
-            # return user instance
-            return u
+        if u:
+            if password_hasher.check_password(u.password, pwd):
+                if password_hasher.needs_rehash(u.password):
+                    schedule_rehash(u.username, u.password, pwd)
+
+                # return user instance
+                return u
         else:
-            return False
+            # unknown username - verify against a dummy hash so a miss costs the same as a hit
+            password_hasher.dummy_verify(pwd)
+
+        return False
 
 
 class Feedback(db.Model):
@@ -100,18 +178,444 @@ class Feedback(db.Model):
                         nullable=False)
 
     username = db.Column(db.String(20),
-                         db.ForeignKey('users.username'))
-
-    user = db.relationship("User", backref="comments")
+                         db.ForeignKey('users.username', ondelete="CASCADE"))
+
+    # bumped on every update. Used for API ETags and to catch concurrent updates.
+    version = db.Column(db.Integer,
+                        nullable=False,
+                        default=1,
+                        server_default="1")
+
+    # UTC. Feedback older than FEEDBACK_ARCHIVE_AFTER_DAYS is moved to feedback_archive by
+    #  archive_feedback.
+    created_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow,
+                           server_default=func.now(),
+                           index=True)
+
+    updated_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow,
+                           onupdate=datetime.utcnow,
+                           server_default=func.now())
+
+    # full text search document (title weighted above content), PostgreSQL only. Filled in by
+    #  index_feedback. SQLite searches the feedback_fts table instead (see the DDL below).
+    search_vector = db.deferred(db.Column(db.Text().with_variant(postgresql.TSVECTOR(), "postgresql"),
+                                          nullable=True))
+
+    # passive_deletes leaves removing a user's feedback to the database cascade
+    user = db.relationship("User", backref=db.backref("comments", passive_deletes=True))
+
+    __mapper_args__ = {
+        "version_id_col": version
+    }
+
+    # supports the keyset paginated profile listing: WHERE username = ? AND id > ? ORDER BY id
+    __table_args__ = (
+        db.Index("ix_feedback_username_id", "username", "id"),
+    )
 
     def __repr__(self):
         """Show feedback information """
 
         return f"<Feedback id:{self.id}, title:{self.title}, content:{self.content}, username:{self.username} >"
 
+    def serialize(self):
+        """ Feedback as a dictionary for JSON responses """
+
+        return {
+            "id": self.id,
+            "title": self.title,
+            "content": self.content,
+            "username": self.username,
+            "version": self.version
+        }
+
+
+class FeedbackArchive(db.Model):
+    """ Cold storage for old feedback. archive_feedback moves rows here from feedback, keeping
+        their ids, so the live table and its indexes only hold recent feedback. Archived
+        feedback is read only and is not searched.
+    """
+
+    __tablename__ = "feedback_archive"
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=False)
+
+    title = db.Column(db.String(100),
+                      nullable=False)
+
+    content = db.Column(db.Text,
+                        nullable=False)
+
+    # archived feedback goes with its user like live feedback does
+    username = db.Column(db.String(20),
+                         db.ForeignKey('users.username', ondelete="CASCADE"))
+
+    version = db.Column(db.Integer,
+                        nullable=False)
+
+    created_at = db.Column(db.DateTime,
+                           nullable=False)
+
+    updated_at = db.Column(db.DateTime,
+                           nullable=False)
+
+    # UTC, when archive_feedback moved the row
+    archived_at = db.Column(db.DateTime,
+                            nullable=False,
+                            default=datetime.utcnow)
+
+    # the archived listing pages by id per user like the profile page
+    __table_args__ = (
+        db.Index("ix_feedback_archive_username_id", "username", "id"),
+    )
+
+    def __repr__(self):
+        """Show archived feedback information """
+
+        return f"<FeedbackArchive id:{self.id}, title:{self.title}, username:{self.username} >"
+
+    def serialize(self):
+        """ Archived feedback as a dictionary for JSON responses """
+
+        return {
+            "id": self.id,
+            "title": self.title,
+            "content": self.content,
+            "username": self.username,
+            "version": self.version,
+            "archived": True
+        }
+
+
+class FeedbackEvent(db.Model):
+    """ Outbox of feedback changes. The feedback helpers append one row per create, update and
+        delete in the same transaction as the change; changefeed.py streams them to consumers
+        and prunes them once every consumer has acknowledged them.
+    """
+
+    __tablename__ = "feedback_events"
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"),
+                   primary_key=True,
+                   autoincrement=True)
+
+    # "create", "update" or "delete"
+    event_type = db.Column(db.String(10),
+                           nullable=False)
+
+    # the feedback and user may be gone by the time the event is read, so no foreign keys
+    feedback_id = db.Column(db.Integer,
+                            nullable=False)
+
+    username = db.Column(db.String(20),
+                         nullable=False)
+
+    # the feedback as it is after the change (as it was, for deletes)
+    title = db.Column(db.String(100),
+                      nullable=False)
+
+    content = db.Column(db.Text,
+                        nullable=False)
+
+    version = db.Column(db.Integer,
+                        nullable=False)
+
+    # UTC, set when the change is flushed
+    created_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow)
+
+    # PostgreSQL: id of the writing transaction (txid_current() default, see below), which
+    #  changefeed.py orders by so events are read in the order they became visible. NULL elsewhere.
+    txid = db.Column(db.BigInteger,
+                     nullable=True,
+                     server_default=FetchedValue())
+
+    def serialize(self):
+        """ Event as a dictionary for the JSONL change feed """
+
+        return {
+            "id": self.id,
+            "type": self.event_type,
+            "feedback_id": self.feedback_id,
+            "username": self.username,
+            "title": self.title,
+            "content": self.content,
+            "version": self.version,
+            "at": self.created_at.isoformat() + "Z"
+        }
+
+
+class FeedbackEventCursor(db.Model):
+    """ How far each change feed consumer has read (and acknowledged) feedback_events. """
+
+    __tablename__ = "feedback_event_cursors"
+
+    consumer = db.Column(db.String(50),
+                         primary_key=True)
+
+    # event ids are per shard (sharding.py), so is the cursor. Always 0 without sharding.
+    shard = db.Column(db.Integer,
+                      primary_key=True,
+                      default=0,
+                      server_default="0")
+
+    last_event_id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"),
+                              nullable=False,
+                              default=0)
+
+    # PostgreSQL: txid of the last event acknowledged; the position is (last_txid, last_event_id)
+    last_txid = db.Column(db.BigInteger,
+                          nullable=False,
+                          default=0,
+                          server_default="0")
+
+    updated_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
+
+
+class UserDirectory(db.Model):
+    """ Shard of every user when DB_SHARD_URIS is set (sharding.py). Lives on the primary; its
+        username and email unique constraints keep both unique across shards.
+    """
+
+    __tablename__ = "user_directory"
+
+    username = db.Column(db.String(20),
+                         primary_key=True)
+
+    email = db.Column(db.String(50),
+                      unique=True,
+                      nullable=False)
+
+    shard = db.Column(db.Integer,
+                      nullable=False)
+
+    # set while move_users copies the user to another shard; writes are refused meanwhile
+    moving = db.Column(db.Boolean,
+                       nullable=False,
+                       default=False,
+                       server_default=db.false())
+
+
+class IdBlock(db.Model):
+    """ Global id allocator on the primary. next_value is the first id not reserved yet. """
+
+    __tablename__ = "id_blocks"
+
+    name = db.Column(db.String(30),
+                     primary_key=True)
+
+    next_value = db.Column(db.BigInteger,
+                           nullable=False)
+
+
+class Job(db.Model):
+    """ Background job queue (jobs.py). A job is enqueued in the caller's transaction and run
+        by a `flask run-jobs` worker, retried with backoff until max_attempts.
+    """
+
+    __tablename__ = "jobs"
+
+    __table_args__ = (
+        db.Index("ix_jobs_state_run_at", "state", "run_at"),
+    )
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"),
+                   primary_key=True,
+                   autoincrement=True)
+
+    # handler registered in jobs.py
+    name = db.Column(db.String(50),
+                     nullable=False)
+
+    # JSON keyword arguments of the handler
+    payload = db.Column(db.Text,
+                        nullable=False,
+                        default="{}")
+
+    # "queued", "running", "done" or "failed"
+    state = db.Column(db.String(10),
+                      nullable=False,
+                      default="queued")
+
+    attempts = db.Column(db.Integer,
+                         nullable=False,
+                         default=0)
+
+    max_attempts = db.Column(db.Integer,
+                             nullable=False)
+
+    # UTC. Not run before run_at; retries move it forward.
+    run_at = db.Column(db.DateTime,
+                       nullable=False,
+                       default=datetime.utcnow)
+
+    # a running job whose locked_until has passed (its worker died or hung) is run again
+    locked_by = db.Column(db.String(100))
+
+    locked_until = db.Column(db.DateTime)
+
+    last_error = db.Column(db.Text)
+
+    created_at = db.Column(db.DateTime,
+                           nullable=False,
+                           default=datetime.utcnow)
+
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        """ Self representation for a Job instance """
+
+        return f"<Job {self.id} {self.name} {self.state} attempts={self.attempts}>"
+
+    def serialize(self):
+        """ Job status as a dictionary """
+
+        return {
+            "id": self.id,
+            "name": self.name,
+            "payload": json.loads(self.payload),
+            "state": self.state,
+            "attempts": self.attempts,
+            "max_attempts": self.max_attempts,
+            "run_at": self.run_at.isoformat() + "Z",
+            "last_error": self.last_error,
+            "created_at": self.created_at.isoformat() + "Z",
+            "finished_at": self.finished_at.isoformat() + "Z" if self.finished_at else None
+        }
+
+
+# Full text search indexes. PostgreSQL gets a GIN index on feedback.search_vector. SQLite gets an
+#  external content FTS5 table kept in step with feedback by triggers, which also covers bulk
+#  imports and cascaded deletes.
+
+# On PostgreSQL every change event records its transaction, see changefeed.read_events
+event.listen(FeedbackEvent.__table__, "after_create", DDL(
+    "ALTER TABLE feedback_events ALTER COLUMN txid SET DEFAULT txid_current()"
+).execute_if(dialect="postgresql"))
+
+event.listen(FeedbackEvent.__table__, "after_create", DDL(
+    "CREATE INDEX ix_feedback_events_txid_id ON feedback_events (txid, id)"
+).execute_if(dialect="postgresql"))
+
+event.listen(Feedback.__table__, "after_create", DDL(
+    "CREATE INDEX ix_feedback_search_vector ON feedback USING GIN (search_vector)"
+).execute_if(dialect="postgresql"))
+
+for fts_ddl in (
+        "CREATE VIRTUAL TABLE feedback_fts USING fts5(title, content, content='feedback', content_rowid='id')",
+        """CREATE TRIGGER feedback_fts_insert AFTER INSERT ON feedback BEGIN
+               INSERT INTO feedback_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+           END""",
+        """CREATE TRIGGER feedback_fts_delete AFTER DELETE ON feedback BEGIN
+               INSERT INTO feedback_fts (feedback_fts, rowid, title, content)
+                   VALUES ('delete', old.id, old.title, old.content);
+           END""",
+        """CREATE TRIGGER feedback_fts_update AFTER UPDATE OF title, content ON feedback BEGIN
+               INSERT INTO feedback_fts (feedback_fts, rowid, title, content)
+                   VALUES ('delete', old.id, old.title, old.content);
+               INSERT INTO feedback_fts (rowid, title, content) VALUES (new.id, new.title, new.content);
+           END"""):
+    event.listen(Feedback.__table__, "after_create", DDL(fts_ddl).execute_if(dialect="sqlite"))
+
+event.listen(Feedback.__table__, "after_drop", DDL(
+    "DROP TABLE IF EXISTS feedback_fts"
+).execute_if(dialect="sqlite"))
+
 
 # Helper functions
 
+def schedule_rehash(username, old_hash, pwd):
+    """ Queue a rehash of username's password with the current bcrypt cost. The rehash runs
+        in the background so the login that triggered it is not slowed down. Only one rehash
+        per username is queued at a time.
+    """
+
+    with rehash_lock:
+        if (username in rehash_pending):
+            return
+        rehash_pending.add(username)
+
+    rehash_executor.submit(rehash_user_password,
+                           current_app._get_current_object(), username, old_hash, pwd)
+
+
+def rehash_user_password(app, username, old_hash, pwd):
+    """ Rehash pwd and save it for username. The update only applies when the stored hash is
+        still old_hash, so a password changed in the meantime is never overwritten.
+    """
+
+    try:
+        new_hash = password_hasher.hash_password(pwd)
+
+        with app.app_context():
+            shard_router.use_shard(username, write=True)
+            User.query.filter_by(username=username, password=old_hash).update(
+                {"password": new_hash}, synchronize_session=False)
+            db.session.commit()
+
+    except (HashingBusyError, ShardMovingError):
+        # pool is saturated or the user is being moved - the next successful login will try again
+        pass
+
+    except Exception:
+        app.logger.exception(f"rehash of {username}'s password failed")
+
+    finally:
+        with rehash_lock:
+            rehash_pending.discard(username)
+
+
+def user_profile_statement(username):
+    """ select() for the UserProfile columns of an active (not disabled) user """
+
+    return select(User.username, User.email, User.first_name, User.last_name, User.feedback_count,
+                  User.pages_version).where(User.username == username, User.disabled == db.false())
+
+
+def db_get_user_profile(username):
+    """ UserProfile for an active (not disabled) user, or None. Loader for identity.user_cache. """
+
+    shard_router.use_shard(username)
+    row = db.session.execute(user_profile_statement(username)).first()
+
+    return UserProfile(*row) if row else None
+
+
+def db_check_availability(username=None, email=None):
+    """ Whether username and / or email are free to register. Returns {"username": bool,
+        "email": bool} with a key for each value given, True when available.
+
+        Every value is looked up with an existence query on the primary key / unique email
+        index, so names created by other workers and processes are seen at once. A free answer
+        is advice only - the unique constraints decide when the row is inserted.
+    """
+
+    results = {}
+
+    # with sharding only the user directory knows every username and email
+    model = UserDirectory if shard_router.enabled else User
+
+    if (username is not None):
+        results["username"] = not db.session.query(exists().where(model.username == username)).scalar()
+
+    if (email is not None):
+        email = email.lower()
+        results["email"] = not db.session.query(exists().where(model.email == email)).scalar()
+
+    return results
+
+
+@on_primary
 def db_add_user(user_spec_in):
     """ Adds a user to the users table.
 
@@ -124,13 +628,46 @@ def db_add_user(user_spec_in):
     for key in user_spec_in.keys():
         user_data[key] = user_spec_in[key].strip()
 
-    new_user = User.register(user_data["username"], user_data["password"])
+    # turn away taken names before paying for a bcrypt hash
+    availability = db_check_availability(user_data["username"], user_data["email"])
+    for field in ("username", "email"):
+        if not availability[field]:
+            return {
+                "success": False,
+                "username": "",
+                "message": {
+                    "text": f"{field} '{user_data[field]}' already exists. Please select a different {field}",
+                    "severity": "error"
+                }
+            }
+
+    try:
+        new_user = User.register(user_data["username"], user_data["password"])
+
+    except HashingBusyError:
+        return {
+            "success": False,
+            "username": "",
+            "message": {
+                "text": "Registration is busy right now. Please try again in a moment.",
+                "severity": "error"
+            }
+        }
 
     new_user.email = user_data["email"].lower()
     new_user.first_name = user_data["first_name"]
     new_user.last_name = user_data["last_name"]
 
+    claimed = False
+
     try:
+        if shard_router.enabled:
+            # claim the username and email across all shards first; the directory's unique
+            #  constraints decide like the users table's do without sharding
+            claim_user_shard(new_user.username, new_user.email)
+            claimed = True
+            shard_router.use_shard(new_user.username, write=True)
+
         db.session.add(new_user)
         db.session.commit()
 
@@ -146,6 +683,8 @@ def db_add_user(user_spec_in):
     except IntegrityError as err:
 
         db.session.rollback()
+        if claimed:
+            release_user_shard(new_user.username)
 
         results = {"success": False}
 
@@ -170,6 +709,9 @@ def db_add_user(user_spec_in):
     except:
 
         db.session.rollback()
+        if claimed:
+            release_user_shard(new_user.username)
+
         results = {
             "success": False,
             "username": "",
@@ -182,180 +724,1205 @@ def db_add_user(user_spec_in):
     return results
 
 
-def db_add_feedback(feedback_in):
-    """ Adds feedback to the feedback table.
-
+def feedback_page_statement(username, after=None, before=None, per_page=20, model=None):
+    """ select() for one page of username's feedback ordered by id, using the (username, id)
+        index instead of OFFSET so every page costs the same as the first. One extra row is
+        selected to tell whether there is a further page. Shared by db_get_feedback_page and
+        the async views (asgi.py); shape the rows with feedback_page. model=FeedbackArchive
+        pages the archived feedback instead.
     """
 
-    # Take the values in feedback_in, move them into feedback_data and handle strip()
-    feedback_data = {}
-    errors = []
-
-    for key in feedback_in.keys():
-        feedback_data[key] = feedback_in[key].strip()
-        if (len(feedback_data[key]) == 0):
-            errors.append((key, f"{key} cannot be all spaces"))
-
-    if (len(errors) == 0):
+    model = model or Feedback
+    statement = select(model).where(model.username == username)
 
-        new_feedback = Feedback(
-            title=feedback_data["title"], content=feedback_data["content"], username=feedback_data["username"])
+    if (before is not None):
+        return statement.where(model.id < before).order_by(model.id.desc()).limit(per_page + 1)
 
-        try:
-            db.session.add(new_feedback)
-            db.session.commit()
+    if (after is not None):
+        statement = statement.where(model.id > after)
 
-            results = {
-                "success": True,
-                "messages": [("okay", f"Feedback '{new_feedback.title}' was created.")]
-            }
+    return statement.order_by(model.id).limit(per_page + 1)
 
-        except:
-            # future hook for integrity errors
 
-            db.session.rollback()
+def feedback_page(rows, after=None, before=None, per_page=20):
+    """ {"feedback": [Feedback, ...], "next": id or None, "prev": id or None} from the rows
+        selected by feedback_page_statement with the same arguments.
+    """
 
-            results = {
-                "success": False,
-                "messages": [("error", f"An error occurred. Feedback '{new_feedback.title}' was NOT created.")]
-            }
+    if (before is not None):
+        has_prev = len(rows) > per_page
+        rows = list(reversed(rows[:per_page]))
 
-    else:
-        # title and/or content were blank
-        results = {
-            "success": False,
-            "messages": errors
+        return {
+            "feedback": rows,
+            "next": rows[-1].id if rows else None,
+            "prev": rows[0].id if (rows and has_prev) else None
         }
 
-    return results
+    has_next = len(rows) > per_page
+    rows = rows[:per_page]
 
+    return {
+        "feedback": rows,
+        "next": rows[-1].id if (rows and has_next) else None,
+        "prev": rows[0].id if (rows and after is not None) else None
+    }
 
-def db_update_feedback(db_feedback, feedback_in):
-    """ Updates a feedback record in the feedback table.
 
-        db_feedback the Feedback database object that was used to prefetch the username.
-        feedback in contains the title and content from the form.
+def db_get_feedback_page(username, after=None, before=None, per_page=20):
+    """ Return one page of username's feedback ordered by id.
 
+        after: return the page that follows the feedback with this id.
+        before: return the page that precedes the feedback with this id.
+
+        Returns {"feedback": [Feedback, ...], "next": id or None, "prev": id or None} where
+        next and prev are the cursors for the after / before links.
     """
 
-    # Take the values in feedback_in, move them into feedback_data and handle strip()
-    feedback_data = {}
-    errors = []
+    shard_router.use_shard(username)
+    rows = db.session.execute(feedback_page_statement(username, after, before, per_page)).scalars().all()
 
-    for key in feedback_in.keys():
-        feedback_data[key] = feedback_in[key].strip()
-        if (len(feedback_data[key]) == 0):
-            errors.append((key, f"{key} cannot be all spaces"))
+    return feedback_page(rows, after, before, per_page)
 
-    if (len(errors) == 0):
 
-        # we looked up the feedback record in app for the user id confirmation. db_feedback
-        #  object was passed into the update function.
+def db_get_archived_feedback_page(username, after=None, before=None, per_page=20):
+    """ db_get_feedback_page for username's archived feedback """
 
-        db_feedback.title = feedback_data["title"]
-        db_feedback.content = feedback_data["content"]
+    shard_router.use_shard(username)
+    rows = db.session.execute(feedback_page_statement(
+        username, after, before, per_page, model=FeedbackArchive)).scalars().all()
 
-        try:
-            # db.session.add(db_feedback)
-            db.session.commit()
+    return feedback_page(rows, after, before, per_page)
 
-            results = {
-                "success": True,
-                "messages": [("okay", f"Feedback '{db_feedback.title}' was updated.")]
-            }
 
-        except:
-            # future hook for integrity errors
+def iter_user_feedback(username, batch_size=500):
+    """ Every piece of username's feedback as (id, title, content) rows ordered by id, fetched
+        batch_size rows at a time through a server side cursor, so the whole list can be
+        streamed without holding it in memory.
+    """
 
-            db.session.rollback()
+    shard_router.use_shard(username)
+    query = db.session.query(Feedback.id, Feedback.title, Feedback.content).filter(
+        Feedback.username == username).order_by(Feedback.id)
 
-            results = {
-                "success": False,
-                "messages": [("error", f"An error occurred. Feedback '{db_feedback.title}' was NOT updated.")]
-            }
+    return query.execution_options(stream_results=True).yield_per(batch_size)
 
-    else:
-        # title and/or content were blank
-        results = {
-            "success": False,
-            "messages": errors
-        }
 
-    return results
+def search_document(title, content):
+    """ tsvector expression for title and content (values or columns) on PostgreSQL """
 
+    return func.setweight(func.to_tsvector(SEARCH_CONFIG, title), "A").op("||")(
+        func.setweight(func.to_tsvector(SEARCH_CONFIG, content), "B"))
 
-def db_delete_feedback(db_feedback):
-    """ deletes a feedback record from the feedback table """
 
-    msg_title_hold = db_feedback.title
+def index_feedback(db_feedback):
+    """ Set db_feedback.search_vector from its current title and content. Only PostgreSQL
+        stores the vector; SQLite's FTS5 table is maintained by triggers.
+    """
 
-    db.session.delete(db_feedback)
+    if (db.engine.dialect.name == "postgresql"):
+        db_feedback.search_vector = search_document(db_feedback.title, db_feedback.content)
 
-    try:
-        db.session.commit()
 
-        results = {
-            "message": ("okay", f"'{msg_title_hold}' was deleted."),
-            "successful": True
-        }
+def index_unindexed_feedback(usernames):
+    """ Fill in search_vector for usernames' feedback that was inserted without one (bulk COPY). """
 
-    except:
-        db.session.rollback()
+    if (usernames and db.engine.dialect.name == "postgresql"):
+        Feedback.query.filter(Feedback.username.in_(usernames), Feedback.search_vector.is_(None)).update(
+            {"search_vector": search_document(Feedback.title, Feedback.content)}, synchronize_session=False)
 
-        results = {
-            "message": ("error", f"An error occurred. '{msg_title_hold}' was NOT deleted."),
-            "successful": False
-        }
 
-    return results
+def fts5_query(terms):
+    """ Quote each search term so FTS5 treats the input as plain words, all of which must match. """
 
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms.split())
 
-def db_delete_user(username):
-    """ deletes a user record from the users table and feedback for the user from 
-        the feedback table. 
+
+def feedback_search_statement(username, terms, page, per_page, dialect_name):
+    """ select() for one page of username's feedback matching all of the words in terms, best
+        match first, plus one row to tell whether there is a further page. Uses the GIN index
+        on PostgreSQL and the FTS5 table on SQLite, so the cost follows the number of matches
+        rather than the size of the feedback table. terms must not be blank.
     """
 
-    results = {"messages": []}
+    statement = select(Feedback).where(Feedback.username == username)
 
-    # delete all of username's feedback
-    nbr_of_feedbacks = Feedback.query.filter_by(username=username).delete()
-    if (nbr_of_feedbacks > 0):
-        try:
-            db.session.commit()
-            if (nbr_of_feedbacks == 1):
-                results["messages"].append(
-                    ("okay", "1 piece of feedback was deleted."))
+    if (dialect_name == "postgresql"):
+        tsquery = func.plainto_tsquery(SEARCH_CONFIG, terms)
+        statement = statement.where(Feedback.search_vector.op("@@")(tsquery)).order_by(
+            func.ts_rank(Feedback.search_vector, tsquery).desc(), Feedback.id.desc())
+    else:
+        feedback_fts = table("feedback_fts", column("rowid"))
+        # bm25 is smaller for better matches; title hits count double
+        statement = statement.join(feedback_fts, feedback_fts.c.rowid == Feedback.id).where(
+            text("feedback_fts MATCH :terms").bindparams(terms=fts5_query(terms))).order_by(
+            text("bm25(feedback_fts, 2.0, 1.0)"), Feedback.id.desc())
 
-            else:
-                results["messages"].append(
-                    ("okay", f"{nbr_of_feedbacks} pieces of feedback were deleted."))
+    return statement.offset((page - 1) * per_page).limit(per_page + 1)
 
-        except:
-            db.session.rollback()
-            # An error occurred while deleting x pieces of feedback. Delete of username did NOT occur.
-            results["successful"] = False
 
-            if (nbr_of_feedbacks == 1):
-                results["messages"].append(
-                    ("error", f"An error occurred while deleting 1 piece of feedback. Delete of {username} did NOT occur."))
-            else:
-                results["messages"].append(
-                    ("error", f"An error occurred while deleting {nbr_of_feedbacks} pieces of feedback. Delete of {username} did NOT occur."))
+def feedback_search_page(rows, page, per_page):
+    """ {"feedback": [Feedback, ...], "page": page, "next": page or None, "prev": page or None}
+        from the rows selected by feedback_search_statement.
+    """
+
+    return {
+        "feedback": rows[:per_page],
+        "page": page,
+        "next": page + 1 if len(rows) > per_page else None,
+        "prev": page - 1 if page > 1 else None
+    }
+
+
+def db_search_feedback(username, terms, page=1, per_page=20):
+    """ Search username's feedback titles and content for all of the words in terms, best
+        match first.
+
+        Returns {"feedback": [Feedback, ...], "page": page, "next": page or None, "prev": page or None}
+    """
+
+    if not terms.split():
+        return feedback_search_page([], page, per_page)
+
+    shard_router.use_shard(username)
+    rows = db.session.execute(feedback_search_statement(
+        username, terms, page, per_page, db.engine.dialect.name)).scalars().all()
+
+    return feedback_search_page(rows, page, per_page)
+
+
+def record_feedback_event(event_type, db_feedback):
+    """ Append an event for db_feedback to the outbox in the caller's transaction. db_feedback
+        must be flushed so its id and version are current.
+    """
+
+    if current_app.config["FEEDBACK_EVENTS_ENABLED"]:
+        db.session.add(FeedbackEvent(event_type=event_type, feedback_id=db_feedback.id,
+                                     username=db_feedback.username, title=db_feedback.title,
+                                     content=db_feedback.content, version=db_feedback.version))
+
+
+def record_feedback_deletes(*criteria, source=None):
+    """ Append delete events for the feedback matching criteria with one INSERT ... SELECT, in
+        the caller's transaction and ahead of the DELETE itself. source=FeedbackArchive records
+        deletes of archived feedback.
+    """
+
+    source = source or Feedback
+
+    if current_app.config["FEEDBACK_EVENTS_ENABLED"]:
+        db.session.execute(insert(FeedbackEvent).from_select(
+            ["event_type", "feedback_id", "username", "title", "content", "version", "created_at"],
+            select(literal("delete"), source.id, source.username, source.title, source.content,
+                   source.version, literal(datetime.utcnow(), db.DateTime)).where(*criteria).order_by(source.id)))
+
+
+def count_feedback(username, change):
+    """ Add change to username's feedback_count, stamp last_feedback_at and bump pages_version.
+        Runs in the caller's transaction so the counter commits or rolls back with the feedback
+        rows.
+    """
+
+    User.query.filter_by(username=username).update(
+        {"feedback_count": User.feedback_count + change, "last_feedback_at": db.func.now(),
+         "pages_version": User.pages_version + 1},
+        synchronize_session=False)
+
+
+def feedback_changed(username):
+    """ Drop the cached feedback pages and profile (with its feedback_count) for username. """
+
+    render_cache.bump(username)
+    user_cache.invalidate(username)
+
+
+@on_primary
+def db_record_login(username):
+    """ Stamp username's last_login_at """
+
+    try:
+        shard_router.use_shard(username, write=True)
+    except ShardMovingError:
+        # not worth holding up the login for
+        return
+
+    User.query.filter_by(username=username).update({"last_login_at": db.func.now()},
+                                                   synchronize_session=False)
+    try:
+        db.session.commit()
+    except:
+        db.session.rollback()
+
+
+def reconcile_feedback_counts(batch_size=1000, report=None):
+    """ Recount feedback for every user, batch_size users per transaction, and fix the
+        feedback_count values that drifted. report(username, stored, actual) is called for each
+        fix. Returns the number of users fixed.
+    """
+
+    return sum(reconcile_shard_feedback_counts(batch_size, report) for shard in shard_router.each_shard())
+
+
+def reconcile_shard_feedback_counts(batch_size, report):
+    """ reconcile_feedback_counts for the users of the current shard """
+
+    fixed = 0
+    last_username = None
+
+    while True:
+        query = db.session.query(User.username, User.feedback_count).order_by(User.username)
+        if (last_username is not None):
+            query = query.filter(User.username > last_username)
+        stored = dict(query.limit(batch_size).all())
+
+        if not stored:
+            return fixed
+
+        last_username = max(stored)
+
+        # feedback_count covers live and archived feedback
+        actual = {}
+        for model in (Feedback, FeedbackArchive):
+            for (username, feedback_count) in db.session.query(model.username, func.count(model.id)).filter(
+                    model.username.in_(stored)).group_by(model.username):
+                actual[username] = actual.get(username, 0) + feedback_count
+
+        for (username, feedback_count) in stored.items():
+            if (feedback_count != actual.get(username, 0)):
+                # recount in the UPDATE so writes since the batch was read are not lost
+                User.query.filter_by(username=username).update(
+                    {"feedback_count": select(func.count(Feedback.id)).where(
+                        Feedback.username == username).scalar_subquery() +
+                     select(func.count(FeedbackArchive.id)).where(
+                        FeedbackArchive.username == username).scalar_subquery(),
+                     "pages_version": User.pages_version + 1},
+                    synchronize_session=False)
+                fixed += 1
+                if report:
+                    report(username, feedback_count, actual.get(username, 0))
+
+        db.session.commit()
+
+        for username in stored:
+            user_cache.invalidate(username)
+
+
+def archive_feedback(older_than_days, batch_size=1000, report=None):
+    """ Move feedback created more than older_than_days ago from feedback to feedback_archive,
+        oldest first, batch_size rows per transaction so the live table is never locked for
+        long. Each row is copied and deleted in the same transaction; on PostgreSQL rows being
+        updated right now are skipped (FOR UPDATE SKIP LOCKED) and picked up by the next run.
+        report(moved so far) is called after each batch. Returns the number of rows moved.
+    """
+
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    moved = 0
+
+    for shard in shard_router.each_shard():
+        moved = archive_shard_feedback(cutoff, batch_size, report, moved)
+
+    return moved
+
+
+def archive_shard_feedback(cutoff, batch_size, report, moved):
+    """ archive_feedback for the current shard. moved is the count so far; returns the new count. """
+
+    columns = ["id", "title", "content", "username", "version", "created_at", "updated_at"]
+
+    while True:
+        rows = db.session.query(Feedback.id, Feedback.username).filter(
+            Feedback.created_at < cutoff).order_by(Feedback.created_at, Feedback.id).limit(
+            batch_size).with_for_update(skip_locked=True).all()
+        if not rows:
+            return moved
+
+        ids = [feedback_id for (feedback_id, username) in rows]
+
+        db.session.execute(insert(FeedbackArchive).from_select(
+            columns + ["archived_at"],
+            select(*[getattr(Feedback, name) for name in columns],
+                   literal(datetime.utcnow(), db.DateTime)).where(Feedback.id.in_(ids))))
+        Feedback.query.filter(Feedback.id.in_(ids)).delete(synchronize_session=False)
+
+        # the cached profile pages no longer match the live table. pages_version reaches the
+        #  web workers; the bump only this process' own cache.
+        usernames = set(username for (feedback_id, username) in rows)
+        User.query.filter(User.username.in_(usernames)).update(
+            {"pages_version": User.pages_version + 1}, synchronize_session=False)
+        db.session.commit()
+
+        for username in usernames:
+            render_cache.bump(username)
+
+        moved += len(ids)
+        if report:
+            report(moved)
+
+
+def clean_feedback_fields(feedback_in):
+    """ Strip the values in feedback_in. Returns (feedback_data, errors) where errors is a list
+        of (field, message) for values that were all spaces or not strings.
+    """
+
+    # Take the values in feedback_in, move them into feedback_data and handle strip()
+    feedback_data = {}
+    errors = []
+
+    for key in feedback_in.keys():
+        if not isinstance(feedback_in[key] or "", str):
+            feedback_data[key] = ""
+            errors.append((key, f"{key} must be a string"))
+            continue
+
+        feedback_data[key] = (feedback_in[key] or "").strip()
+        if (len(feedback_data[key]) == 0):
+            errors.append((key, f"{key} cannot be all spaces"))
+
+    return (feedback_data, errors)
+
+
+def other_shard_feedback_owners(feedback_ids):
+    """ {feedback_id: username} for those of feedback_ids that live on another shard than the
+        current one. Lets a miss on the caller's shard tell "not_owner" from "not_found" like an
+        unsharded database does. Empty without sharding.
+    """
+
+    owners = {}
+    if not (shard_router.enabled and feedback_ids):
+        return owners
+
+    current = g.get("db_shard")
+    for shard in shard_router.each_shard():
+        if (g.db_shard != current):
+            owners.update(db.session.query(Feedback.id, Feedback.username).filter(Feedback.id.in_(feedback_ids)))
+
+    return owners
+
+
+def get_owned_feedback(feedback_id, username):
+    """ Look up feedback_id for username. Returns (db_feedback, error) where error is None when
+        username wrote the feedback, "not_found" when feedback_id does not exist and
+        "not_owner" when it belongs to someone else.
+    """
+
+    shard_router.use_shard(username)
+    db_feedback = Feedback.query.get(feedback_id)
+
+    if (db_feedback is None):
+        if other_shard_feedback_owners([feedback_id]):
+            return (None, "not_owner")
+        return (None, "not_found")
+
+    if (db_feedback.username != username):
+        return (None, "not_owner")
+
+    return (db_feedback, None)
+
+
+@on_primary
+def db_add_feedback(feedback_in):
+    """ Adds feedback to the feedback table.
+
+    """
+
+    (feedback_data, errors) = clean_feedback_fields(feedback_in)
+
+    if (len(errors) == 0):
+
+        shard_router.use_shard(feedback_data["username"], write=True)
+
+        new_feedback = Feedback(
+            title=feedback_data["title"], content=feedback_data["content"], username=feedback_data["username"])
+        assign_feedback_ids([new_feedback])
+        index_feedback(new_feedback)
+
+        try:
+            db.session.add(new_feedback)
+            db.session.flush()
+            record_feedback_event("create", new_feedback)
+            count_feedback(new_feedback.username, 1)
+            db.session.commit()
+
+            feedback_changed(new_feedback.username)
+
+            results = {
+                "success": True,
+                "feedback": new_feedback,
+                "messages": [("okay", f"Feedback '{new_feedback.title}' was created.")]
+            }
+
+        except:
+            # future hook for integrity errors
+
+            db.session.rollback()
+
+            results = {
+                "success": False,
+                "messages": [("error", f"An error occurred. Feedback '{new_feedback.title}' was NOT created.")]
+            }
+
+    else:
+        # title and/or content were blank
+        results = {
+            "success": False,
+            "messages": errors
+        }
+
+    return results
+
+
+FEEDBACK_WRITE_COLUMNS = (Feedback.id, Feedback.title, Feedback.content, Feedback.username, Feedback.version)
+
+
+def owned_feedback_criteria(feedback_id, username, expected_version=None):
+    """ WHERE clause matching feedback_id only when username wrote it and, when expected_version
+        is given, nobody changed it since that version was read.
+    """
+
+    criteria = [Feedback.id == feedback_id, Feedback.username == username]
+    if (expected_version is not None):
+        criteria.append(Feedback.version == expected_version)
+
+    return criteria
+
+
+def diagnose_feedback_miss(feedback_id, username):
+    """ Why a conditional write on feedback_id matched no row: "not_found", "not_owner" or, when
+        the row is username's, "conflict" (its version moved on). Only runs on the failure path.
+    """
+
+    row = db.session.execute(select(Feedback.username).where(Feedback.id == feedback_id)).first()
+
+    if (row is None):
+        return "not_owner" if other_shard_feedback_owners([feedback_id]) else "not_found"
+
+    if (row.username != username):
+        return "not_owner"
+
+    return "conflict"
+
+
+def write_returning(statement, feedback_id):
+    """ Run a conditional UPDATE / DELETE on feedback_id and return the row it changed as
+        FEEDBACK_WRITE_COLUMNS (for a DELETE, as it was), or None when nothing matched. One
+        round trip with RETURNING. Dialects without it (SQLite) read the row in the same
+        transaction: after an UPDATE, which holds the write lock, and before a DELETE, whose
+        row count then confirms it.
+    """
+
+    if db.engine.dialect.full_returning:
+        return db.session.execute(statement.returning(*FEEDBACK_WRITE_COLUMNS)).first()
+
+    lookup = select(*FEEDBACK_WRITE_COLUMNS).where(Feedback.id == feedback_id)
+
+    if (statement.is_delete):
+        row = db.session.execute(lookup).first()
+        return row if db.session.execute(statement).rowcount else None
+
+    return db.session.execute(lookup).first() if db.session.execute(statement).rowcount else None
+
+
+@on_primary
+def db_update_feedback(feedback_id, username, feedback_in, expected_version=None):
+    """ Updates a feedback record in the feedback table.
+
+        One conditional UPDATE ... WHERE id = :id AND username = :username [AND version =
+        :expected_version] RETURNING checks ownership, catches a lost update and bumps the version,
+        without loading the row first. feedback_in contains the title and content from the form.
+
+        Returns {"success": bool, "error": None, "invalid", "not_found", "not_owner" or
+        "conflict", "feedback": Feedback (not attached to the session) or None, "messages": [...]}
+    """
+
+    (feedback_data, errors) = clean_feedback_fields(feedback_in)
+
+    if (len(errors) == 0):
+
+        shard_router.use_shard(username, write=True)
+
+        values = {"title": feedback_data["title"], "content": feedback_data["content"],
+                  "version": Feedback.version + 1}
+        if (db.engine.dialect.name == "postgresql"):
+            values["search_vector"] = search_document(feedback_data["title"], feedback_data["content"])
+
+        statement = update(Feedback).where(
+            *owned_feedback_criteria(feedback_id, username, expected_version)).values(values)
+
+        try:
+            row = write_returning(statement, feedback_id)
+
+            if row is None:
+                error = diagnose_feedback_miss(feedback_id, username)
+                db.session.rollback()
+
+                messages = {
+                    "not_found": "The requested feedback was not found and was NOT updated.",
+                    "not_owner": "You cannot edit another users feedback.",
+                    "conflict": f"Feedback '{feedback_data['title']}' was changed by another request and was NOT updated."
+                }
+
+                return {
+                    "success": False,
+                    "error": error,
+                    "feedback": None,
+                    "messages": [("error", messages[error])]
+                }
+
+            record_feedback_event("update", row)
+            count_feedback(username, 0)
+            db.session.commit()
+
+            feedback_changed(username)
+
+            results = {
+                "success": True,
+                "error": None,
+                "feedback": Feedback(**row._mapping),
+                "messages": [("okay", f"Feedback '{row.title}' was updated.")]
+            }
+
+        except:
+            # future hook for integrity errors
+
+            db.session.rollback()
+
+            results = {
+                "success": False,
+                "error": "failed",
+                "feedback": None,
+                "messages": [("error", f"An error occurred. Feedback '{feedback_data['title']}' was NOT updated.")]
+            }
+
+    else:
+        # title and/or content were blank
+        results = {
+            "success": False,
+            "error": "invalid",
+            "feedback": None,
+            "messages": errors
+        }
+
+    return results
+
+
+@on_primary
+def db_delete_feedback(feedback_id, username, expected_version=None):
+    """ deletes a feedback record from the feedback table with one conditional
+        DELETE ... WHERE id = :id AND username = :username [AND version = :expected_version] RETURNING.
+
+        Returns {"successful": bool, "error": None, "not_found", "not_owner", "conflict" or
+        "failed", "message": (severity, text)}
+    """
+
+    shard_router.use_shard(username, write=True)
+    statement = delete(Feedback).where(*owned_feedback_criteria(feedback_id, username, expected_version))
+
+    try:
+        row = write_returning(statement, feedback_id)
+
+        if row is None:
+            error = diagnose_feedback_miss(feedback_id, username)
+            db.session.rollback()
+
+            messages = {
+                "not_found": "The requested feedback was not found and was NOT deleted.",
+                "not_owner": "You cannot delete another users feedback.",
+                "conflict": "The feedback was changed by another request and was NOT deleted."
+            }
+
+            return {
+                "message": ("error", messages[error]),
+                "error": error,
+                "successful": False
+            }
+
+        record_feedback_event("delete", row)
+        count_feedback(username, -1)
+        db.session.commit()
+
+        feedback_changed(username)
+
+        results = {
+            "message": ("okay", f"'{row.title}' was deleted."),
+            "error": None,
+            "successful": True
+        }
+
+    except:
+        db.session.rollback()
+
+        results = {
+            "message": ("error", "An error occurred. The feedback was NOT deleted."),
+            "error": "failed",
+            "successful": False
+        }
+
+    return results
+
+
+@on_primary
+def db_add_feedback_batch(username, feedback_list):
+    """ Adds several pieces of feedback for username in one transaction.
+
+        feedback_list is a list of {"title": ..., "content": ...}. Each item is validated like
+        db_add_feedback; the valid ones are inserted together (one multi row INSERT on
+        PostgreSQL) and the rest are reported.
+
+        Returns {"success": bool, "created": n, "failed": n,
+                 "items": [{"success": bool, "feedback": Feedback or None, "messages": [...]}, ...]}
+        with items in the order of feedback_list.
+    """
+
+    items = []
+    new_feedback = []
+
+    for feedback_in in feedback_list:
+        (feedback_data, errors) = clean_feedback_fields(
+            {"title": feedback_in.get("title"), "content": feedback_in.get("content")})
+
+        if (len(errors) == 0):
+            db_feedback = Feedback(title=feedback_data["title"], content=feedback_data["content"],
+                                   username=username)
+            new_feedback.append(db_feedback)
+            items.append({"success": True, "feedback": db_feedback,
+                          "messages": [("okay", f"Feedback '{db_feedback.title}' was created.")]})
+        else:
+            items.append({"success": False, "feedback": None,
+                          "messages": [("error", msg) for (field, msg) in errors]})
+
+    results = {"success": True, "items": items,
+               "created": len(new_feedback), "failed": len(items) - len(new_feedback)}
+
+    if not new_feedback:
+        return results
+
+    shard_router.use_shard(username, write=True)
+    assign_feedback_ids(new_feedback)
+
+    try:
+        db.session.add_all(new_feedback)
+        db.session.flush()
+        for db_feedback in new_feedback:
+            record_feedback_event("create", db_feedback)
+        # per row search vectors would stop the ORM batching the INSERT, so set them afterwards
+        #  in one UPDATE
+        index_unindexed_feedback({username})
+        count_feedback(username, len(new_feedback))
+        db.session.commit()
+
+        feedback_changed(username)
+
+    except:
+        db.session.rollback()
+
+        results["success"] = False
+        results["created"] = 0
+        results["failed"] = len(items)
+        for item in items:
+            if (item["success"]):
+                item["success"] = False
+                item["feedback"] = None
+                item["messages"] = [("error", "An error occurred. The feedback was NOT created.")]
+
+    return results
+
+
+@on_primary
+def db_delete_feedback_batch(username, feedback_ids):
+    """ Deletes several pieces of username's feedback. Ownership of the whole set is checked with
+        one query and the owned feedback is removed with one DELETE in one transaction.
+
+        Returns {"success": bool, "deleted": n, "failed": n,
+                 "items": [{"id": id, "success": bool, "error": None | "not_found" | "not_owner" | "failed",
+                            "message": (severity, text)}, ...]}
+        with items in the order of feedback_ids (duplicates are dropped).
+    """
+
+    feedback_ids = list(dict.fromkeys(feedback_ids))
+
+    shard_router.use_shard(username, write=True)
+    found = {feedback_id: (owner, title) for (feedback_id, owner, title) in db.session.query(
+        Feedback.id, Feedback.username, Feedback.title).filter(Feedback.id.in_(feedback_ids))}
+    found.update((feedback_id, (owner, None)) for (feedback_id, owner) in other_shard_feedback_owners(
+        [feedback_id for feedback_id in feedback_ids if feedback_id not in found]).items())
+
+    items = []
+    for feedback_id in feedback_ids:
+        if (feedback_id not in found):
+            items.append({"id": feedback_id, "success": False, "error": "not_found",
+                          "message": ("error", f"Feedback {feedback_id} was not found and was NOT deleted.")})
+        elif (found[feedback_id][0] != username):
+            items.append({"id": feedback_id, "success": False, "error": "not_owner",
+                          "message": ("error", "You cannot delete another users feedback.")})
+        else:
+            items.append({"id": feedback_id, "success": True, "error": None,
+                          "message": ("okay", f"'{found[feedback_id][1]}' was deleted.")})
+
+    owned_ids = [item["id"] for item in items if item["success"]]
+    results = {"success": True, "items": items,
+               "deleted": len(owned_ids), "failed": len(items) - len(owned_ids)}
+
+    if not owned_ids:
+        return results
+
+    try:
+        # username is repeated so feedback that changed hands since the check is never deleted
+        record_feedback_deletes(Feedback.id.in_(owned_ids), Feedback.username == username)
+        nbr_deleted = Feedback.query.filter(Feedback.id.in_(owned_ids), Feedback.username == username).delete(
+            synchronize_session=False)
+        count_feedback(username, -nbr_deleted)
+        db.session.commit()
+
+        feedback_changed(username)
 
-            # return -- user had feedback that could not get deleted. Do not delete the user.
+    except:
+        db.session.rollback()
+
+        results["success"] = False
+        results["deleted"] = 0
+        results["failed"] = len(items)
+        for item in items:
+            if (item["success"]):
+                item["success"] = False
+                item["error"] = "failed"
+                item["message"] = ("error", f"An error occurred. '{found[item['id']][1]}' was NOT deleted.")
+
+    return results
+
+
+def feedback_count_message(nbr_of_feedbacks):
+    """ "1 piece of feedback" / "n pieces of feedback" """
+
+    if (nbr_of_feedbacks == 1):
+        return "1 piece of feedback"
+
+    return f"{nbr_of_feedbacks} pieces of feedback"
+
+
+@on_primary
+def db_delete_user(username):
+    """ deletes a user record from the users table and feedback for the user from 
+        the feedback table. 
+
+        The feedback goes with the user through the ON DELETE CASCADE foreign key, so a normal
+        account is removed by one DELETE in one transaction. Accounts with more than
+        USER_PURGE_THRESHOLD pieces of feedback are disabled right away instead and their
+        feedback is purged in chunks by a background thread (see purge_user).
+    """
+
+    results = {"messages": []}
+
+    # cached feedback pages and profile for username are stale whether or not the deletes
+    #  below succeed
+    render_cache.bump(username)
+    user_cache.invalidate(username)
+
+    shard_router.use_shard(username, write=True)
+
+    nbr_of_feedbacks = db.session.query(User.feedback_count).filter_by(username=username).scalar()
+
+    if (nbr_of_feedbacks is None):
+        results["successful"] = False
+        results["messages"].append(("error", f"User '{username}' was not found and was NOT deleted."))
+        return results
+
+    if (nbr_of_feedbacks > current_app.config["USER_PURGE_THRESHOLD"]):
+        # large account - disable now, purge later so the feedback table is not locked for
+        #  the length of this request.
+        User.query.filter_by(username=username).update({"disabled": True})
+        if current_app.config["JOBS_ENABLED"]:
+            # queued with the disable, so every disabled user has a purge job
+            enqueue_job("purge_user", {"username": username})
+        try:
+            db.session.commit()
+
+        except:
+            db.session.rollback()
+            results["successful"] = False
+            results["messages"].append(
+                ("error", f"An error occurred while deleting {username}. {username} was NOT deleted."))
             return results
 
-    # delete username
-    User.query.filter_by(username=username).delete()
+        if not current_app.config["JOBS_ENABLED"]:
+            schedule_purge(username)
+
+        results["successful"] = True
+        results["messages"].append(
+            ("okay", f"User '{username}' was disabled. {feedback_count_message(nbr_of_feedbacks)} will be deleted in the background."))
+        return results
+
     try:
+        # delete username - live and archived feedback cascade in the database, after their
+        #  delete events are recorded
+        record_feedback_deletes(Feedback.username == username)
+        record_feedback_deletes(FeedbackArchive.username == username, source=FeedbackArchive)
+        nbr_of_users = User.query.filter_by(username=username).delete()
         db.session.commit()
+        if nbr_of_users:
+            release_user_shard(username)
         results["successful"] = True
+        if (nbr_of_feedbacks > 0):
+            results["messages"].append(
+                ("okay", f"{feedback_count_message(nbr_of_feedbacks)} {'was' if nbr_of_feedbacks == 1 else 'were'} deleted."))
         results["messages"].append(("okay", f"User '{username}' was deleted."))
 
     except:
         db.session.rollback()
         results["successful"] = False
         results["messages"].append(
-            ("error", f"An error occurred while deleting {username}. {username} was NOT deleted."))
+            ("error", f"An error occurred while deleting {username} and {feedback_count_message(nbr_of_feedbacks)}. {username} was NOT deleted."))
 
     return results
+
+
+def enqueue_job(name, payload=None, delay=0, max_attempts=None):
+    """ Add a job for the jobs.py handler name to the session. It is queued when the caller
+        commits, together with the rest of the transaction. Returns the Job.
+    """
+
+    job = Job(name=name, payload=json.dumps(payload or {}, sort_keys=True),
+              max_attempts=max_attempts or current_app.config["JOB_MAX_ATTEMPTS"],
+              run_at=datetime.utcnow() + timedelta(seconds=delay))
+    db.session.add(job)
+
+    return job
+
+
+def schedule_purge(username):
+    """ Purge a disabled user's feedback and then the user on a background thread. Without
+        JOBS_ENABLED; otherwise db_delete_user queues a purge_user job for `flask run-jobs`.
+    """
+
+    purge_executor.submit(purge_user, current_app._get_current_object(), username)
+
+
+def purge_user(app, username, progress=None):
+    """ Delete username's feedback USER_PURGE_CHUNK_SIZE rows per transaction, then delete the
+        user. Each chunk is short so other writers to the feedback table are never held up
+        for long. Every chunk commits with the user's lower feedback_count, which is what
+        `flask purge-status` shows; it is also logged and passed to progress(status) when given.
+
+        Returns the final status {"username", "deleted", "chunks", "state"}.
+    """
+
+    status = {"username": username, "deleted": 0, "chunks": 0, "state": "running"}
+
+    with app.app_context():
+        chunk_size = app.config["USER_PURGE_CHUNK_SIZE"]
+
+        try:
+            shard_router.use_shard(username, write=True)
+
+            for model in (Feedback, FeedbackArchive):
+                while True:
+                    ids = [feedback_id for (feedback_id,) in db.session.query(model.id).filter(
+                        model.username == username).order_by(model.id).limit(chunk_size)]
+                    if not ids:
+                        break
+
+                    record_feedback_deletes(model.id.in_(ids), source=model)
+                    model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+                    count_feedback(username, -len(ids))
+                    db.session.commit()
+
+                    status["deleted"] += len(ids)
+                    status["chunks"] += 1
+                    app.logger.info(f"purge {username}: chunk {status['chunks']}, {status['deleted']} deleted")
+                    if progress:
+                        progress(status)
+
+            nbr_of_users = User.query.filter_by(username=username).delete()
+            db.session.commit()
+            if nbr_of_users:
+                release_user_shard(username)
+            status["state"] = "done"
+
+        except Exception:
+            db.session.rollback()
+            status["state"] = "failed"
+            app.logger.exception(f"purge of {username} failed after {status['deleted']} rows")
+
+        finally:
+            db.session.remove()
+
+    render_cache.bump(username)
+    user_cache.invalidate(username)
+    app.logger.info(
+        f"purge {username}: {status['state']}, {feedback_count_message(status['deleted'])} deleted in {status['chunks']} chunks")
+
+    return status
+
+
+# Sharding (sharding.py)
+
+def lookup_user_shard(username):
+    """ shard_router loader: (shard, moving) of username from the user directory, or None.
+        Always reads the primary, on a connection of its own.
+    """
+
+    with db.engine.connect() as connection:
+        row = connection.execute(select(UserDirectory.shard, UserDirectory.moving).where(
+            UserDirectory.username == username)).first()
+
+    return (row.shard, row.moving) if row else None
+
+
+def claim_user_shard(username, email):
+    """ Record a new user in the user directory, on its hash placement, and commit. Raises
+        IntegrityError when the username or email is taken on any shard.
+    """
+
+    db.session.add(UserDirectory(username=username, email=email, shard=shard_router.placement(username)))
+    db.session.commit()
+    shard_router.forget(username)
+
+
+def release_user_shard(username):
+    """ Drop username from the user directory after the user was deleted, or was not created. """
+
+    if not shard_router.enabled:
+        return
+
+    try:
+        UserDirectory.query.filter_by(username=username).delete()
+        db.session.commit()
+    except:
+        db.session.rollback()
+        current_app.logger.exception(f"{username} could not be removed from the user directory")
+
+    shard_router.forget(username)
+
+
+def reserve_id_block(name, size):
+    """ Reserve size ids of the id_blocks counter name in a transaction of its own on the
+        primary. Returns (first id, end), end excluded.
+    """
+
+    with db.engine.begin() as connection:
+        # the UPDATE locks the row until commit, so the value read back is this block's end
+        updated = connection.execute(update(IdBlock).where(IdBlock.name == name).values(
+            next_value=IdBlock.next_value + size)).rowcount
+        if not updated:
+            raise ShardingError(f"no '{name}' id block. Run `flask init-shards`.")
+
+        end = connection.execute(select(IdBlock.next_value).where(IdBlock.name == name)).scalar()
+
+    return (end - size, end)
+
+
+def allocate_feedback_ids(count):
+    """ count unused feedback ids, from the block this worker reserved (SHARD_ID_BLOCK_SIZE ids
+        at a time), so feedback ids stay unique across shards.
+    """
+
+    block_size = max(current_app.config["SHARD_ID_BLOCK_SIZE"], count)
+    feedback_ids = []
+
+    with feedback_id_lock:
+        block = feedback_id_blocks.setdefault(str(db.engine.url), {"next": 0, "end": 0})
+
+        while (len(feedback_ids) < count):
+            if (block["next"] >= block["end"]):
+                (block["next"], block["end"]) = reserve_id_block("feedback", block_size)
+
+            taken = min(count - len(feedback_ids), block["end"] - block["next"])
+            feedback_ids.extend(range(block["next"], block["next"] + taken))
+            block["next"] += taken
+
+    return feedback_ids
+
+
+def assign_feedback_ids(feedback_list):
+    """ With sharding, give the new Feedback objects in feedback_list their ids before they are
+        added. Without it the database assigns them.
+    """
+
+    if shard_router.enabled:
+        for (db_feedback, feedback_id) in zip(feedback_list, allocate_feedback_ids(len(feedback_list))):
+            db_feedback.id = feedback_id
+
+
+def create_shard_tables():
+    """ Create the sharded tables, with their indexes and triggers, on every shard that lacks them """
+
+    tables = [db.metadata.tables[name] for name in sorted(SHARDED_TABLES)]
+
+    for engine in shard_router.shard_engines(db):
+        db.metadata.create_all(bind=engine, tables=tables)
+
+
+def rebuild_user_directory(batch_size=1000):
+    """ Add the users of every shard that are missing from the user directory. Returns the
+        number added.
+    """
+
+    added = 0
+
+    for shard in shard_router.each_shard():
+        last_username = None
+
+        while True:
+            query = db.session.query(User.username, User.email).order_by(User.username)
+            if (last_username is not None):
+                query = query.filter(User.username > last_username)
+            users = query.limit(batch_size).all()
+
+            if not users:
+                break
+
+            last_username = users[-1].username
+
+            known = {username for (username,) in db.session.query(UserDirectory.username).filter(
+                UserDirectory.username.in_([user.username for user in users]))}
+            missing = [user for user in users if user.username not in known]
+
+            db.session.add_all([UserDirectory(username=user.username, email=user.email, shard=shard)
+                                for user in missing])
+            db.session.commit()
+            added += len(missing)
+
+    return added
+
+
+def init_feedback_id_block():
+    """ Start the feedback id allocator above every feedback id on the shards. Returns the next id. """
+
+    highest = 0
+    for shard in shard_router.each_shard():
+        for model in (Feedback, FeedbackArchive):
+            highest = max(highest, db.session.query(func.max(model.id)).scalar() or 0)
+
+    id_block = IdBlock.query.get("feedback")
+    if id_block is None:
+        id_block = IdBlock(name="feedback", next_value=highest + 1)
+        db.session.add(id_block)
+    else:
+        id_block.next_value = max(id_block.next_value, highest + 1)
+
+    next_value = id_block.next_value
+    db.session.commit()
+
+    return next_value
+
+
+def copy_user_rows(username, source, target, chunk_size=1000):
+    """ Copy username's user row, feedback and archived feedback from shard source to shard
+        target, chunk_size rows per transaction. Leftovers of an interrupted copy on target are
+        removed first. Ids are kept.
+    """
+
+    shard_router.use_index(target)
+    User.query.filter_by(username=username).delete()
+    db.session.commit()
+
+    shard_router.use_index(source)
+    user_row = db.session.execute(select(User.__table__).where(User.username == username)).mappings().first()
+    if user_row is None:
+        return
+
+    # a new pages_version: web workers drop pages they cached from the old shard
+    shard_router.use_index(target)
+    db.session.execute(insert(User.__table__), [dict(user_row, pages_version=user_row["pages_version"] + 1)])
+    db.session.commit()
+
+    for model in (Feedback, FeedbackArchive):
+        last_id = 0
+
+        while True:
+            shard_router.use_index(source)
+            rows = db.session.execute(select(model.__table__).where(
+                model.username == username, model.id > last_id).order_by(model.id).limit(chunk_size)).mappings().all()
+            if not rows:
+                break
+
+            shard_router.use_index(target)
+            db.session.execute(insert(model.__table__), [dict(row) for row in rows])
+            db.session.commit()
+
+            last_id = rows[-1]["id"]
+
+
+def move_users(moves, report=None):
+    """ Move users to other shards while the app keeps running. moves is a list of (username,
+        target shard index).
+
+        The users are marked moving and the move waits SHARD_DIRECTORY_TTL for every worker to
+        see it, so writes are refused (ShardMovingError) while the rows are copied; reads carry
+        on from the old shard. Each user is then switched over in the directory and, after
+        another SHARD_DIRECTORY_TTL, removed from the old shard. An interrupted move can simply
+        be run again. report(username, source, target) is called per user switched. Returns the
+        number of users moved.
+    """
+
+    entries = {entry.username: entry for entry in UserDirectory.query.filter(
+        UserDirectory.username.in_([username for (username, target) in moves]))}
+    moves = [(username, target) for (username, target) in moves
+             if (username in entries and entries[username].shard != target)]
+
+    if not moves:
+        return 0
+
+    for (username, target) in moves:
+        entries[username].moving = True
+    db.session.commit()
+
+    time.sleep(shard_router.ttl)
+
+    sources = []
+    try:
+        for (username, target) in moves:
+            source = entries[username].shard
+            copy_user_rows(username, source, target)
+
+            entries[username].shard = target
+            entries[username].moving = False
+            db.session.commit()
+            sources.append((username, source))
+
+            shard_router.forget(username)
+            if report:
+                report(username, source, target)
+
+    finally:
+        db.session.rollback()
+        for (username, target) in moves:
+            entries[username].moving = False
+        db.session.commit()
+
+    # workers that still think a moved user is on the old shard read from it until their cache expires
+    time.sleep(shard_router.ttl)
+
+    for (username, source) in sources:
+        shard_router.use_index(source)
+        User.query.filter_by(username=username).delete()
+        db.session.commit()
+
+        render_cache.bump(username)
+        user_cache.invalidate(username)
+
+    shard_router.use_index(None)
+
+    return len(sources)
+
+
+def rebalance_shards(batch_size=100, report=None):
+    """ Move every user that is not on its hash placement there, batch_size users at a time
+        (see move_users). Run after adding shards to DB_SHARD_URIS. Returns the number moved.
+    """
+
+    moved = 0
+    last_username = None
+
+    while True:
+        query = UserDirectory.query.order_by(UserDirectory.username)
+        if (last_username is not None):
+            query = query.filter(UserDirectory.username > last_username)
+        entries = query.limit(batch_size).all()
+
+        if not entries:
+            return moved
+
+        last_username = entries[-1].username
+
+        moved += move_users([(entry.username, shard_router.placement(entry.username)) for entry in entries
+                             if (entry.shard != shard_router.placement(entry.username))], report=report)
@@ -0,0 +1,106 @@
+""" Cache of rendered profile page feedback sections.
+
+    Entries are keyed by username, a per-user version counter and the page being shown.
+    Every feedback write bumps the user's version, which makes all of that user's cached
+    pages unreachable at once - they are never rewritten, just aged out by the LRU. The
+    version counters live in their own store that is never evicted; losing a counter would
+    restart it at a value that old entries may still be cached under.
+
+    The counters only reach the processes sharing the backend, so the key also holds the
+    user's users.pages_version, which every feedback change bumps in the database. Changes
+    made elsewhere (the CLI, job workers, other workers with the memory backend) show up once
+    the worker's cached profile is reloaded, within USER_CACHE_TTL.
+
+        RENDER_CACHE_ENABLED     False turns the cache off.
+        RENDER_CACHE_BACKEND     "memory" (per worker, default) or "sqlite" (shared by the
+                                 workers on one host through RENDER_CACHE_PATH).
+        RENDER_CACHE_PATH        SQLite file for the sqlite backend.
+        RENDER_CACHE_MAX_BYTES   memory cap for cached html.
+"""
+
+import threading
+
+from store import make_store
+
+
+class RenderCache:
+    """ Versioned per-user cache of rendered html with hit / miss counters. """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.store = None
+        self.versions = None
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("RENDER_CACHE_ENABLED", True)
+        app.config.setdefault("RENDER_CACHE_BACKEND", "memory")
+        app.config.setdefault("RENDER_CACHE_PATH", None)
+        app.config.setdefault("RENDER_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+
+        self.enabled = app.config["RENDER_CACHE_ENABLED"]
+        self.store = make_store(app.config["RENDER_CACHE_BACKEND"],
+                                path=app.config["RENDER_CACHE_PATH"],
+                                max_bytes=app.config["RENDER_CACHE_MAX_BYTES"],
+                                table="render_cache")
+        self.versions = make_store(app.config["RENDER_CACHE_BACKEND"],
+                                   path=app.config["RENDER_CACHE_PATH"],
+                                   table="render_cache_versions")
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, username):
+        """ Current cache version for username. """
+
+        return self.versions.get(username) or 0
+
+    def bump(self, username):
+        """ Invalidate every cached page for username. Called after feedback writes. """
+
+        if self.versions is not None:
+            self.versions.incr(username)
+
+    def key(self, username, variant, pages_version=0):
+        """ Cache key for one rendering of username's feedback. pages_version is the user's
+            users.pages_version. Read the key BEFORE querying the database so a write that lands
+            during the render is not hidden by the entry.
+        """
+
+        return f"html:{username}:{pages_version}:{self.version(username)}:{variant}"
+
+    def get(self, key):
+        """ Return cached html for key or None. """
+
+        if not self.enabled:
+            return None
+
+        value = self.store.get(key)
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def set(self, key, html):
+        if self.enabled:
+            self.store.set(key, html)
+
+    def stats(self):
+        """ Hit / miss counters for this worker plus the store size. """
+
+        results = {"hits": self.hits, "misses": self.misses}
+        if self.store is not None:
+            results.update(self.store.stats())
+        return results
+
+
+render_cache = RenderCache()
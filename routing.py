@@ -0,0 +1,151 @@
+""" Read / write splitting between the primary database and read replicas.
+
+    DB_REPLICA_URIS lists replica database URIs (comma separated). Each becomes a
+    Flask-SQLAlchemy bind (replica0, replica1, ...) with the same engine options as the primary.
+    When it is empty everything runs on SQLALCHEMY_DATABASE_URI as before.
+
+    Each GET / HEAD request is given one replica, picked at random, and RoutingSession sends the
+    request's SELECTs there. Flushes, INSERT / UPDATE / DELETE statements and anything that is
+    not a SELECT go to the primary, and once a request has written, the rest of it reads from
+    the primary too. The db_* helpers that write are decorated with on_primary, which moves the
+    request to the primary before their first read. Other methods, the CLI and background threads only use the primary.
+
+    Read your writes: a request that wrote (any POST, PATCH, PUT or DELETE, or a GET that wrote)
+    pins the browser session to the primary for DB_REPLICA_PIN_SECONDS, so the page it is
+    redirected to shows the change even while the replicas lag. Keep it above the replication
+    lag. Other sessions may see slightly stale data for that long.
+
+    The async views of asgi.py read through their own engine on the primary. With sharding
+    (sharding.py) only the global tables use replicas.
+
+    Locally, point DB_REPLICA_URIS at a second SQLite file and refresh it from the primary with
+    `flask copy-to-replicas`, or at a streaming replica of a local PostgreSQL instance.
+"""
+
+import functools
+import random
+import time
+
+from flask import g, has_app_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+from sharding import shard_router
+
+READ_ONLY_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def use_primary():
+    """ Send the rest of the current request, reads included, to the primary. """
+
+    if has_app_context():
+        g.db_replica = None
+        g.db_wrote = True
+
+
+def reading_replica():
+    """ Whether the current request reads from a replica. What it reads may lag the primary, so
+        it must not be cached beyond the request (see app.view_user_page).
+    """
+
+    return has_app_context() and g.get("db_replica") is not None
+
+
+def on_primary(helper):
+    """ Decorator for the db_* helpers that write, so the reads they make on the way (ownership
+        and availability checks, ...) never see a lagging replica.
+    """
+
+    @functools.wraps(helper)
+    def wrapper(*args, **kwargs):
+        use_primary()
+        return helper(*args, **kwargs)
+
+    return wrapper
+
+
+class RoutingSession(SignallingSession):
+    """ SignallingSession that reads from the request's replica, when it has one. """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        shard = shard_router.bind_key_for(mapper, clause)
+        if shard is not None:
+            # users and their feedback live on their shard (sharding.py); replicas are not used
+            return get_state(self.app).db.get_engine(self.app, bind=shard)
+
+        replica = g.get("db_replica") if has_app_context() else None
+
+        if replica is not None:
+            if (not self._flushing and getattr(clause, "is_select", False)):
+                return get_state(self.app).db.get_engine(self.app, bind=replica)
+
+            # a write: the rest of the request reads its own changes from the primary
+            use_primary()
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy whose sessions are RoutingSessions """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaRouter:
+    """ Registers the replica binds and picks the engine for each request. """
+
+    def __init__(self, app=None):
+        self.bind_keys = []
+        self.pin_seconds = 5
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """ Call before the SQLAlchemy engines are first used and before any other before_request
+            hook that queries.
+        """
+
+        app.config.setdefault("DB_REPLICA_URIS", "")
+        app.config.setdefault("DB_REPLICA_PIN_SECONDS", 5)
+
+        uris = [uri.strip() for uri in app.config["DB_REPLICA_URIS"].split(",") if uri.strip()]
+
+        self.bind_keys = [f"replica{i}" for i in range(len(uris))]
+        self.pin_seconds = app.config["DB_REPLICA_PIN_SECONDS"]
+
+        if not uris:
+            return
+
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        binds.update(zip(self.bind_keys, uris))
+        app.config["SQLALCHEMY_BINDS"] = binds
+
+        app.before_request(self.choose_engine)
+        app.after_request(self.pin_writer)
+
+    def replica_engines(self, db):
+        """ The replica engines of db (for instrumentation) """
+
+        return [db.get_engine(bind=key) for key in self.bind_keys]
+
+    def choose_engine(self):
+        """ before_request: give read only requests of unpinned sessions a replica """
+
+        g.db_replica = None
+        g.db_wrote = False
+
+        if (request.method in READ_ONLY_METHODS and session.get("db_primary_until", 0) < time.time()):
+            g.db_replica = random.choice(self.bind_keys)
+
+    def pin_writer(self, response):
+        """ after_request: keep a session that just wrote on the primary for a while """
+
+        if ((request.method not in READ_ONLY_METHODS or g.get("db_wrote")) and self.pin_seconds > 0):
+            session["db_primary_until"] = time.time() + self.pin_seconds
+
+        return response
+
+
+replica_router = ReplicaRouter()
@@ -0,0 +1,224 @@
+""" Configuration for the Flask Feedback app.
+
+    DEFAULTS holds every setting the app reads. Any of them can be overridden by an
+    environment variable of the same name; the value is converted to the type of the default
+    ("true" / "1" / "yes" for booleans). create_app(config) applies its config argument last.
+
+    DATABASE_URL is accepted as an alias of SQLALCHEMY_DATABASE_URI. SECRET_KEY comes from the
+    environment, the config argument or, failing both, from APP_KEY in config.py.
+"""
+
+import os
+
+DEFAULTS = {
+    # Flask and SQL Alchemy Configuration
+    "SQLALCHEMY_DATABASE_URI": "postgresql:///flask_feedback_db",
+    "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    "SQLALCHEMY_ECHO": False,
+
+    # engine connection pool (ignored for SQLite). 0 statement timeout means no timeout.
+    "DB_POOL_SIZE": 5,
+    "DB_MAX_OVERFLOW": 10,
+    "DB_POOL_TIMEOUT": 30,
+    "DB_POOL_RECYCLE": 1800,
+    "DB_POOL_PRE_PING": True,
+    "DB_STATEMENT_TIMEOUT_MS": 0,
+
+    # read replicas (routing.py): comma separated URIs. GET requests read from one of them; a
+    #  session that wrote reads from the primary for DB_REPLICA_PIN_SECONDS.
+    "DB_REPLICA_URIS": "",
+    "DB_REPLICA_PIN_SECONDS": 5,
+
+    # hash sharding (sharding.py): comma separated URIs of the databases holding users and their
+    #  feedback. Shard lookups are cached for SHARD_DIRECTORY_TTL seconds per worker; feedback ids
+    #  are reserved from the primary SHARD_ID_BLOCK_SIZE at a time.
+    "DB_SHARD_URIS": "",
+    "SHARD_DIRECTORY_TTL": 5,
+    "SHARD_DIRECTORY_MAX_ENTRIES": 100000,
+    "SHARD_ID_BLOCK_SIZE": 1000,
+
+    # slow query log - statements slower than SLOW_QUERY_MS, SLOW_QUERY_SAMPLE_RATE of them
+    #  logged. Parameter values are replaced by their type unless SLOW_QUERY_REDACT is False.
+    "SLOW_QUERY_MS": 200,
+    "SLOW_QUERY_SAMPLE_RATE": 1.0,
+    "SLOW_QUERY_REDACT": True,
+
+    # Prometheus text metrics (metrics.py)
+    "METRICS_ENABLED": True,
+    "METRICS_PATH": "/metrics",
+
+    # login throttling (throttle.py)
+    "LOGIN_THROTTLE_ENABLED": True,
+    "LOGIN_THROTTLE_BACKEND": "memory",
+    "LOGIN_THROTTLE_PATH": "",
+    "LOGIN_THROTTLE_MAX_ENTRIES": 100000,
+    "LOGIN_IP_BURST": 20,
+    "LOGIN_IP_RATE": 1.0,
+    "LOGIN_USER_BURST": 5,
+    "LOGIN_USER_RATE": 0.1,
+    "LOGIN_BACKOFF_AFTER": 3,
+    "LOGIN_BACKOFF_BASE": 1.0,
+    "LOGIN_BACKOFF_MAX": 300.0,
+
+    # feedback items per page on the profile page. ?per_page= may ask for up to the max.
+    "FEEDBACK_PAGE_SIZE": 20,
+    "FEEDBACK_MAX_PAGE_SIZE": 100,
+
+    # streamed profile page: the whole feedback list is sent in PROFILE_STREAM_CHUNK_BYTES chunks
+    #  as it is read, PROFILE_STREAM_BATCH_SIZE rows per fetch, gzipped when the client accepts it.
+    "PROFILE_STREAMING_ENABLED": False,
+    "PROFILE_STREAM_BATCH_SIZE": 500,
+    "PROFILE_STREAM_CHUNK_BYTES": 16 * 1024,
+    "PROFILE_STREAM_GZIP": True,
+
+    # hot / cold feedback: `flask archive-feedback` moves feedback older than this to
+    #  feedback_archive, FEEDBACK_ARCHIVE_BATCH_SIZE rows per transaction
+    "FEEDBACK_ARCHIVE_AFTER_DAYS": 365,
+    "FEEDBACK_ARCHIVE_BATCH_SIZE": 1000,
+
+    # background jobs (jobs.py) run by `flask run-jobs`. JOBS_ENABLED queues the purges of large
+    #  accounts there instead of running them on a thread of the web process. Failed jobs are
+    #  retried after JOB_RETRY_BACKOFF seconds, doubling up to JOB_RETRY_BACKOFF_MAX.
+    "JOBS_ENABLED": False,
+    "JOB_WORKER_THREADS": 4,
+    "JOB_POLL_INTERVAL": 1.0,
+    "JOB_VISIBILITY_TIMEOUT": 300,
+    "JOB_MAX_ATTEMPTS": 5,
+    "JOB_RETRY_BACKOFF": 10,
+    "JOB_RETRY_BACKOFF_MAX": 3600,
+    "JOB_RETENTION_DAYS": 7,
+
+    # most feedback items one batch create / delete request may carry
+    "FEEDBACK_MAX_BATCH_SIZE": 100,
+
+    # feedback change feed (changefeed.py). The settle time only applies to databases other than
+    #  PostgreSQL and SQLite, where it bounds write transactions. Acknowledged events are kept
+    #  for the retention time so new consumers can catch up.
+    "FEEDBACK_EVENTS_ENABLED": True,
+    "FEEDBACK_EVENTS_SETTLE_SECONDS": 5,
+    "FEEDBACK_EVENTS_RETENTION_HOURS": 24,
+
+    # users with more feedback than the threshold are disabled and purged in chunks in the background
+    "USER_PURGE_THRESHOLD": 1000,
+    "USER_PURGE_CHUNK_SIZE": 500,
+
+    # password hashing pool (hashing.py)
+    "HASHING_POOL_SIZE": min(4, os.cpu_count() or 1),
+    "HASHING_MAX_QUEUE": 32,
+    "HASHING_TIMEOUT": 5.0,
+    "BCRYPT_LOG_ROUNDS": 12,
+    "BCRYPT_TARGET_MS": 80,
+    "BCRYPT_CALIBRATE_ON_STARTUP": False,
+
+    # profile page render cache (render_cache.py)
+    "RENDER_CACHE_ENABLED": True,
+    "RENDER_CACHE_BACKEND": "memory",
+    "RENDER_CACHE_PATH": "",
+    "RENDER_CACHE_MAX_BYTES": 32 * 1024 * 1024,
+
+    # async serving mode (asgi.py). ASYNC_DATABASE_URI defaults to SQLALCHEMY_DATABASE_URI with
+    #  the asyncpg / aiosqlite driver. Routes without an async view run on ASYNC_BRIDGE_THREADS.
+    "ASYNC_DATABASE_URI": "",
+    "ASYNC_BRIDGE_THREADS": 16,
+
+    # fingerprinted static assets (assets.py, `flask build-assets`) and compiled template cache.
+    #  JINJA_BYTECODE_CACHE_DIR defaults to Jinja's per user 0700 directory in the system temp dir;
+    #  a directory given here must belong to the app's user and not be writable by others.
+    "ASSETS_URL_PREFIX": "/assets",
+    "ASSETS_MAX_AGE": 365 * 24 * 3600,
+    "JINJA_BYTECODE_CACHE_ENABLED": True,
+    "JINJA_BYTECODE_CACHE_DIR": "",
+
+    # logged in user's profile cache (identity.py)
+    "USER_CACHE_ENABLED": True,
+    "USER_CACHE_TTL": 60,
+    "USER_CACHE_MAX_ENTRIES": 10000,
+}
+
+
+def convert(value, default):
+    """ Convert the environment string value to the type of default. """
+
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+def load_config(environ=None):
+    """ DEFAULTS overridden by environment variables. """
+
+    if environ is None:
+        environ = os.environ
+
+    config = dict(DEFAULTS)
+
+    for (key, default) in DEFAULTS.items():
+        if (key in environ):
+            config[key] = convert(environ[key], default)
+
+    if ("DATABASE_URL" in environ and "SQLALCHEMY_DATABASE_URI" not in environ):
+        config["SQLALCHEMY_DATABASE_URI"] = environ["DATABASE_URL"]
+
+    if ("SECRET_KEY" in environ):
+        config["SECRET_KEY"] = environ["SECRET_KEY"]
+
+    return config
+
+
+def engine_options(config):
+    """ SQLALCHEMY_ENGINE_OPTIONS built from the DB_* settings. SQLite does not use a sized
+        connection pool, so only pre-ping applies there.
+    """
+
+    options = {"pool_pre_ping": config["DB_POOL_PRE_PING"]}
+
+    if config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        return options
+
+    options.update({
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+    })
+
+    if (config["DB_STATEMENT_TIMEOUT_MS"] > 0 and config["SQLALCHEMY_DATABASE_URI"].startswith("postgres")):
+        options["connect_args"] = {
+            "options": f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT_MS']}"
+        }
+
+    return options
+
+
+def async_database_uri(uri):
+    """ uri with the asyncio driver: asyncpg for PostgreSQL, aiosqlite for SQLite. """
+
+    (scheme, rest) = uri.split(":", 1)
+    dialect = scheme.split("+")[0]
+
+    if (dialect in ("postgres", "postgresql")):
+        return f"postgresql+asyncpg:{rest}"
+
+    if (dialect == "sqlite"):
+        return f"sqlite+aiosqlite:{rest}"
+
+    return uri
+
+
+def async_engine_options(config):
+    """ engine_options for create_async_engine. asyncpg takes the statement timeout as a server
+        setting instead of a libpq options string.
+    """
+
+    options = engine_options(config)
+
+    if ("connect_args" in options):
+        options["connect_args"] = {
+            "server_settings": {"statement_timeout": str(config["DB_STATEMENT_TIMEOUT_MS"])}
+        }
+
+    return options
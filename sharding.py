@@ -0,0 +1,193 @@
+""" Hash sharding of users and their feedback across several databases.
+
+    DB_SHARD_URIS lists the shard databases (comma separated); empty keeps everything in
+    SQLALCHEMY_DATABASE_URI. Each shard is a Flask-SQLAlchemy bind (shard0, shard1, ...) holding
+    the users, feedback, feedback_archive and feedback_events tables (SHARDED_TABLES) for its
+    users. The primary keeps the global tables: user_directory, which records every user's shard
+    and keeps emails unique across shards, the id allocator and the change feed cursors.
+
+    A new user goes to shard blake2b(username) % number of shards. The models.py helpers call
+    shard_router.use_shard(username) before touching a user's rows and RoutingSession sends
+    statements on the sharded tables to that shard, so the routes in app.py do not change.
+    Admin jobs walk every shard with shard_router.each_shard(). A statement on a sharded table
+    without a chosen shard raises ShardingError rather than guessing.
+
+    Shard lookups are cached per worker for SHARD_DIRECTORY_TTL seconds. `flask move-user` and
+    `flask rebalance-shards` move users online: the user is marked moving (writes get a
+    ShardMovingError, reads carry on), copied once every worker has seen the mark, switched over
+    and removed from the old shard once every worker has seen the switch.
+
+        DB_SHARD_URIS                 shard database URIs. To shard an existing database, list
+                                      it first, run `flask init-shards`, then `flask rebalance-shards`.
+        SHARD_DIRECTORY_TTL           seconds a worker trusts its cached shard of a user.
+        SHARD_DIRECTORY_MAX_ENTRIES   cached shard lookups per worker.
+        SHARD_ID_BLOCK_SIZE           feedback ids reserved from the primary at a time.
+
+    Feedback ids come from a global allocator, so they stay unique (and a moved user keeps
+    them) across shards. Change feed event ids are per shard; with sharding the events carry
+    their shard. Read replicas (routing.py) only serve the global tables.
+"""
+
+import hashlib
+import time
+
+from flask import g, has_app_context
+from sqlalchemy.sql.util import find_tables
+
+from store import MemoryStore
+
+SHARDED_TABLES = frozenset(("users", "feedback", "feedback_archive", "feedback_events"))
+
+
+class ShardingError(Exception):
+    """ A statement on a sharded table was issued without choosing a shard. """
+
+
+class ShardMovingError(ShardingError):
+    """ The user is being moved to another shard. Writes are refused until the move is done. """
+
+
+def placement(username, nbr_shards):
+    """ Shard index for a new user: a stable hash of username, the same in every process. """
+
+    digest = hashlib.blake2b(username.encode("utf8"), digest_size=8).digest()
+
+    return int.from_bytes(digest, "big") % nbr_shards
+
+
+def statement_tables(mapper, clause):
+    """ Names of the tables a statement reads or writes """
+
+    if mapper is not None:
+        return {mapper.local_table.name}
+
+    if clause is None:
+        return set()
+
+    return {table.name for table in find_tables(clause, include_crud=True, include_joins=True)}
+
+
+class ShardRouter:
+    """ Registers the shard binds and tracks the shard of the current unit of work. """
+
+    def __init__(self, app=None, loader=None):
+        self.enabled = False
+        self.bind_keys = []
+        self.ttl = 5
+        self.loader = None
+        self.store = MemoryStore()
+
+        if app is not None:
+            self.init_app(app, loader)
+
+    def init_app(self, app, loader):
+        """ loader(username) returns (shard index, moving) from the user directory, or None for
+            an unknown user. Call before the SQLAlchemy engines are first used.
+        """
+
+        app.config.setdefault("DB_SHARD_URIS", "")
+        app.config.setdefault("SHARD_DIRECTORY_TTL", 5)
+        app.config.setdefault("SHARD_DIRECTORY_MAX_ENTRIES", 100000)
+        app.config.setdefault("SHARD_ID_BLOCK_SIZE", 1000)
+
+        uris = [uri.strip() for uri in app.config["DB_SHARD_URIS"].split(",") if uri.strip()]
+
+        self.enabled = bool(uris)
+        self.bind_keys = [f"shard{i}" for i in range(len(uris))]
+        self.ttl = app.config["SHARD_DIRECTORY_TTL"]
+        self.loader = loader
+        self.store = MemoryStore(max_entries=app.config["SHARD_DIRECTORY_MAX_ENTRIES"])
+
+        if uris:
+            binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+            binds.update(zip(self.bind_keys, uris))
+            app.config["SQLALCHEMY_BINDS"] = binds
+
+    @property
+    def nbr_shards(self):
+        return len(self.bind_keys)
+
+    def placement(self, username):
+        return placement(username, self.nbr_shards)
+
+    def shard_engines(self, db):
+        """ The shard engines of db, in shard order """
+
+        return [db.get_engine(bind=key) for key in self.bind_keys]
+
+    # user -> shard
+
+    def locate(self, username):
+        """ (shard index, moving) of username, from the cache while it is fresh. Unknown users
+            are placed by hash, which is where they will be created.
+        """
+
+        cached = self.store.get(username)
+        if cached is not None:
+            (expires, location) = cached
+            if (time.monotonic() < expires):
+                return location
+
+        location = self.loader(username) or (self.placement(username), False)
+        self.store.set(username, (time.monotonic() + self.ttl, location))
+
+        return location
+
+    def forget(self, username):
+        self.store.delete(username)
+
+    def use_shard(self, username, write=False):
+        """ Route the sharded tables to username's shard for the rest of the app context.
+            write=True raises ShardMovingError while the user is being moved.
+        """
+
+        if not self.enabled:
+            return
+
+        (index, moving) = self.locate(username)
+        if (write and moving):
+            raise ShardMovingError(f"{username} is being moved to another shard")
+
+        g.db_shard = self.bind_keys[index]
+
+    def use_index(self, index):
+        """ Route the sharded tables to shard index (None: no shard chosen) """
+
+        if self.enabled:
+            g.db_shard = None if index is None else self.bind_keys[index]
+
+    def each_shard(self):
+        """ Yield every shard index with the sharded tables routed to it. Without sharding this
+            yields 0 once and everything stays on the primary.
+        """
+
+        if not self.enabled:
+            yield 0
+            return
+
+        previous = g.get("db_shard")
+        try:
+            for index in range(self.nbr_shards):
+                g.db_shard = self.bind_keys[index]
+                yield index
+        finally:
+            g.db_shard = previous
+
+    def bind_key_for(self, mapper, clause):
+        """ Bind key of the shard a statement must run on, or None for the global tables. """
+
+        if not self.enabled:
+            return None
+
+        tables = statement_tables(mapper, clause) & SHARDED_TABLES
+        if not tables:
+            return None
+
+        shard = g.get("db_shard") if has_app_context() else None
+        if shard is None:
+            raise ShardingError(f"no shard chosen for a statement on {', '.join(sorted(tables))}")
+
+        return shard
+
+
+shard_router = ShardRouter()
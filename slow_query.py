@@ -0,0 +1,97 @@
+""" Sampled slow query log.
+
+    Replaces SQLALCHEMY_ECHO, which writes every statement to the log synchronously. Each
+    statement is timed with SQLAlchemy cursor events; only statements slower than
+    SLOW_QUERY_MS are considered and SLOW_QUERY_SAMPLE_RATE of those are logged. The log
+    records go through a QueueHandler so the request thread never waits on log I/O.
+"""
+
+import logging
+import logging.handlers
+import queue
+import random
+import time
+
+from sqlalchemy import event
+
+logger = logging.getLogger("feedback.slow_query")
+
+
+def redact(parameters):
+    """ Replace parameter values by their type names so logged statements carry no user data
+        (passwords, emails, feedback text).
+    """
+
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for (key, value) in parameters.items()}
+
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            # executemany
+            return f"<{len(parameters)} parameter sets>"
+        return [type(value).__name__ for value in parameters]
+
+    return type(parameters).__name__
+
+
+class SlowQueryLog:
+    """ Times SQL statements on an app's engine and logs a sample of the slow ones. """
+
+    def __init__(self, app=None):
+        self.threshold = 0.2
+        self.sample_rate = 1.0
+        self.redact = True
+
+        self._listener = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SLOW_QUERY_MS", 200)
+        app.config.setdefault("SLOW_QUERY_SAMPLE_RATE", 1.0)
+        app.config.setdefault("SLOW_QUERY_REDACT", True)
+
+        self.threshold = app.config["SLOW_QUERY_MS"] / 1000
+        self.sample_rate = app.config["SLOW_QUERY_SAMPLE_RATE"]
+        self.redact = app.config["SLOW_QUERY_REDACT"]
+
+        self.start_listener()
+
+    def start_listener(self):
+        """ Hand slow query records to a background thread that does the writing. """
+
+        if self._listener is not None:
+            return
+
+        records = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(records, logging.StreamHandler())
+        self._listener.start()
+
+        logger.addHandler(logging.handlers.QueueHandler(records))
+        logger.setLevel(logging.WARNING)
+        logger.propagate = False
+
+    def instrument(self, engine):
+        """ Attach the timing events to engine. """
+
+        if event.contains(engine, "before_cursor_execute", self.before_cursor_execute):
+            return
+
+        event.listen(engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["slow_query_start"].pop()
+
+        if (elapsed < self.threshold or random.random() >= self.sample_rate):
+            return
+
+        logger.warning("slow query %.1f ms: %s parameters=%s", elapsed * 1000, " ".join(statement.split()),
+                       redact(parameters) if self.redact else parameters)
+
+
+slow_query_log = SlowQueryLog()
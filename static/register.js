@@ -0,0 +1,42 @@
+// Registration form: tell the visitor a username or email is taken as soon as they leave the field.
+
+async function check_availability(input) {
+
+    /** function synopsis:
+     *   asks /register/check whether the value of input (the username or email field) is free
+     *   and shows or clears a message next to the field.
+     */
+
+    const field = input.name;
+    const value = input.value.trim();
+    let notice = input.parentElement.querySelector(".availability");
+
+    if (notice) {
+        notice.remove();
+    }
+
+    if (!value) {
+        return;
+    }
+
+    const response = await fetch(`/register/check?${field}=${encodeURIComponent(value)}`);
+    if (!response.ok) {
+        return;
+    }
+
+    const results = await response.json();
+
+    if (results[field] === false) {
+        notice = document.createElement("span");
+        notice.className = "error-fld availability";
+        notice.textContent = `${field} '${value}' already exists. Please select a different ${field}`;
+        input.before(notice);
+    }
+}
+
+for (const name of ["username", "email"]) {
+    const input = document.getElementById(name);
+    if (input) {
+        input.addEventListener("change", () => check_availability(input));
+    }
+}
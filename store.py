@@ -0,0 +1,227 @@
+""" Small key/value stores used by the Flask Feedback caches.
+
+    MemoryStore     in-process LRU bounded by entry count and/or bytes. One copy per worker.
+    SqliteStore     LRU in a local SQLite file so several worker processes on the same host
+                    share entries and counters.
+
+    Both stores hold str, bytes or int values and expose the same get / set / delete / incr /
+    update interface, so callers pick a backend by configuration only.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def value_size(value):
+    """ Approximate size in bytes of a stored value. """
+
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode("utf8"))
+    return 8
+
+
+class MemoryStore:
+    """ Thread safe in-process LRU store. """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Return the value for key or None. A hit marks key as most recently used. """
+
+        with self._lock:
+            if (key not in self._data):
+                return None
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        """ Store value for key, evicting least recently used entries when over a limit. """
+
+        with self._lock:
+            self._set(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            if (key in self._data):
+                self._bytes -= value_size(self._data.pop(key))
+
+    def incr(self, key, amount=1):
+        """ Add amount to the integer at key (0 when missing) and return the new value. """
+
+        with self._lock:
+            value = (self._data.get(key) or 0) + amount
+            self._set(key, value)
+            return value
+
+    def update(self, key, fn):
+        """ Atomically replace the value at key with fn(current value or None). fn returns
+            (new_value, result); update returns result.
+        """
+
+        with self._lock:
+            (value, result) = fn(self._data.get(key))
+            self._set(key, value)
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data), "bytes": self._bytes}
+
+    def _set(self, key, value):
+        if (key in self._data):
+            self._bytes -= value_size(self._data.pop(key))
+
+        self._data[key] = value
+        self._bytes += value_size(value)
+
+        while self._data and (
+                (self.max_entries is not None and len(self._data) > self.max_entries) or
+                (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            (_, evicted) = self._data.popitem(last=False)
+            self._bytes -= value_size(evicted)
+
+
+class SqliteStore:
+    """ LRU store in a local SQLite file shared by every process that opens the same path.
+        Several stores can share one file by using different table names.
+    """
+
+    def __init__(self, path, max_entries=None, max_bytes=None, table="kv"):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute(f"""CREATE TABLE IF NOT EXISTS {self.table} (
+                                key TEXT PRIMARY KEY,
+                                value BLOB,
+                                size INTEGER NOT NULL,
+                                accessed REAL NOT NULL)""")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS ix_{self.table}_accessed ON {self.table} (accessed)")
+
+    def _connect(self):
+        """ One connection per thread. WAL lets readers run alongside a writer. """
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        conn.execute(f"UPDATE {self.table} SET accessed = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def set(self, key, value):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._set(conn, key, value)
+            self._evict(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, key):
+        self._connect().execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def incr(self, key, amount=1):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            value = (int(row[0]) if row else 0) + amount
+            self._set(conn, key, value)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return value
+
+    def update(self, key, fn):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            (value, result) = fn(row[0] if row else None)
+            self._set(conn, key, value)
+            self._evict(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        return result
+
+    def clear(self):
+        self._connect().execute(f"DELETE FROM {self.table}")
+
+    def stats(self):
+        (entries, size) = self._connect().execute(
+            f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+        return {"entries": entries, "bytes": size}
+
+    def _set(self, conn, key, value):
+        conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                     (key, value, value_size(value), time.time()))
+
+    def _evict(self, conn):
+        if self.max_entries is not None:
+            conn.execute(f"""DELETE FROM {self.table} WHERE key IN (
+                                SELECT key FROM {self.table} ORDER BY accessed DESC LIMIT -1 OFFSET ?)""",
+                         (self.max_entries,))
+
+        if self.max_bytes is not None:
+            (total,) = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()
+            while total > self.max_bytes:
+                row = conn.execute(
+                    f"SELECT key, size FROM {self.table} ORDER BY accessed LIMIT 1").fetchone()
+                if row is None:
+                    break
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (row[0],))
+                total -= row[1]
+
+
+def make_store(backend, path=None, max_entries=None, max_bytes=None, table="kv"):
+    """ Build a store from configuration values: backend is "memory" or "sqlite". """
+
+    if (backend == "memory"):
+        return MemoryStore(max_entries=max_entries, max_bytes=max_bytes)
+
+    if (backend == "sqlite"):
+        if not path:
+            raise ValueError("the sqlite store needs a file path")
+        return SqliteStore(path, max_entries=max_entries, max_bytes=max_bytes, table=table)
+
+    raise ValueError(f"unknown store backend '{backend}'")
@@ -0,0 +1,114 @@
+""" Shared fixtures. Each test gets its own SQLite database files in a temp directory. """
+
+import itertools
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app  # noqa: E402
+from models import db  # noqa: E402
+from sharding import placement  # noqa: E402
+
+PASSWORD = "secret-password"
+
+SHARDS = {"DB_SHARD_URIS": "sqlite:///{tmp}/shard0.db,sqlite:///{tmp}/shard1.db", "SHARD_DIRECTORY_TTL": 0}
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """ make_app(**config) builds the app on tmp_path/primary.db (plus any binds in config) with
+        every table created. Config values may use {tmp} for tmp_path.
+    """
+
+    apps = []
+
+    def make(**config):
+        settings = {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///{tmp}/primary.db",
+            "SECRET_KEY": "testing",
+            "WTF_CSRF_ENABLED": False,
+            "BCRYPT_LOG_ROUNDS": 4,
+            "HASHING_POOL_SIZE": 0,
+            "LOGIN_THROTTLE_ENABLED": False,
+            "JINJA_BYTECODE_CACHE_ENABLED": False,
+        }
+        settings.update(config)
+        settings = {key: value.format(tmp=tmp_path) if isinstance(value, str) else value
+                    for (key, value) in settings.items()}
+
+        app = create_app(settings)
+        with app.app_context():
+            db.create_all()
+        apps.append(app)
+        return app
+
+    yield make
+
+    for app in apps:
+        with app.app_context():
+            db.session.remove()
+            db.get_engine().dispose()
+            for key in (app.config.get("SQLALCHEMY_BINDS") or {}):
+                db.get_engine(bind=key).dispose()
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def sharded_app(make_app):
+    """ The app on two shard files, after `flask init-shards` """
+
+    app = make_app(**SHARDS)
+    result = app.test_cli_runner().invoke(args=["init-shards"])
+    assert result.exit_code == 0, result.output
+    return app
+
+
+def usernames_on(shard, count):
+    """ count usernames whose hash placement is shard (of two) """
+
+    names = (f"user{i}" for i in itertools.count())
+    return list(itertools.islice((name for name in names if placement(name, 2) == shard), count))
+
+
+def register(client, username, email=None):
+    """ Register username through the page (which also logs the client in) """
+
+    return client.post("/register", data={
+        "username": username, "password": PASSWORD, "email": email or f"{username}@example.com",
+        "first_name": "Test", "last_name": username.title()})
+
+
+def login(client, username):
+    return client.post("/login", data={"username": username, "password": PASSWORD})
+
+
+def add_feedback(client, username, title, content):
+    return client.post(f"/user/{username}/feedback/add", data={"title": title, "content": content})
+
+
+def flashes(client):
+    """ Take the messages flashed to client and not shown yet, as [(category, message)] """
+
+    with client.session_transaction() as browser_session:
+        return list(browser_session.pop("_flashes", []))
+
+
+def feedback_ids(app, username):
+    """ username's live feedback ids, oldest first """
+
+    from models import Feedback
+    from sharding import shard_router
+
+    with app.app_context():
+        shard_router.use_shard(username)
+        ids = [feedback_id for (feedback_id,) in db.session.query(Feedback.id).filter_by(
+            username=username).order_by(Feedback.id)]
+        db.session.remove()
+    return ids
@@ -0,0 +1,88 @@
+""" JSON API: ETags from the row versions, conditional GETs and writes, error statuses. """
+
+import hashlib
+
+import pytest
+
+from conftest import add_feedback, feedback_ids, register
+
+
+def etag(*id_versions):
+    return hashlib.sha1(",".join(f"{feedback_id}.{version}" for (feedback_id, version) in id_versions).encode(
+        "utf8")).hexdigest()
+
+
+@pytest.fixture
+def client(app):
+    bobby = app.test_client()
+    register(bobby, "bobby")
+    add_feedback(bobby, "bobby", "bobby's", "content")
+
+    client = app.test_client()
+    register(client, "alice")
+    add_feedback(client, "alice", "first", "content")
+    add_feedback(client, "alice", "second", "content")
+    return client
+
+
+def test_etag_follows_the_row_versions(app, client):
+    (first, second) = feedback_ids(app, "alice")
+
+    response = client.get(f"/api/feedback/{first}")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{etag((first, 1))}"'
+    assert response.get_json()["feedback"]["title"] == "first"
+
+    # the list in page order, oldest first
+    assert client.get("/api/feedback").headers["ETag"] == f'"{etag((first, 1), (second, 1))}"'
+
+    response = client.patch(f"/api/feedback/{first}", json={"content": "changed"})
+    assert response.headers["ETag"] == f'"{etag((first, 2))}"'
+    assert response.get_json()["feedback"]["title"] == "first"
+    assert client.get("/api/feedback").headers["ETag"] == f'"{etag((first, 2), (second, 1))}"'
+
+
+def test_if_none_match_gives_304(app, client):
+    (first, _) = feedback_ids(app, "alice")
+
+    for url in (f"/api/feedback/{first}", "/api/feedback"):
+        tag = client.get(url).headers["ETag"]
+
+        response = client.get(url, headers={"If-None-Match": tag})
+        assert response.status_code == 304 and response.data == b""
+
+        assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+
+    client.patch(f"/api/feedback/{first}", json={"title": "changed"})
+    assert client.get(f"/api/feedback/{first}", headers={"If-None-Match": f'"{etag((first, 1))}"'}).status_code == 200
+
+
+def test_if_match_mismatch_gives_412(app, client):
+    (first, _) = feedback_ids(app, "alice")
+    url = f"/api/feedback/{first}"
+
+    assert client.patch(url, json={"title": "x"}, headers={"If-Match": '"other"'}).status_code == 412
+    assert client.delete(url, headers={"If-Match": '"other"'}).status_code == 412
+    assert client.get(url).get_json()["feedback"]["title"] == "first"
+
+    response = client.delete(url, headers={"If-Match": f'"{etag((first, 1))}"'})
+    assert response.status_code == 200
+    assert client.get(url).status_code == 404
+
+
+def test_error_statuses(app, client):
+    (bobby_id,) = feedback_ids(app, "bobby")
+
+    response = client.get(f"/api/feedback/{bobby_id}")
+    assert (response.status_code, response.get_json()) == (403, {"error": "You cannot access another users feedback."})
+
+    response = client.get("/api/feedback/9999")
+    assert (response.status_code, response.get_json()) == (404, {"error": "The requested feedback was not found."})
+
+    response = client.patch(f"/api/feedback/{feedback_ids(app, 'alice')[0]}", json={"title": ""})
+    assert response.status_code == 400 and response.get_json()["errors"]
+
+    logged_out = app.test_client()
+    assert logged_out.get(f"/api/feedback/{bobby_id}").status_code == 401
+    assert logged_out.get("/api/feedback").status_code == 401
+    assert logged_out.post("/api/feedback", json={"title": "x", "content": "y"}).status_code == 401
@@ -0,0 +1,122 @@
+""" The async views of asgi.py answer exactly as the Flask routes they stand in for. """
+
+import asyncio
+
+import pytest
+
+from conftest import add_feedback, register
+from models import Feedback
+
+pytest.importorskip("aiosqlite")
+
+import asgi  # noqa: E402
+
+
+def session_cookie(client):
+    return "; ".join(f"{cookie.name}={cookie.value}" for cookie in client.cookie_jar)
+
+
+async def call(asgi_app, path, cookie):
+    """ GET path through asgi_app. Returns (status, {header: value}, body). """
+
+    (path, _, query) = path.partition("?")
+    scope = {"type": "http", "method": "GET", "path": path, "query_string": query.encode(),
+             "headers": [(b"host", b"localhost"), (b"cookie", cookie.encode())],
+             "server": ("localhost", 80), "client": ("127.0.0.1", 1), "scheme": "http",
+             "http_version": "1.1", "root_path": ""}
+    messages = [{"type": "http.request", "body": b"", "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+
+    headers = {name.decode("latin1"): value.decode("latin1") for (name, value) in sent[0]["headers"]}
+    return (sent[0]["status"], headers, sent[1]["body"])
+
+
+@pytest.fixture
+def served(make_app):
+    """ (flask app, FeedbackASGI, logged in test client) with alice's feedback and bobby's """
+
+    app = make_app()
+    bobby = app.test_client()
+    register(bobby, "bobby")
+    add_feedback(bobby, "bobby", "not yours", "x")
+
+    client = app.test_client()
+    register(client, "alice")
+    for i in range(3):
+        add_feedback(client, "alice", f"title {i}", f"content {i}")
+    # read the flashes, so both sides render the same page
+    client.get("/user/alice")
+
+    asgi_app = asgi.FeedbackASGI(app)
+    yield (app, asgi_app, client)
+    asgi_app.bridge.shutdown()
+
+
+def compare(served, paths, monkeypatch):
+    """ Request every path through Flask and through the ASGI app. Returns the endpoints that were
+        served by a coroutine.
+    """
+
+    (app, asgi_app, client) = served
+    served_async = []
+
+    for (endpoint, view) in list(asgi_app.views.items()):
+        async def spy(environ, _view=view, _endpoint=endpoint, **view_args):
+            response = await _view(environ, **view_args)
+            if response is not None:
+                served_async.append(_endpoint)
+            return response
+        monkeypatch.setitem(asgi_app.views, endpoint, spy)
+
+    async def main():
+        try:
+            return [await call(asgi_app, path, session_cookie(client)) for path in paths]
+        finally:
+            await asgi_app.engine.dispose()
+
+    for ((status, headers, body), path) in zip(asyncio.run(main()), paths):
+        response = client.get(path)
+        assert (status, body) == (response.status_code, response.data), path
+        assert headers.get("Content-Type") == response.headers.get("Content-Type"), path
+        assert headers.get("ETag") == response.headers.get("ETag"), path
+
+    return served_async
+
+
+def test_view_user_page(served, monkeypatch):
+    paths = ["/user/alice", "/user/alice?per_page=2", "/user/alice?per_page=1&after=2", "/user/bobby"]
+
+    served_async = compare(served, paths, monkeypatch)
+
+    # someone else's profile goes to Flask for its flash and redirect
+    assert served_async == ["feedback_app.view_user_page"] * 3
+
+
+def test_api_get_feedback(served, monkeypatch):
+    (app, asgi_app, client) = served
+    with app.app_context():
+        alice_id = Feedback.query.filter_by(username="alice").first().id
+        bobby_id = Feedback.query.filter_by(username="bobby").first().id
+
+    paths = [f"/api/feedback/{alice_id}", f"/api/feedback/{bobby_id}", "/api/feedback/9999"]
+
+    served_async = compare(served, paths, monkeypatch)
+
+    assert served_async == ["feedback_app.api_get_feedback"] * 3
+
+
+def test_logged_out_requests_go_to_flask(served, monkeypatch):
+    (app, asgi_app, client) = served
+    client.post("/logout")
+
+    served_async = compare(served, ["/user/alice", "/api/feedback/1"], monkeypatch)
+
+    assert served_async == []
@@ -0,0 +1,40 @@
+""" Username / email availability checks before a password is hashed. """
+
+import sqlite3
+
+from conftest import register
+from models import User
+
+
+def test_check_sees_users_created_elsewhere(app, tmp_path, monkeypatch):
+    client = app.test_client()
+    assert client.get("/register/check?username=bobby&email=bob@x.com").get_json() == {
+        "username": True, "email": True}
+
+    # another worker or process creates the user
+    with sqlite3.connect(tmp_path / "primary.db") as other_worker:
+        other_worker.execute(
+            "INSERT INTO users (username, password, email, first_name, last_name) "
+            "VALUES ('bobby', 'x', 'bob@x.com', 'Bob', 'Smith')")
+
+    assert client.get("/register/check?username=bobby&email=BOB@x.com").get_json() == {
+        "username": False, "email": False}
+
+    def register_user(*args):
+        raise AssertionError("the password was hashed for a taken username")
+    monkeypatch.setattr(User, "register", register_user)
+
+    response = register(client, "bobby", email="new@x.com")
+    assert response.status_code == 200 and b"already exists" in response.data
+
+
+def test_check_after_delete(app):
+    client = app.test_client()
+    register(client, "alice")
+    assert client.get("/register/check?username=alice").get_json() == {"username": False}
+
+    client.post("/user/alice/delete")
+
+    assert client.get("/register/check?username=alice").get_json() == {"username": True}
+    with app.app_context():
+        assert User.query.count() == 0
@@ -0,0 +1,119 @@
+""" Batch create and delete of feedback: one transaction, one result per item. """
+
+import pytest
+
+from conftest import add_feedback, feedback_ids, flashes, register
+from models import User
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(FEEDBACK_MAX_BATCH_SIZE=5)
+
+
+@pytest.fixture
+def client(app):
+    bobby = app.test_client()
+    register(bobby, "bobby")
+    add_feedback(bobby, "bobby", "bobby's", "content")
+
+    client = app.test_client()
+    register(client, "alice")
+    return client
+
+
+def feedback_count(app, username):
+    with app.app_context():
+        return User.query.get(username).feedback_count
+
+
+def test_batch_create_reports_each_item(app, client):
+    response = client.post("/api/feedback/batch", json={"feedback": [
+        {"title": "one", "content": "first"},
+        {"title": "", "content": "no title"},
+        "not an object",
+        {"title": "two", "content": "second"},
+    ]})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body["created"], body["failed"]) == (2, 2)
+    assert [item["status"] for item in body["results"]] == [201, 400, 400, 201]
+    assert [item["feedback"]["title"] for item in body["results"] if item["status"] == 201] == ["one", "two"]
+    assert all(item["errors"] for item in body["results"] if item["status"] == 400)
+
+    assert [item["feedback"]["id"] for item in body["results"] if item["status"] == 201] == feedback_ids(app, "alice")
+    assert feedback_count(app, "alice") == 2
+
+
+def test_batch_create_rejects_blank_fields(app, client):
+    response = client.post("/api/feedback/batch", json={"feedback": [{"title": "   ", "content": "x"}, {"title": "x"}]})
+
+    assert [item["status"] for item in response.get_json()["results"]] == [400, 400]
+    assert feedback_ids(app, "alice") == []
+
+
+@pytest.mark.parametrize("body, status", [
+    ({"feedback": []}, 400),
+    ({"feedback": {"title": "x"}}, 400),
+    ({}, 400),
+    ({"feedback": [{"title": "t", "content": "c"}] * 6}, 413),
+])
+def test_batch_create_refuses_bad_lists(app, client, body, status):
+    assert client.post("/api/feedback/batch", json=body).status_code == status
+    assert feedback_ids(app, "alice") == []
+
+
+def test_batch_delete_reports_each_id(app, client):
+    for i in range(3):
+        add_feedback(client, "alice", f"title {i}", "content")
+    (first, second, third) = feedback_ids(app, "alice")
+    (bobby_id,) = feedback_ids(app, "bobby")
+
+    response = client.post("/api/feedback/batch/delete", json={"ids": [first, bobby_id, 9999, first, third]})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    # the duplicate id is reported once
+    assert [(item["id"], item["status"]) for item in body["results"]] == [
+        (first, 200), (bobby_id, 403), (9999, 404), (third, 200)]
+    assert (body["deleted"], body["failed"]) == (2, 2)
+
+    assert feedback_ids(app, "alice") == [second]
+    assert feedback_ids(app, "bobby") == [bobby_id]
+    assert feedback_count(app, "alice") == 1
+
+
+@pytest.mark.parametrize("ids, status", [
+    ([], 400),
+    (["1"], 400),
+    ([1, True], 400),
+    ([1, 2, 3, 4, 5, 6], 413),
+])
+def test_batch_delete_refuses_bad_lists(app, client, ids, status):
+    add_feedback(client, "alice", "title", "content")
+
+    assert client.post("/api/feedback/batch/delete", json={"ids": ids}).status_code == status
+    assert len(feedback_ids(app, "alice")) == 1
+
+
+def test_batch_delete_page(app, client):
+    for i in range(2):
+        add_feedback(client, "alice", f"title {i}", "content")
+    (first, second) = feedback_ids(app, "alice")
+    (bobby_id,) = feedback_ids(app, "bobby")
+    flashes(client)
+
+    response = client.post("/user/alice/feedback/delete", data={"feedback_id": [first, bobby_id]})
+
+    assert response.status_code == 302
+    assert flashes(client) == [("flash-okay", "'title 0' was deleted."),
+                               ("flash-error", "You cannot delete another users feedback.")]
+    assert feedback_ids(app, "alice") == [second]
+
+    client.post("/user/alice/feedback/delete", data={"feedback_id": [1, 2, 3, 4, 5, 6]})
+    assert flashes(client) == [("flash-error", "At most 5 pieces of feedback can be deleted at once.")]
+    assert feedback_ids(app, "alice") == [second]
+
+    assert client.post("/api/feedback/batch/delete", json={"ids": [second]}).get_json()["deleted"] == 1
+    assert app.test_client().post("/api/feedback/batch/delete", json={"ids": [second]}).status_code == 401
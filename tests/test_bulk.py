@@ -0,0 +1,165 @@
+""" Bulk import and export (bulk.py) through the flask CLI commands. """
+
+import json
+import sqlite3
+
+import pytest
+
+import bulk
+from conftest import PASSWORD, login, register
+from models import db, Feedback, User
+
+
+def user_row(username, **fields):
+    row = {"username": username, "password": PASSWORD, "email": f"{username}@example.com",
+           "first_name": "Bulk", "last_name": "User"}
+    row.update(fields)
+    return row
+
+
+def write_jsonl(path, rows):
+    path.write_text("".join((row if isinstance(row, str) else json.dumps(row)) + "\n" for row in rows))
+    return str(path)
+
+
+def cli(app, *args):
+    result = app.test_cli_runner().invoke(args=list(args))
+    assert result.exception is None, result.output
+    return result.output.splitlines()
+
+
+def rejected(output):
+    """ Rejected rows by row number; batches are checked in chunks, so report order varies """
+    return dict(sorted((int(line.split(":")[0][4:]), line.split(": ", 1)[1])
+                       for line in output if line.startswith("row ")))
+
+
+def usernames(app):
+    with app.app_context():
+        return sorted(username for (username,) in db.session.query(User.username))
+
+
+def test_import_users_rejects_bad_rows(app, tmp_path):
+    register(app.test_client(), "taken")
+
+    source = write_jsonl(tmp_path / "users.jsonl", [
+        user_row("alice"),
+        user_row("bob"),
+        user_row("carol", email=""),
+        user_row("david", password="short"),
+        user_row("erin5", first_name=7),
+        user_row("frank", password=["a", "list"]),
+        '["not", "an", "object"]',
+        "42",
+        "{broken",
+        user_row("taken", email="new@example.com"),
+        user_row("grace", email="taken@example.com"),
+        user_row("alice", email="alice2@example.com"),
+        user_row("heidi", email="ALICE@example.com"),
+        user_row("ivan1", password=None, password_hash="not a hash"),
+        user_row("judy1"),
+    ])
+
+    output = cli(app, "import-users", source, "--workers", "1", "--batch-size", "4")
+
+    assert rejected(output) == {
+        2: "username must be 4 to 20 characters in length",
+        3: "email must be 1 to 50 characters in length",
+        4: "password must be at least 6 characters in length",
+        5: "first_name must be a string",
+        6: "password must be a string",
+        7: "not a JSON object",
+        8: "not a JSON object",
+        9: "invalid JSON: Expecting property name enclosed in double quotes: line 1 column 2 (char 1)",
+        10: "username 'taken' already exists",
+        11: "email 'taken@example.com' already exists",
+        12: "username 'alice' appears earlier in the file",
+        13: "email 'alice@example.com' appears earlier in the file",
+        14: "password_hash is not a bcrypt hash",
+    }
+    assert output[-1] == "2 users created, 13 rows rejected."
+    assert usernames(app) == ["alice", "judy1", "taken"]
+
+    assert login(app.test_client(), "judy1").status_code == 302
+
+
+def test_import_feedback_rejects_bad_rows(app, tmp_path):
+    register(app.test_client(), "alice")
+
+    source = write_jsonl(tmp_path / "feedback.jsonl", [
+        {"title": "one", "content": "first", "username": "alice"},
+        {"title": "", "content": "no title", "username": "alice"},
+        {"title": 5, "content": "number", "username": "alice"},
+        {"title": "unknown", "content": "x", "username": "nobody"},
+        ["not", "an", "object"],
+        {"title": "two", "content": "second", "username": "alice"},
+    ])
+
+    output = cli(app, "import-feedback", source)
+
+    assert rejected(output) == {
+        2: "title cannot be all spaces",
+        3: "title must be a string",
+        4: "username 'nobody' does not exist",
+        5: "not a JSON object",
+    }
+    assert output[-1] == "2 feedback created, 4 rows rejected."
+    with app.app_context():
+        assert sorted(feedback.title for feedback in Feedback.query) == ["one", "two"]
+        assert User.query.get("alice").feedback_count == 2
+
+
+def test_conflicting_rows_fall_back_to_row_by_row(app, tmp_path, monkeypatch):
+    """ A signup that lands between the conflict check and the insert only costs its own row """
+
+    hash_passwords = bulk.hash_passwords
+
+    def hash_while_someone_signs_up(*args):
+        with sqlite3.connect(tmp_path / "primary.db") as other_worker:
+            other_worker.execute("INSERT INTO users (username, password, email, first_name, last_name) "
+                                 "VALUES ('bobby', 'x', 'elsewhere@example.com', 'B', 'B')")
+        return hash_passwords(*args)
+
+    monkeypatch.setattr(bulk, "hash_passwords", hash_while_someone_signs_up)
+
+    source = write_jsonl(tmp_path / "users.jsonl", [user_row("alice"), user_row("bobby"), user_row("carol")])
+
+    output = cli(app, "import-users", source, "--workers", "1")
+
+    assert output == ["row 2: conflicts with an existing username or email",
+                      "2 users created, 1 rows rejected."]
+    assert usernames(app) == ["alice", "bobby", "carol"]
+    with app.app_context():
+        assert User.query.get("bobby").email == "elsewhere@example.com"
+
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl"])
+def test_export_round_trip(make_app, tmp_path, fmt):
+    source = make_app(SQLALCHEMY_DATABASE_URI="sqlite:///{tmp}/source.db")
+    client = source.test_client()
+    register(client, "alice")
+    for (title, content) in [("one", "plain"), ("two, with comma", 'quotes " and\nnew lines')]:
+        client.post("/user/alice/feedback/add", data={"title": title, "content": content})
+    register(source.test_client(), "bobby")
+
+    (users, feedback) = (str(tmp_path / f"users.{fmt}"), str(tmp_path / f"feedback.{fmt}"))
+    assert cli(source, "export-users", users, "--format", fmt) == ["2 users exported."]
+    assert cli(source, "export-feedback", feedback, "--format", fmt) == ["2 feedback exported."]
+
+    target = make_app(SQLALCHEMY_DATABASE_URI="sqlite:///{tmp}/target.db")
+    assert cli(target, "import-users", users, "--format", fmt, "--workers", "1")[-1] == \
+        "2 users created, 0 rows rejected."
+    assert cli(target, "import-feedback", feedback, "--format", fmt)[-1] == \
+        "2 feedback created, 0 rows rejected."
+
+    def contents(app):
+        with app.app_context():
+            return ([(user.username, user.password, user.email, user.first_name, user.last_name)
+                     for user in User.query.order_by(User.username)],
+                    [(feedback.title, feedback.content, feedback.username)
+                     for feedback in Feedback.query.order_by(Feedback.id)])
+
+    assert contents(target) == contents(source)
+
+    # the password hashes came across, so the old password still works
+    assert login(target.test_client(), "alice").status_code == 302
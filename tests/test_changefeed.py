@@ -0,0 +1,155 @@
+""" The feedback change feed: outbox order, per consumer (and shard) cursors, retention. """
+
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import changefeed
+from conftest import add_feedback, feedback_ids, register, usernames_on
+from models import db, FeedbackEvent
+
+
+def consume(app, consumer, **kwargs):
+    """ (events read as dicts, summary) """
+
+    stream = io.StringIO()
+    with app.app_context():
+        summary = changefeed.consume(consumer, stream, **kwargs)
+    return ([json.loads(line) for line in stream.getvalue().splitlines()], summary)
+
+
+def nbr_events(app):
+    with app.app_context():
+        return FeedbackEvent.query.count()
+
+
+def age_events(app, hours):
+    with app.app_context():
+        FeedbackEvent.query.update({"created_at": datetime.utcnow() - timedelta(hours=hours)})
+        db.session.commit()
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    register(client, "alice")
+    return client
+
+
+def test_events_follow_the_writes_in_order(app, client):
+    add_feedback(client, "alice", "first", "content")
+    (feedback_id,) = feedback_ids(app, "alice")
+    client.post(f"/feedback/{feedback_id}/update", data={"title": "renamed", "content": "x", "version": "1"})
+    add_feedback(client, "alice", "second", "content")
+    client.post(f"/feedback/{feedback_id}/delete")
+
+    (events, summary) = consume(app, "search-index")
+
+    assert [(event["type"], event["feedback_id"], event["title"], event["version"]) for event in events] == [
+        ("create", feedback_id, "first", 1),
+        ("update", feedback_id, "renamed", 2),
+        ("create", feedback_id + 1, "second", 1),
+        ("delete", feedback_id, "renamed", 2)]
+    assert [event["id"] for event in events] == sorted(event["id"] for event in events)
+    assert summary["cursor"] == events[-1]["id"]
+
+
+def test_each_consumer_resumes_from_its_cursor(app, client):
+    for i in range(5):
+        add_feedback(client, "alice", f"title {i}", "content")
+
+    (events, summary) = consume(app, "a", batch_size=2)
+    assert (len(events), summary["batches"]) == (5, 3)
+
+    add_feedback(client, "alice", "later", "content")
+
+    (events, _) = consume(app, "a")
+    assert [event["title"] for event in events] == ["later"]
+    assert consume(app, "a")[0] == []
+
+    # a new consumer starts from the oldest retained event
+    (events, _) = consume(app, "b")
+    assert len(events) == 6
+
+    with app.app_context():
+        assert changefeed.get_cursor("a") == changefeed.get_cursor("b") == (0, events[-1]["id"])
+        assert changefeed.get_cursor("c") == (0, 0)
+
+
+def test_failed_write_replays_the_batch(app, client):
+    for i in range(3):
+        add_feedback(client, "alice", f"title {i}", "content")
+
+    class Broken(io.StringIO):
+        def flush(self):
+            raise OSError("disk full")
+
+    with app.app_context(), pytest.raises(OSError):
+        changefeed.consume("a", Broken())
+
+    # nothing was acknowledged, so the batch comes again
+    assert len(consume(app, "a")[0]) == 3
+
+
+def test_unsettled_events_wait(make_app, monkeypatch):
+    app = make_app(FEEDBACK_EVENTS_SETTLE_SECONDS=60)
+    client = app.test_client()
+    register(client, "alice")
+    add_feedback(client, "alice", "title", "content")
+
+    # a database without commit order guarantees waits FEEDBACK_EVENTS_SETTLE_SECONDS
+    monkeypatch.setattr(changefeed, "visibility_order", lambda: "settle")
+    assert consume(app, "a")[0] == []
+
+    age_events(app, 1)
+    assert len(consume(app, "a")[0]) == 1
+
+
+def test_prune_keeps_recent_and_unacknowledged_events(make_app):
+    app = make_app(FEEDBACK_EVENTS_RETENTION_HOURS=24)
+    client = app.test_client()
+    register(client, "alice")
+    for i in range(3):
+        add_feedback(client, "alice", f"title {i}", "content")
+
+    consume(app, "slow", batch_size=1, prune_acknowledged=False)
+    add_feedback(client, "alice", "title 3", "content")
+    (events, summary) = consume(app, "fast")
+
+    # acknowledged by both, but inside the retention period
+    assert (len(events), summary["pruned"]) == (4, 0)
+
+    age_events(app, 25)
+    (_, summary) = consume(app, "fast")
+    # only what the slowest consumer acknowledged
+    assert (summary["pruned"], nbr_events(app)) == (3, 1)
+
+    (events, summary) = consume(app, "slow")
+    assert ([event["title"] for event in events], summary["pruned"]) == (["title 3"], 1)
+    assert nbr_events(app) == 0
+
+
+def test_sharded_feed_has_a_cursor_per_shard(sharded_app):
+    app = sharded_app
+    clients = {}
+    for shard in (0, 1):
+        (username,) = usernames_on(shard, 1)
+        clients[shard] = (username, app.test_client())
+        register(clients[shard][1], username)
+        add_feedback(clients[shard][1], username, f"on {shard}", "content")
+
+    (events, summary) = consume(app, "a")
+    assert sorted((event["shard"], event["title"]) for event in events) == [(0, "on 0"), (1, "on 1")]
+    assert len(summary["cursor"]) == 2
+
+    (username, client) = clients[1]
+    add_feedback(client, username, "later on 1", "content")
+    add_feedback(client, username, "more on 1", "content")
+
+    (events, summary) = consume(app, "a")
+    assert [(event["shard"], event["title"]) for event in events] == [(1, "later on 1"), (1, "more on 1")]
+
+    with app.app_context():
+        assert [changefeed.get_cursor("a", shard)[1] for shard in (0, 1)] == summary["cursor"]
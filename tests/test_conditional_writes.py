@@ -0,0 +1,117 @@
+""" Conditional updates and deletes: only the owner's feedback, only the version that was read. """
+
+import pytest
+
+from conftest import add_feedback, feedback_ids, flashes, register, usernames_on
+from models import db, Feedback
+from sharding import shard_router
+
+
+def feedback_row(app, username, feedback_id):
+    with app.app_context():
+        shard_router.use_shard(username)
+        row = db.session.query(Feedback.title, Feedback.version).filter_by(id=feedback_id).first()
+        db.session.remove()
+    return row
+
+
+@pytest.fixture
+def two_users(app):
+    """ (alice's client, alice's feedback id, bobby's feedback id) """
+
+    bobby = app.test_client()
+    register(bobby, "bobby")
+    add_feedback(bobby, "bobby", "bobby's", "content")
+
+    alice = app.test_client()
+    register(alice, "alice")
+    add_feedback(alice, "alice", "original", "content")
+    flashes(alice)
+
+    return (alice, feedback_ids(app, "alice")[0], feedback_ids(app, "bobby")[0])
+
+
+def test_update_page_refuses_a_stale_version(app, two_users):
+    (alice, feedback_id, _) = two_users
+    update = f"/feedback/{feedback_id}/update"
+
+    response = alice.post(update, data={"title": "first", "content": "edit", "version": "1"})
+    assert response.status_code == 302 and response.location.endswith("/user/alice")
+    assert feedback_row(app, "alice", feedback_id) == ("first", 2)
+    flashes(alice)
+
+    # a second form loaded at version 1
+    response = alice.post(update, data={"title": "second", "content": "edit", "version": "1"})
+    assert response.status_code == 302 and response.location.endswith(update)
+    assert flashes(alice) == [
+        ("flash-error", "Feedback 'second' was changed by another request and was NOT updated.")]
+    assert feedback_row(app, "alice", feedback_id) == ("first", 2)
+
+
+def test_api_patch_honors_if_match(app, two_users):
+    (alice, feedback_id, _) = two_users
+    url = f"/api/feedback/{feedback_id}"
+
+    etag = alice.get(url).headers["ETag"].strip('"')
+    response = alice.patch(url, json={"title": "patched"}, headers={"If-Match": f'"{etag}"'})
+    assert response.status_code == 200
+    assert response.get_json()["feedback"]["title"] == "patched"
+    assert response.headers["ETag"].strip('"') != etag
+
+    # the ETag read before the patch no longer matches
+    response = alice.patch(url, json={"title": "stale"}, headers={"If-Match": f'"{etag}"'})
+    assert response.status_code == 412
+    response = alice.delete(url, headers={"If-Match": f'"{etag}"'})
+    assert response.status_code == 412
+    assert feedback_row(app, "alice", feedback_id) == ("patched", 2)
+
+
+def test_another_users_feedback_is_refused(app, two_users):
+    (alice, _, bobby_id) = two_users
+
+    response = alice.post(f"/feedback/{bobby_id}/update", data={"title": "mine", "content": "x", "version": "1"})
+    assert response.status_code == 302 and response.location.endswith("/user/alice")
+    assert flashes(alice) == [("flash-error", "You cannot edit another users feedback.")]
+
+    alice.post(f"/feedback/{bobby_id}/delete")
+    assert flashes(alice) == [("flash-error", "You cannot delete another users feedback.")]
+
+    assert alice.get(f"/api/feedback/{bobby_id}").status_code == 403
+    assert alice.patch(f"/api/feedback/{bobby_id}", json={"title": "mine"}).status_code == 403
+    assert alice.delete(f"/api/feedback/{bobby_id}").status_code == 403
+
+    assert feedback_row(app, "bobby", bobby_id) == ("bobby's", 1)
+
+    assert alice.patch("/api/feedback/9999", json={"title": "x"}).status_code == 404
+    assert alice.delete("/api/feedback/9999").status_code == 404
+    assert alice.post("/feedback/9999/update", data={"title": "x", "content": "x", "version": "1"}).status_code == 404
+
+
+def test_another_users_feedback_on_another_shard_is_refused(sharded_app):
+    app = sharded_app
+    (alice_name,) = usernames_on(0, 1)
+    (bobby_name,) = usernames_on(1, 1)
+
+    bobby = app.test_client()
+    register(bobby, bobby_name)
+    add_feedback(bobby, bobby_name, "bobby's", "content")
+    (bobby_id,) = feedback_ids(app, bobby_name)
+
+    alice = app.test_client()
+    register(alice, alice_name)
+    flashes(alice)
+
+    # bobby's feedback is not on alice's shard, but it exists: 403, not 404
+    assert alice.get(f"/api/feedback/{bobby_id}").status_code == 403
+    assert alice.patch(f"/api/feedback/{bobby_id}", json={"title": "mine"}).status_code == 403
+    assert alice.delete(f"/api/feedback/{bobby_id}").status_code == 403
+
+    response = alice.post(f"/feedback/{bobby_id}/update", data={"title": "mine", "content": "x", "version": "1"})
+    assert response.status_code == 302
+    assert flashes(alice) == [("flash-error", "You cannot edit another users feedback.")]
+
+    response = alice.post("/api/feedback/batch/delete", json={"ids": [bobby_id, 9999]})
+    assert [item["status"] for item in response.get_json()["results"]] == [403, 404]
+
+    assert feedback_row(app, bobby_name, bobby_id) == ("bobby's", 1)
+    assert alice.get("/api/feedback/9999").status_code == 404
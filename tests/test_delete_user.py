@@ -0,0 +1,124 @@
+""" Deleting a user: one cascading DELETE for small accounts, disable and purge for large ones. """
+
+import sqlite3
+
+import models
+from conftest import add_feedback, flashes, login, register
+from models import db, Feedback, FeedbackArchive, FeedbackEvent, User, db_delete_user
+
+
+def table_counts(app):
+    with app.app_context():
+        return {"users": User.query.count(), "feedback": Feedback.query.count(),
+                "archive": FeedbackArchive.query.count()}
+
+
+def delete_events(app):
+    with app.app_context():
+        return sorted((event.username, event.feedback_id) for event in FeedbackEvent.query.filter_by(
+            event_type="delete"))
+
+
+def make_user(app, username, nbr_feedback, nbr_archived=0):
+    """ Register username with nbr_feedback pieces of feedback, the first nbr_archived of them
+        archived. Returns the logged in client.
+    """
+
+    client = app.test_client()
+    register(client, username)
+    for i in range(nbr_feedback):
+        add_feedback(client, username, f"title {i}", "content")
+
+    if nbr_archived:
+        with app.app_context():
+            ids = [feedback.id for feedback in Feedback.query.filter_by(username=username).order_by(Feedback.id)]
+            Feedback.query.filter(Feedback.id.in_(ids[:nbr_archived])).update(
+                {"created_at": db.func.datetime("now", "-2 days")}, synchronize_session=False)
+            db.session.commit()
+        app.test_cli_runner().invoke(args=["archive-feedback", "--older-than-days", "1"])
+
+    flashes(client)
+    return client
+
+
+def test_small_account_is_deleted_with_its_feedback(app):
+    make_user(app, "bobby", 1)
+    client = make_user(app, "alice", 3, nbr_archived=1)
+    assert table_counts(app) == {"users": 2, "feedback": 3, "archive": 1}
+
+    response = client.post("/user/alice/delete")
+
+    assert response.status_code == 302
+    assert flashes(client) == [("flash-okay", "3 pieces of feedback were deleted."),
+                               ("flash-okay", "User 'alice' was deleted.")]
+    assert table_counts(app) == {"users": 1, "feedback": 1, "archive": 0}
+
+    # one delete event per piece of feedback, live or archived
+    events = delete_events(app)
+    assert len(events) == 3 and {username for (username, feedback_id) in events} == {"alice"}
+
+    with client.session_transaction() as browser_session:
+        assert "username" not in browser_session
+
+
+def test_large_account_is_disabled_then_purged_in_chunks(make_app, monkeypatch):
+    app = make_app(USER_PURGE_THRESHOLD=3, USER_PURGE_CHUNK_SIZE=2)
+    make_user(app, "bobby", 1)
+    client = make_user(app, "alice", 5, nbr_archived=2)
+
+    chunks = []
+    purge_user = models.purge_user
+    monkeypatch.setattr(models, "purge_user", lambda app, username: purge_user(
+        app, username, progress=lambda status: chunks.append(status["deleted"])))
+
+    response = client.post("/user/alice/delete")
+    assert response.status_code == 302
+    assert flashes(client) == [
+        ("flash-okay", "User 'alice' was disabled. 5 pieces of feedback will be deleted in the background.")]
+
+    # the purge runs on purge_executor's single thread; wait for it
+    models.purge_executor.submit(lambda: None).result()
+
+    # live feedback first, then the archive, two rows per chunk
+    assert chunks == [2, 3, 5]
+    assert table_counts(app) == {"users": 1, "feedback": 1, "archive": 0}
+    assert len(delete_events(app)) == 5
+
+
+def test_disabled_user_cannot_login(make_app, monkeypatch):
+    app = make_app(USER_PURGE_THRESHOLD=1)
+    client = make_user(app, "alice", 2)
+    # no purge, so the user stays disabled
+    monkeypatch.setattr(models, "schedule_purge", lambda username: None)
+
+    client.post("/user/alice/delete")
+
+    with app.app_context():
+        assert User.query.get("alice").disabled is True
+
+    client = app.test_client()
+    response = login(client, "alice")
+    assert response.status_code == 200
+    with client.session_transaction() as browser_session:
+        assert "username" not in browser_session
+
+    assert app.test_cli_runner().invoke(args=["purge-status"]).output.splitlines() == [
+        "alice: 2 feedback left", "1 users waiting to be purged."]
+    assert "alice: done, 2 feedback deleted." in app.test_cli_runner().invoke(args=["purge-disabled-users"]).output
+    assert table_counts(app) == {"users": 0, "feedback": 0, "archive": 0}
+
+
+def test_missing_user_is_reported(app, tmp_path):
+    with app.test_request_context():
+        assert db_delete_user("ghost") == {
+            "successful": False, "messages": [("error", "User 'ghost' was not found and was NOT deleted.")]}
+
+    client = make_user(app, "alice", 1)
+    # deleted by another request or process since the page was loaded
+    with sqlite3.connect(tmp_path / "primary.db") as other_worker:
+        other_worker.execute("DELETE FROM users WHERE username = 'alice'")
+
+    response = client.post("/user/alice/delete")
+
+    assert response.status_code == 302 and response.location.endswith("/user/alice")
+    assert flashes(client) == [("flash-error", "User 'alice' was not found and was NOT deleted.")]
@@ -0,0 +1,204 @@
+""" The jobs table queue (jobs.py): claiming, retries, visibility timeouts and the workers. """
+
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import jobs
+from conftest import add_feedback, register
+from jobs import job_queue
+from models import db, Job, User, enqueue_job
+
+SETTINGS = {"JOB_RETRY_BACKOFF": 10, "JOB_RETRY_BACKOFF_MAX": 25, "JOB_VISIBILITY_TIMEOUT": 60,
+            "JOB_MAX_ATTEMPTS": 4, "JOB_POLL_INTERVAL": 0.01}
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app(**SETTINGS)
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """ Payloads seen by the "record" job handler. A payload with "fail" makes it raise. """
+
+    calls = []
+
+    def record(app, payload, heartbeat):
+        calls.append(payload)
+        if payload.get("fail"):
+            raise ValueError(payload["fail"])
+
+    monkeypatch.setitem(job_queue.handlers, "record", record)
+    return calls
+
+
+def queue(name="record", payload=None, **kwargs):
+    job = enqueue_job(name, payload, **kwargs)
+    db.session.commit()
+    return job.id
+
+
+def make_due(job_id):
+    Job.query.filter_by(id=job_id).update({"run_at": datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+
+
+def test_claim_takes_the_oldest_due_job_once(app):
+    first = queue(payload={"n": 1})
+    second = queue(payload={"n": 2})
+    queue(payload={"n": 3}, delay=60)
+
+    job = job_queue.claim("w1")
+    assert (job.id, job.state, job.attempts, job.locked_by) == (first, "running", 1, "w1")
+    assert job.locked_until > datetime.utcnow() + timedelta(seconds=50)
+
+    assert job_queue.claim("w2").id == second
+    # the third is not due yet
+    assert job_queue.claim("w3") is None
+
+
+def test_failed_job_is_retried_with_backoff_then_failed(app, calls):
+    job_id = queue(payload={"fail": "boom"})
+
+    delays = []
+    for attempt in (1, 2, 3, 4):
+        job = job_queue.claim("w1")
+        assert (job.id, job.attempts) == (job_id, attempt)
+        assert job_queue.run(app, job, "w1") is False
+
+        job = Job.query.get(job_id)
+        assert job.last_error == "ValueError: boom"
+        if (attempt < 4):
+            assert job.state == "queued"
+            delays.append(round((job.run_at - datetime.utcnow()).total_seconds()))
+            assert job_queue.claim("w1") is None
+            make_due(job_id)
+
+    # 10 * 2 ** (attempts - 1) seconds, at most JOB_RETRY_BACKOFF_MAX
+    assert delays == [10, 20, 25]
+    assert (job.state, job.attempts) == ("failed", 4)
+    assert job_queue.claim("w1") is None
+    assert len(calls) == 4
+
+
+def test_unknown_handler_fails_the_attempt(app):
+    job_id = queue(name="no_such_job")
+
+    assert job_queue.run(app, job_queue.claim("w1"), "w1") is False
+    assert Job.query.get(job_id).last_error == "LookupError: no handler for job 'no_such_job'"
+
+
+def test_expired_claim_is_taken_over(app, calls):
+    job_id = queue()
+    job_queue.claim("w1")
+
+    # still hidden from the other workers
+    assert job_queue.claim("w2") is None
+
+    Job.query.filter_by(id=job_id).update({"locked_until": datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+
+    job = job_queue.claim("w2")
+    assert (job.id, job.attempts, job.locked_by) == (job_id, 2, "w2")
+
+    # the first worker finishing late changes nothing
+    job_queue.complete(job_id, "w1")
+    assert Job.query.get(job_id).state == "running"
+
+    job_queue.complete(job_id, "w2")
+    assert Job.query.get(job_id).state == "done"
+
+
+def test_expired_claim_on_the_last_attempt_fails(app):
+    job_id = queue()
+    Job.query.filter_by(id=job_id).update({"state": "running", "attempts": 4, "locked_by": "w1",
+                                           "locked_until": datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+
+    assert job_queue.claim("w2") is None
+    job = Job.query.get(job_id)
+    assert (job.state, job.last_error) == ("failed", "visibility timeout expired")
+
+
+def test_heartbeat_extends_the_claim(app):
+    job_id = queue()
+    job_queue.claim("w1")
+    Job.query.filter_by(id=job_id).update({"locked_until": datetime.utcnow() + timedelta(seconds=1)})
+    db.session.commit()
+
+    job_queue.heartbeat(job_id, "w2")
+    db.session.expire_all()
+    assert Job.query.get(job_id).locked_until < datetime.utcnow() + timedelta(seconds=5)
+
+    job_queue.heartbeat(job_id, "w1")
+    db.session.expire_all()
+    assert Job.query.get(job_id).locked_until > datetime.utcnow() + timedelta(seconds=50)
+
+
+def test_prune_deletes_old_done_jobs(app):
+    (old_done, new_done, old_failed) = (queue(), queue(), queue())
+    long_ago = datetime.utcnow() - timedelta(days=8)
+    Job.query.filter_by(id=old_done).update({"state": "done", "finished_at": long_ago})
+    Job.query.filter_by(id=new_done).update({"state": "done", "finished_at": datetime.utcnow()})
+    Job.query.filter_by(id=old_failed).update({"state": "failed", "finished_at": long_ago})
+    db.session.commit()
+
+    assert job_queue.prune() == 1
+    assert sorted(job.id for job in Job.query) == [new_done, old_failed]
+
+
+def test_run_workers_once(app, calls):
+    job_ids = [queue(payload={"n": n}) for n in range(6)]
+    failing = queue(payload={"fail": "boom"})
+    db.session.remove()
+
+    reports = []
+    lock = threading.Lock()
+
+    def report(job_id, name, succeeded):
+        with lock:
+            reports.append((job_id, succeeded))
+
+    job_queue.run_workers(app, 3, once=True, report=report)
+
+    assert sorted(reports) == sorted([(job_id, True) for job_id in job_ids] + [(failing, False)])
+    assert sorted(payload.get("n", -1) for payload in calls) == [-1, 0, 1, 2, 3, 4, 5]
+    assert {job.id: job.state for job in Job.query} == dict(
+        [(job_id, "done") for job_id in job_ids] + [(failing, "queued")])
+
+
+def test_purge_user_job(make_app):
+    app = make_app(JOBS_ENABLED=True, USER_PURGE_THRESHOLD=1, **SETTINGS)
+    client = app.test_client()
+    register(client, "alice")
+    add_feedback(client, "alice", "one", "x")
+    add_feedback(client, "alice", "two", "x")
+
+    client.post("/user/alice/delete")
+
+    with app.app_context():
+        assert [(job.name, job.serialize()["payload"]) for job in Job.query] == [("purge_user", {"username": "alice"})]
+        assert User.query.get("alice").disabled is True
+
+    job_queue.run_workers(app, 1, once=True)
+
+    with app.app_context():
+        assert User.query.count() == 0
+        assert Job.query.one().state == "done"
+
+
+def test_failed_purge_is_retried(app, monkeypatch):
+    monkeypatch.setattr(jobs, "purge_user", lambda app, username, progress=None: {
+        "username": username, "state": "failed", "deleted": 4, "chunks": 2})
+    job_id = queue(name="purge_user", payload={"username": "alice"})
+
+    with pytest.raises(RuntimeError, match="purge of alice failed after 4 rows"):
+        job_queue.handlers["purge_user"](app, {"username": "alice"}, lambda: None)
+
+    assert job_queue.run(app, job_queue.claim("w1"), "w1") is False
+    job = Job.query.get(job_id)
+    assert (job.state, job.last_error) == ("queued", "RuntimeError: purge of alice failed after 4 rows")
@@ -0,0 +1,20 @@
+""" Per request metrics cover the statements of every before_request hook. """
+
+from conftest import add_feedback, register
+from metrics import metrics
+
+
+def test_current_user_query_is_counted(make_app, monkeypatch):
+    app = make_app(USER_CACHE_ENABLED=False, RENDER_CACHE_ENABLED=False)
+    client = app.test_client()
+    register(client, "alice")
+    add_feedback(client, "alice", "title", "content")
+
+    observed = []
+    monkeypatch.setattr(metrics.request_sql_statements, "observe",
+                        lambda count, endpoint: observed.append((endpoint, count)))
+
+    client.get("/user/alice")
+
+    # the current user (identity.py's before_request hook) and the feedback page
+    assert observed == [("feedback_app.view_user_page", 2)]
@@ -0,0 +1,102 @@
+""" Read replica routing: GETs read a replica, and a session that just wrote is pinned to the
+    primary. The replica is a second SQLite file refreshed with `flask copy-to-replicas`.
+"""
+
+import re
+import sqlite3
+import time
+
+import pytest
+
+from conftest import add_feedback, login, register
+
+REPLICA = {"DB_REPLICA_URIS": "sqlite:///{tmp}/replica.db", "USER_CACHE_ENABLED": False}
+
+
+def page_titles(client, username):
+    """ Feedback titles listed on username's page (flashed messages left out) """
+
+    return re.findall(r'list-feedback-title">([^<]*)', client.get(f"/user/{username}").data.decode())
+
+
+def unpin(client):
+    with client.session_transaction() as browser_session:
+        browser_session["db_primary_until"] = 0
+
+
+@pytest.fixture
+def replicated(make_app):
+    """ (app, client) with alice registered, her feedback "old" replicated and then "fresh"
+        added on the primary only.
+    """
+
+    app = make_app(**REPLICA)
+    client = app.test_client()
+    register(client, "alice")
+    add_feedback(client, "alice", "old", "replicated")
+    assert app.test_cli_runner().invoke(args=["copy-to-replicas"]).exit_code == 0
+    add_feedback(client, "alice", "fresh", "primary only")
+
+    return (app, client)
+
+
+def test_get_reads_the_replica(replicated):
+    (app, client) = replicated
+    unpin(client)
+
+    assert page_titles(client, "alice") == ["old"]
+
+    titles = [comment["title"] for comment in client.get("/api/feedback").get_json()["feedback"]]
+    assert titles == ["old"]
+
+    app.test_cli_runner().invoke(args=["copy-to-replicas"])
+    assert "fresh" in page_titles(client, "alice")
+
+
+def test_post_pins_the_session_to_the_primary(replicated):
+    (app, client) = replicated
+
+    with client.session_transaction() as browser_session:
+        assert browser_session["db_primary_until"] > time.time()
+
+    assert "fresh" in page_titles(client, "alice")
+
+    # a GET does not extend the pin
+    with client.session_transaction() as browser_session:
+        pinned_until = browser_session["db_primary_until"]
+    client.get("/api/feedback")
+    with client.session_transaction() as browser_session:
+        assert browser_session["db_primary_until"] == pinned_until
+
+
+def test_pin_expires(make_app):
+    app = make_app(DB_REPLICA_PIN_SECONDS=0.2, **REPLICA)
+    register(app.test_client(), "alice")
+    app.test_cli_runner().invoke(args=["copy-to-replicas"])
+
+    writer = app.test_client()
+    login(writer, "alice")
+    add_feedback(writer, "alice", "fresh", "primary only")
+    assert "fresh" in page_titles(writer, "alice")
+
+    time.sleep(0.3)
+    assert "fresh" not in page_titles(writer, "alice")
+
+
+def test_replica_pages_are_not_cached(make_app, tmp_path):
+    app = make_app(**REPLICA)
+    client = app.test_client()
+    register(client, "alice")
+    add_feedback(client, "alice", "fresh", "x")
+    app.test_cli_runner().invoke(args=["copy-to-replicas"])
+
+    # a replica that has the users row (so the same pages_version) but not yet the feedback
+    with sqlite3.connect(tmp_path / "replica.db") as replica:
+        replica.execute("UPDATE feedback SET title = 'stale'")
+
+    unpin(client)
+    assert page_titles(client, "alice") == ["stale"]
+
+    # the page read from the replica must not be served once the session reads the primary
+    login(client, "alice")
+    assert page_titles(client, "alice") == ["fresh"]
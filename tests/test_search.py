@@ -0,0 +1,83 @@
+""" Feedback search on SQLite: the FTS5 table is kept in step with feedback by triggers. """
+
+from sqlalchemy import text
+
+from conftest import add_feedback, register
+from models import db, Feedback, db_search_feedback
+
+
+def search_titles(app, username, terms):
+    with app.app_context():
+        return [feedback.title for feedback in db_search_feedback(username, terms)["feedback"]]
+
+
+def fts_rows(app, terms):
+    with app.app_context():
+        return db.session.execute(text("SELECT rowid FROM feedback_fts WHERE feedback_fts MATCH :terms"),
+                                  {"terms": terms}).scalars().all()
+
+
+def test_search_matches_all_words_best_first(app):
+    client = app.test_client()
+    register(client, "alice")
+    add_feedback(client, "alice", "Pizza night", "the cheese was cold")
+    add_feedback(client, "alice", "Salad", "pizza would have been better")
+    add_feedback(client, "alice", "Soup", "nothing to do with it")
+
+    assert search_titles(app, "alice", "pizza") == ["Pizza night", "Salad"]
+    assert search_titles(app, "alice", "pizza cheese") == ["Pizza night"]
+    assert search_titles(app, "alice", "  ") == []
+
+    response = client.get("/api/feedback/search?q=pizza")
+    assert [comment["title"] for comment in response.get_json()["feedback"]] == ["Pizza night", "Salad"]
+
+
+def test_search_is_per_user_and_quotes_terms(app):
+    register(app.test_client(), "bobby")
+    client = app.test_client()
+    register(client, "alice")
+    add_feedback(client, "alice", "Pizza", "cheese")
+
+    assert search_titles(app, "bobby", "pizza") == []
+    # FTS5 syntax in the input is searched as plain words, not parsed
+    assert search_titles(app, "alice", 'pizza" OR "x') == []
+    assert search_titles(app, "alice", "NEAR(pizza") == []
+
+
+def test_update_and_delete_reach_the_index(app):
+    client = app.test_client()
+    register(client, "alice")
+    add_feedback(client, "alice", "Pizza", "cheese")
+
+    with app.app_context():
+        feedback_id = Feedback.query.filter_by(username="alice").one().id
+    assert fts_rows(app, "pizza") == [feedback_id]
+
+    client.post(f"/feedback/{feedback_id}/update", data={"title": "Pasta", "content": "tomato", "version": "1"})
+
+    assert fts_rows(app, "pizza") == []
+    assert fts_rows(app, "pasta") == [feedback_id]
+    assert search_titles(app, "alice", "tomato") == ["Pasta"]
+
+    client.post(f"/feedback/{feedback_id}/delete")
+
+    assert fts_rows(app, "pasta") == []
+    assert search_titles(app, "alice", "tomato") == []
+
+
+def test_bulk_changes_reach_the_index(app):
+    client = app.test_client()
+    register(client, "alice")
+    add_feedback(client, "alice", "Pizza", "cheese")
+    add_feedback(client, "alice", "Pizza again", "more cheese")
+
+    with app.app_context():
+        Feedback.query.filter_by(username="alice").update({"content": "olives"}, synchronize_session=False)
+        db.session.commit()
+    assert search_titles(app, "alice", "cheese") == []
+    assert len(search_titles(app, "alice", "olives")) == 2
+
+    with app.app_context():
+        Feedback.query.filter_by(username="alice").delete(synchronize_session=False)
+        db.session.commit()
+    assert fts_rows(app, "pizza") == []
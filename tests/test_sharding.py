@@ -0,0 +1,142 @@
+""" Sharding on two SQLite shard files: placement, the user directory, online moves. """
+
+import threading
+
+import pytest
+
+import models
+from conftest import add_feedback, login, register, usernames_on
+from models import db, Feedback, User, UserDirectory, move_users
+from sharding import placement, shard_router
+
+
+@pytest.fixture
+def app(sharded_app):
+    return sharded_app
+
+
+def shard_contents(app):
+    """ {shard: ([usernames], [feedback ids])} """
+
+    with app.app_context():
+        contents = {shard: (sorted(username for (username,) in db.session.query(User.username)),
+                            sorted(feedback_id for (feedback_id,) in db.session.query(Feedback.id)))
+                    for shard in shard_router.each_shard()}
+        db.session.remove()
+    return contents
+
+
+def directory(app):
+    with app.app_context():
+        return {entry.username: entry.shard for entry in UserDirectory.query}
+
+
+def test_placement_is_stable():
+    assert [placement("alice", 4)] * 3 == [placement("alice", 4) for _ in range(3)]
+    assert {placement(f"user{i}", 4) for i in range(200)} == {0, 1, 2, 3}
+
+
+def test_users_and_feedback_live_on_their_shard(app):
+    (name0,) = usernames_on(0, 1)
+    (name1,) = usernames_on(1, 1)
+
+    for username in (name0, name1):
+        client = app.test_client()
+        register(client, username)
+        add_feedback(client, username, f"{username} title", "content")
+        add_feedback(client, username, f"{username} again", "content")
+
+    contents = shard_contents(app)
+    assert contents[0][0] == [name0] and contents[1][0] == [name1]
+    assert directory(app) == {name0: 0, name1: 1}
+
+    # ids come from the global allocator, so they do not collide across shards
+    all_ids = contents[0][1] + contents[1][1]
+    assert len(all_ids) == 4 and len(set(all_ids)) == 4
+
+    client = app.test_client()
+    login(client, name1)
+    titles = [comment["title"] for comment in client.get("/api/feedback").get_json()["feedback"]]
+    assert sorted(titles) == [f"{name1} again", f"{name1} title"]
+
+
+def test_username_and_email_unique_across_shards(app):
+    (name0,) = usernames_on(0, 1)
+    (name1,) = usernames_on(1, 1)
+
+    register(app.test_client(), name0, email="shared@example.com")
+    register(app.test_client(), name1, email="shared@example.com")
+    register(app.test_client(), name0, email="other@example.com")
+
+    assert directory(app) == {name0: 0}
+    assert shard_contents(app)[1][0] == []
+
+    with app.app_context():
+        shard_router.use_shard(name0)
+        assert User.query.filter_by(username=name0).one().email == "shared@example.com"
+        db.session.remove()
+
+
+def test_move_users(app):
+    (username,) = usernames_on(0, 1)
+    client = app.test_client()
+    register(client, username)
+    add_feedback(client, username, "before", "the move")
+
+    feedback_ids = shard_contents(app)[0][1]
+
+    with app.app_context():
+        assert move_users([(username, 1)]) == 1
+        # already there
+        assert move_users([(username, 1)]) == 0
+
+    contents = shard_contents(app)
+    assert contents[0] == ([], [])
+    assert contents[1] == ([username], feedback_ids)
+    assert directory(app) == {username: 1}
+
+    add_feedback(client, username, "after", "the move")
+    titles = [comment["title"] for comment in client.get("/api/feedback").get_json()["feedback"]]
+    assert sorted(titles) == ["after", "before"]
+    assert shard_contents(app)[0] == ([], [])
+
+
+def test_writes_are_refused_during_a_move(app, monkeypatch):
+    (username,) = usernames_on(0, 1)
+    client = app.test_client()
+    register(client, username)
+    add_feedback(client, username, "before", "the move")
+    feedback_ids = shard_contents(app)[0][1]
+
+    responses = {}
+
+    def during_copy():
+        responses["api"] = client.post("/api/feedback", json={"title": "during", "content": "the move"})
+        responses["page"] = client.post(f"/user/{username}/feedback/add",
+                                        data={"title": "during", "content": "the move"})
+        responses["read"] = client.get("/api/feedback")
+
+    copy_user_rows = models.copy_user_rows
+
+    def copy_with_writes(*args, **kwargs):
+        # the requests run on a thread of their own, as they would in a web worker
+        thread = threading.Thread(target=during_copy)
+        thread.start()
+        thread.join()
+        return copy_user_rows(*args, **kwargs)
+
+    monkeypatch.setattr(models, "copy_user_rows", copy_with_writes)
+
+    with app.app_context():
+        assert move_users([(username, 1)]) == 1
+
+    assert responses["api"].status_code == 503
+    assert responses["api"].headers["Retry-After"] == "0"
+    assert responses["page"].status_code == 302
+    assert [comment["title"] for comment in responses["read"].get_json()["feedback"]] == ["before"]
+
+    # nothing was written during the copy, and writes work again once the move is done
+    with app.app_context():
+        assert UserDirectory.query.get(username).moving is False
+    assert shard_contents(app) == {0: ([], []), 1: ([username], feedback_ids)}
+    assert client.post("/api/feedback", json={"title": "after", "content": "the move"}).status_code == 201
@@ -0,0 +1,118 @@
+""" Login throttling: per IP and per username token buckets, backoff after failures. """
+
+import types
+
+import pytest
+
+import throttle
+from conftest import PASSWORD, register
+from models import User
+from throttle import login_throttle
+
+THROTTLE = {"LOGIN_THROTTLE_ENABLED": True, "LOGIN_IP_BURST": 100, "LOGIN_IP_RATE": 0.001,
+            "LOGIN_USER_BURST": 100, "LOGIN_USER_RATE": 0.001, "LOGIN_BACKOFF_AFTER": 100,
+            "LOGIN_BACKOFF_BASE": 1.0, "LOGIN_BACKOFF_MAX": 300.0}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """ The throttle's time.time(), moved forward with clock.now += seconds """
+
+    clock = types.SimpleNamespace(now=1000000.0)
+    monkeypatch.setattr(throttle, "time", types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def hashes(monkeypatch):
+    """ Calls that reached User.authenticate (the bcrypt verify) """
+
+    calls = []
+    authenticate = User.authenticate.__func__
+
+    def counted(cls, username, pwd):
+        calls.append(username)
+        return authenticate(cls, username, pwd)
+
+    monkeypatch.setattr(User, "authenticate", classmethod(counted))
+    return calls
+
+
+def make(make_app, **config):
+    app = make_app(**dict(THROTTLE, **config))
+    register(app.test_client(), "alice")
+    return app
+
+
+def attempt(app, username="alice", password="wrong-password", ip="10.0.0.1"):
+    client = app.test_client()
+    response = client.post("/login", data={"username": username, "password": password},
+                           environ_base={"REMOTE_ADDR": ip})
+    return response.status_code
+
+
+def test_ip_bucket(make_app, clock, hashes):
+    app = make(make_app, LOGIN_IP_BURST=3, LOGIN_IP_RATE=1.0)
+
+    assert [attempt(app, f"user{i}") for i in range(4)] == [200, 200, 200, 429]
+    # another client IP has its own bucket
+    assert attempt(app, "user9", ip="10.0.0.2") == 200
+
+    # refilled at LOGIN_IP_RATE
+    clock.now += 1
+    assert [attempt(app, "user5"), attempt(app, "user6")] == [200, 429]
+
+    assert hashes == ["user0", "user1", "user2", "user9", "user5"]
+
+
+def test_username_bucket(make_app, clock, hashes):
+    app = make(make_app, LOGIN_USER_BURST=2, LOGIN_USER_RATE=0.1)
+
+    assert [attempt(app, ip=f"10.0.0.{i}") for i in range(3)] == [200, 200, 429]
+    # other usernames are not affected
+    assert attempt(app, "bobby") == 200
+
+    clock.now += 10
+    assert attempt(app, password=PASSWORD) == 302
+
+    assert hashes == ["alice", "alice", "bobby", "alice"]
+
+
+def test_backoff_after_failures(make_app, clock, hashes):
+    app = make(make_app, LOGIN_BACKOFF_AFTER=2, LOGIN_BACKOFF_BASE=1.0, LOGIN_BACKOFF_MAX=4.0)
+
+    assert [attempt(app), attempt(app)] == [200, 200]
+
+    # 1, 2, 4 then capped at 4 seconds
+    for delay in (1, 2, 4, 4):
+        response = app.test_client().post("/login", data={"username": "alice", "password": PASSWORD})
+        assert response.status_code == 429
+        assert f"try again in {delay} seconds".encode() in response.data
+
+        clock.now += delay
+        assert attempt(app) == 200
+
+    assert len(hashes) == 6
+
+    # a successful login clears the failures
+    clock.now += 4
+    assert attempt(app, password=PASSWORD) == 302
+    assert [attempt(app), attempt(app)] == [200, 200]
+
+
+def test_backoff_exponent_is_capped(make_app, clock):
+    make(make_app, LOGIN_BACKOFF_AFTER=3, LOGIN_BACKOFF_MAX=300.0)
+
+    # a very long run of failures
+    login_throttle.store.update("user:alice", lambda value: (f"5|{clock.now}|5000|0", None))
+    login_throttle.record_failure("alice")
+
+    (tokens, last, failures, locked_until) = login_throttle.store.get("user:alice").split("|")
+    assert (int(failures), float(locked_until)) == (5001, clock.now + 300.0)
+
+
+def test_throttled_attempts_are_refused_before_hashing(make_app, clock, hashes):
+    app = make(make_app, LOGIN_USER_BURST=1)
+
+    assert [attempt(app) for _ in range(3)] == [200, 429, 429]
+    assert hashes == ["alice"]
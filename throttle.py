@@ -0,0 +1,158 @@
+""" Login throttling.
+
+    Every POST to /login costs a bcrypt verify, so an unthrottled credential stuffing burst
+    turns into a CPU denial of service. LoginThrottle is checked before the user is looked up
+    or any password is hashed:
+
+        - a token bucket per client IP (LOGIN_IP_BURST attempts, refilled at LOGIN_IP_RATE per
+          second)
+        - a token bucket per username (LOGIN_USER_BURST, LOGIN_USER_RATE)
+        - exponential backoff per username once it has LOGIN_BACKOFF_AFTER consecutive failures:
+          LOGIN_BACKOFF_BASE seconds, doubling per failure, capped at LOGIN_BACKOFF_MAX.
+
+    State lives in a bounded store (store.py): "memory" per worker, or "sqlite" at
+    LOGIN_THROTTLE_PATH so the workers on one host share limits. LOGIN_THROTTLE_MAX_ENTRIES
+    bounds either one. Rejections are counted in feedback_login_throttled_total by reason.
+
+    The IP is request.remote_addr; behind a reverse proxy wrap the app in werkzeug's ProxyFix.
+"""
+
+import time
+
+from metrics import metrics
+from store import make_store
+
+
+def refill(tokens, last, now, burst, rate):
+    """ Token count after refilling from last to now. """
+
+    return min(burst, tokens + (now - last) * rate)
+
+
+class LoginThrottle:
+    """ Token buckets per IP and username plus failure backoff per username. """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.store = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("LOGIN_THROTTLE_ENABLED", True)
+        app.config.setdefault("LOGIN_THROTTLE_BACKEND", "memory")
+        app.config.setdefault("LOGIN_THROTTLE_PATH", "")
+        app.config.setdefault("LOGIN_THROTTLE_MAX_ENTRIES", 100000)
+        app.config.setdefault("LOGIN_IP_BURST", 20)
+        app.config.setdefault("LOGIN_IP_RATE", 1.0)
+        app.config.setdefault("LOGIN_USER_BURST", 5)
+        app.config.setdefault("LOGIN_USER_RATE", 0.1)
+        app.config.setdefault("LOGIN_BACKOFF_AFTER", 3)
+        app.config.setdefault("LOGIN_BACKOFF_BASE", 1.0)
+        app.config.setdefault("LOGIN_BACKOFF_MAX", 300.0)
+
+        self.enabled = app.config["LOGIN_THROTTLE_ENABLED"]
+        self.store = make_store(app.config["LOGIN_THROTTLE_BACKEND"],
+                                path=app.config["LOGIN_THROTTLE_PATH"],
+                                max_entries=app.config["LOGIN_THROTTLE_MAX_ENTRIES"],
+                                table="login_throttle")
+
+        self.ip_burst = app.config["LOGIN_IP_BURST"]
+        self.ip_rate = app.config["LOGIN_IP_RATE"]
+        self.user_burst = app.config["LOGIN_USER_BURST"]
+        self.user_rate = app.config["LOGIN_USER_RATE"]
+        self.backoff_after = app.config["LOGIN_BACKOFF_AFTER"]
+        self.backoff_base = app.config["LOGIN_BACKOFF_BASE"]
+        self.backoff_max = app.config["LOGIN_BACKOFF_MAX"]
+
+    # state is kept as "tokens|last" for IPs and "tokens|last|failures|locked_until" for users
+
+    def take_ip_token(self, ip, now):
+        def take(value):
+            (tokens, last) = map(float, value.split("|")) if value else (self.ip_burst, now)
+            tokens = refill(tokens, last, now, self.ip_burst, self.ip_rate)
+
+            if (tokens < 1):
+                return (f"{tokens}|{now}", (1 - tokens) / self.ip_rate)
+
+            return (f"{tokens - 1}|{now}", None)
+
+        return self.store.update(f"ip:{ip}", take)
+
+    def take_user_token(self, username, now):
+        """ Returns (retry_after, reason) - retry_after is None when the attempt is allowed. """
+
+        def take(value):
+            if value:
+                (tokens, last, failures, locked_until) = value.split("|")
+                (tokens, last, failures, locked_until) = (float(tokens), float(last), int(failures), float(locked_until))
+            else:
+                (tokens, last, failures, locked_until) = (self.user_burst, now, 0, 0.0)
+
+            tokens = refill(tokens, last, now, self.user_burst, self.user_rate)
+
+            if (now < locked_until):
+                return (f"{tokens}|{now}|{failures}|{locked_until}", (locked_until - now, "backoff"))
+
+            if (tokens < 1):
+                return (f"{tokens}|{now}|{failures}|{locked_until}", ((1 - tokens) / self.user_rate, "user_rate"))
+
+            return (f"{tokens - 1}|{now}|{failures}|{locked_until}", (None, None))
+
+        return self.store.update(f"user:{username}", take)
+
+    def check(self, username, ip):
+        """ Spend one login attempt for username from ip. Returns None when the attempt may go
+            ahead, otherwise the number of seconds to wait.
+        """
+
+        if not self.enabled:
+            return None
+
+        now = time.time()
+
+        retry_after = self.take_ip_token(ip, now)
+        if retry_after is not None:
+            metrics.login_throttled.inc("ip_rate")
+            return retry_after
+
+        (retry_after, reason) = self.take_user_token(username, now)
+        if retry_after is not None:
+            metrics.login_throttled.inc(reason)
+            return retry_after
+
+        return None
+
+    def record_failure(self, username):
+        """ Count a failed login for username and start / extend its backoff. """
+
+        if not self.enabled:
+            return
+
+        now = time.time()
+
+        def fail(value):
+            if value:
+                (tokens, last, failures, locked_until) = value.split("|")
+            else:
+                (tokens, last, failures, locked_until) = (self.user_burst, now, 0, 0.0)
+
+            failures = int(failures) + 1
+            if (failures >= self.backoff_after):
+                # the exponent is capped so a long run of failures cannot overflow the float
+                delay = min(self.backoff_max, self.backoff_base * 2 ** min(failures - self.backoff_after, 32))
+                locked_until = now + delay
+
+            return (f"{tokens}|{last}|{failures}|{locked_until}", None)
+
+        self.store.update(f"user:{username}", fail)
+
+    def record_success(self, username):
+        """ A successful login clears username's failures and backoff. """
+
+        if self.enabled:
+            self.store.delete(f"user:{username}")
+
+
+login_throttle = LoginThrottle()